@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""Startup benchmark for server5 service roles.
+
+For each SERVICE_ROLE this measures, in fresh interpreters:
+  import  - time to `import server5`
+  live    - time from spawning uvicorn until /health/live answers
+  ready   - time until /health/ready reports 200 (model loaded and warmed up)
+  rss     - peak resident memory of the server at that point
+
+Usage:
+    python scripts/bench-startup.py [--roles chat caption all] [--runs 3]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+IMPORT_SNIPPET = (
+    "import time; t = time.perf_counter(); import server5; "
+    "print(time.perf_counter() - t)"
+)
+
+
+def role_env(role: str) -> dict:
+    return {**os.environ, "SERVICE_ROLE": role}
+
+
+def time_import(role: str) -> float:
+    out = subprocess.run([sys.executable, "-c", IMPORT_SNIPPET], cwd=ROOT, env=role_env(role),
+                         capture_output=True, text=True, check=True)
+    return float(out.stdout.strip().splitlines()[-1])
+
+
+def peak_rss_mb(pid: int) -> float:
+    """VmHWM from /proc (Linux only); 0 when unavailable."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return 0.0
+
+
+def time_ready(role: str, port: int, timeout: float) -> tuple:
+    """(seconds until live, seconds until ready, peak RSS in MB)."""
+    cmd = [sys.executable, "-m", "uvicorn", "server5:app", "--port", str(port), "--log-level", "warning"]
+    start = time.perf_counter()
+    proc = subprocess.Popen(cmd, cwd=ROOT, env=role_env(role),
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    live = None
+    try:
+        while time.perf_counter() - start < timeout:
+            if proc.poll() is not None:
+                raise RuntimeError(f"server exited with {proc.returncode} (role={role})")
+            try:
+                response = httpx.get(f"http://127.0.0.1:{port}/health/ready", timeout=1)
+            except httpx.HTTPError:
+                time.sleep(0.05)
+                continue
+            live = live or time.perf_counter() - start
+            if response.status_code == 200:
+                return live, time.perf_counter() - start, peak_rss_mb(proc.pid)
+            startup = response.json().get("detail", {})
+            if startup.get("phase") == "failed":
+                raise RuntimeError(f"startup failed (role={role}): {startup.get('error')}")
+            time.sleep(0.05)
+        raise TimeoutError(f"server not ready after {timeout}s (role={role})")
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--roles", nargs="+", default=["chat", "caption", "all"],
+                        choices=["chat", "caption", "all"])
+    parser.add_argument("--runs", type=int, default=3, help="repetitions per role (median is reported)")
+    parser.add_argument("--port", type=int, default=8599)
+    parser.add_argument("--timeout", type=float, default=600, help="readiness timeout in seconds")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    results = {}
+    for role in args.roles:
+        imports = [time_import(role) for _ in range(args.runs)]
+        readies = [time_ready(role, args.port, args.timeout) for _ in range(args.runs)]
+        results[role] = {
+            "import_s": round(statistics.median(imports), 3),
+            "live_s": round(statistics.median(r[0] for r in readies), 3),
+            "ready_s": round(statistics.median(r[1] for r in readies), 3),
+            "peak_rss_mb": round(max(r[2] for r in readies), 1),
+        }
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{'role':<10}{'import (s)':>12}{'live (s)':>12}{'ready (s)':>12}{'peak RSS (MB)':>16}")
+    for role, r in results.items():
+        print(f"{role:<10}{r['import_s']:>12.3f}{r['live_s']:>12.3f}{r['ready_s']:>12.3f}"
+              f"{r['peak_rss_mb']:>16.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,25 +2,42 @@
 
 # server.py - Optimized Video Caption API
 import os
-import torch
+import re
+import json
+import math
+import random
+import sqlite3
+import time
+import hashlib
+import subprocess
+import uuid
+import asyncio
+import queue
+import itertools
+import threading
+import weakref
 import tempfile
-import requests
-from fastapi import FastAPI, HTTPException, BackgroundTasks, Body, Query
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from dataclasses import dataclass, field, replace
+from fastapi import APIRouter, FastAPI, HTTPException, BackgroundTasks, Body, Query
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, Field
-from contextlib import asynccontextmanager
-from transformers import BitsAndBytesConfig
-from qwen_vl_utils import process_vision_info
-import boto3
-from botocore.exceptions import ClientError
+from contextlib import asynccontextmanager, contextmanager
+from urllib.parse import parse_qs, unquote, urlsplit
+from xml.etree import ElementTree
 import logging
-from typing import List, Optional, Literal
-from functools import lru_cache
+from typing import TYPE_CHECKING, AsyncIterator, List, Optional, Literal, Sequence
+from functools import lru_cache, partial
 import httpx
-from openai import OpenAI
-import anthropic
-from groq import Groq
 from dotenv import load_dotenv
 
+# torch, transformers, qwen_vl_utils, boto3 and the LLM SDKs are imported
+# where they are first used, so a chat-only worker never loads the VLM stack
+if TYPE_CHECKING:
+    import torch
+
 load_dotenv()
 
 # Configure logging
@@ -31,31 +48,119 @@ logger = logging.getLogger(__name__)
 # CONFIGURATION
 # =============================================================================
 
+# Service role: "caption" (VLM + transcription), "chat" (LLM only) or "all"
+SERVICE_ROLE = os.getenv("SERVICE_ROLE", "all")
+if SERVICE_ROLE not in ("caption", "chat", "all"):
+    raise ValueError(f"Unknown SERVICE_ROLE: {SERVICE_ROLE}")
+SERVES_CAPTIONS = SERVICE_ROLE in ("caption", "all")
+SERVES_CHAT = SERVICE_ROLE in ("chat", "all")
+
 # Model configuration
 MODEL_ID = os.getenv("MODEL_ID", "Qwen/Qwen3-VL-8B-Instruct")
 QUANTIZATION = os.getenv("QUANTIZATION", "None")  # "None", "8-bit", "4-bit"
 ATTENTION_IMPL = os.getenv("ATTENTION_IMPL", "flash_attention_2")
 MAX_TOKENS = int(os.getenv("MAX_TOKENS", "1024"))
-RESOLUTION_MODE = os.getenv("RESOLUTION_MODE", "auto")
+RESOLUTION_MODE = os.getenv("RESOLUTION_MODE", "auto")  # "auto", "low", "high", "budget:<tokens>"
+RESOLUTION_MIN_PIXELS = int(os.getenv("RESOLUTION_MIN_PIXELS", str(64 * 28 * 28)))
+FRAME_DECODE_MODE = os.getenv("FRAME_DECODE_MODE", "pipe")  # "pipe" (in-memory) or "file"
+# Frame selection (pipe mode): "uniform", "scene" (ffmpeg scene score), "phash" (dHash dedup) or "scene+phash"
+FRAME_SELECT = os.getenv("FRAME_SELECT", "uniform")
+SCENE_THRESHOLD = float(os.getenv("SCENE_THRESHOLD", "0.01"))  # UI changes score far below cut-detection levels
+PHASH_DISTANCE = int(os.getenv("PHASH_DISTANCE", "4"))  # max differing bits (of 64) for a duplicate
+SELECT_MIN_FRAMES = int(os.getenv("SELECT_MIN_FRAMES", "8"))
+FFMPEG_TIMEOUT = int(os.getenv("FFMPEG_TIMEOUT", "300"))
+
+# Warm-up: caption a synthetic clip before reporting ready (0 runs disables)
+WARMUP_RUNS = int(os.getenv("WARMUP_RUNS", "1"))
+WARMUP_SECONDS = float(os.getenv("WARMUP_SECONDS", "10"))
+WARMUP_RESOLUTION = os.getenv("WARMUP_RESOLUTION", "1280x720")  # synthetic clip size (WxH)
+# Decoding: "off", "static" (static KV cache) or "compile" (static cache + torch.compile'd decode step)
+GENERATION_COMPILE = os.getenv("GENERATION_COMPILE", "off")
+COMPILE_CACHE_DIR = os.getenv("COMPILE_CACHE_DIR", "./compile_cache")
+if GENERATION_COMPILE == "compile":
+    # Read by inductor when torch loads; persisted graphs let restarts skip recompiling
+    os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", os.path.abspath(COMPILE_CACHE_DIR))
+    os.environ.setdefault("TORCHINDUCTOR_FX_GRAPH_CACHE", "1")
+    os.environ.setdefault("TORCHINDUCTOR_AUTOGRAD_CACHE", "1")
 
 # Prompt configuration
 PROMPT_FILE_PATH = os.getenv("PROMPT_FILE_PATH", "./prompt.txt")
 DEFAULT_PROMPT = "Describe this video."
+# Multi-prompt jobs: answer several prompts from one decode and one vision encoding of the video
+MAX_PROMPTS = int(os.getenv("MAX_PROMPTS", "8"))
+PREFIX_CACHE = os.getenv("PREFIX_CACHE", "true").lower() == "true"  # reuse the KV cache up to the end of the video
+
+# Long videos: split into keyframe-aligned segments, caption each, merge with the LLM (0, the default, disables)
+LONG_VIDEO_SECONDS = float(os.getenv("LONG_VIDEO_SECONDS", "0"))
+SEGMENT_SECONDS = float(os.getenv("SEGMENT_SECONDS", "180"))
+LONG_VIDEO_MAX_SEGMENTS = int(os.getenv("LONG_VIDEO_MAX_SEGMENTS", "16"))  # segments lengthen past this
+MERGE_PROMPT_FILE_PATH = os.getenv("MERGE_PROMPT_FILE_PATH", "./merge_prompt.txt")
+MERGE_MAX_TOKENS = int(os.getenv("MERGE_MAX_TOKENS", "2048"))
+DEFAULT_MERGE_PROMPT = (
+    "You are given captions of consecutive segments of one video, in order, with their time "
+    "ranges, followed by the instructions each caption was written to. Merge them into a single "
+    "caption of the whole video that follows those instructions. Keep every distinct step or event "
+    "in order, remove repetition across segment boundaries, and do not mention the segments."
+)
 
 # API configuration
 CAPTION_RESULT_ENDPOINT = os.getenv("RESPONSE_WEBHOOK_URL")
 RESULT_API_TIMEOUT = int(os.getenv("RESULT_API_TIMEOUT", "30"))
 RESULT_API_KEY = os.getenv("RESULT_API_KEY", "")
 
+# Webhook outbox configuration (WEBHOOK_BATCH_SIZE > 1 posts JSON lists of payloads)
+WEBHOOK_OUTBOX_PATH = os.getenv("WEBHOOK_OUTBOX_PATH", "./webhook_outbox.db")
+WEBHOOK_CONCURRENCY = int(os.getenv("WEBHOOK_CONCURRENCY", "4"))  # per endpoint
+WEBHOOK_BATCH_SIZE = int(os.getenv("WEBHOOK_BATCH_SIZE", "1"))
+WEBHOOK_MAX_ATTEMPTS = int(os.getenv("WEBHOOK_MAX_ATTEMPTS", "10"))
+WEBHOOK_BACKOFF_BASE = float(os.getenv("WEBHOOK_BACKOFF_BASE", "1.0"))
+WEBHOOK_BACKOFF_MAX = float(os.getenv("WEBHOOK_BACKOFF_MAX", "300"))
+WEBHOOK_POLL_INTERVAL = float(os.getenv("WEBHOOK_POLL_INTERVAL", "5"))
+WEBHOOK_DEAD_RETENTION_HOURS = float(os.getenv("WEBHOOK_DEAD_RETENTION_HOURS", "168"))  # 0 keeps dead rows forever
+WEBHOOK_PRUNE_INTERVAL = float(os.getenv("WEBHOOK_PRUNE_INTERVAL", "3600"))
+
 # AWS configuration
 AWS_ACCESS_KEY_ID = os.getenv("AWS_ACCESS_KEY_ID")
 AWS_SECRET_ACCESS_KEY = os.getenv("AWS_SECRET_ACCESS_KEY")
 AWS_REGION = os.getenv("AWS_REGION", "us-east-1")
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL")  # e.g. MinIO or a local S3 stand-in
+
+# Download configuration (shared by ranged HTTP GETs and S3 multipart transfers)
+DOWNLOAD_CONCURRENCY = int(os.getenv("DOWNLOAD_CONCURRENCY", "8"))
+DOWNLOAD_PART_MB = int(os.getenv("DOWNLOAD_PART_MB", "8"))
+DOWNLOAD_PARALLEL_MIN_MB = int(os.getenv("DOWNLOAD_PARALLEL_MIN_MB", "16"))
 
 # LLM configuration
 LLM_PROVIDER = os.getenv("LLM_PROVIDER", "groq").lower()
 CHAT_MAX_TOKENS = int(os.getenv("CHAT_MAX_TOKENS", "2000"))
 CHAT_TEMPERATURE = float(os.getenv("CHAT_TEMPERATURE", "0.7"))
+CHAT_STREAM_WEBHOOK = os.getenv("CHAT_STREAM_WEBHOOK", "false").lower() == "true"  # default for ChatRequest.stream
+CHAT_STREAM_INTERVAL_MS = int(os.getenv("CHAT_STREAM_INTERVAL_MS", "500"))  # partial webhook posts at most this often...
+CHAT_STREAM_TOKENS = int(os.getenv("CHAT_STREAM_TOKENS", "50"))  # ...unless this many tokens are waiting
+
+# LLM routing: providers in preference order; empty means LLM_PROVIDER alone
+LLM_PROVIDERS = [p.strip().lower() for p in os.getenv("LLM_PROVIDERS", "").split(",") if p.strip()]
+LLM_HEDGE = os.getenv("LLM_HEDGE", "false").lower() == "true"
+LLM_HEDGE_DEFAULT_MS = int(os.getenv("LLM_HEDGE_DEFAULT_MS", "3000"))  # hedge delay until p95 is known
+LLM_HEDGE_MIN_MS = int(os.getenv("LLM_HEDGE_MIN_MS", "250"))
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "3"))  # consecutive 429/5xx/network errors
+LLM_BREAKER_COOLDOWN = int(os.getenv("LLM_BREAKER_COOLDOWN", "30"))
+LLM_STATS_WINDOW = int(os.getenv("LLM_STATS_WINDOW", "600"))  # seconds of latency history per provider
+
+# Chat context compaction: token budget for history plus the new message, not counting
+# the system prompt and initial content (0, the default, sends full history)
+CHAT_CONTEXT_TOKENS = int(os.getenv("CHAT_CONTEXT_TOKENS", "0"))
+CHAT_KEEP_MESSAGES = int(os.getenv("CHAT_KEEP_MESSAGES", "6"))  # recent history kept verbatim
+CHAT_SUMMARY_STEP = int(os.getenv("CHAT_SUMMARY_STEP", "4"))  # summary rolls forward this many messages at a time
+CHAT_SUMMARY_MAX_TOKENS = int(os.getenv("CHAT_SUMMARY_MAX_TOKENS", "600"))
+CHAT_SUMMARY_CACHE_DIR = os.getenv("CHAT_SUMMARY_CACHE_DIR", "./chat_summaries")
+CHAT_SUMMARY_CACHE_MAX_MB = int(os.getenv("CHAT_SUMMARY_CACHE_MAX_MB", "32"))
+
+# Chat response cache: on by default for temperature 0, per-request opt-in otherwise (0 entries disables)
+CHAT_CACHE_SIZE = int(os.getenv("CHAT_CACHE_SIZE", "512"))
+CHAT_CACHE_TTL = int(os.getenv("CHAT_CACHE_TTL", "3600"))
+CHAT_CACHE_DIR = os.getenv("CHAT_CACHE_DIR", "")  # optional on-disk tier
+CHAT_CACHE_MAX_MB = int(os.getenv("CHAT_CACHE_MAX_MB", "64"))
 CHAT_SYSTEM_PROMPT = os.getenv("CHAT_SYSTEM_PROMPT", """You are a helpful AI assistant that helps users refine and modify video processing steps or captions. 
 Users may have generated steps or captions from videos, and they want to chat with you to make changes, improvements, or ask questions.
 Be concise, helpful, and focus on understanding what changes the user wants to make.""")
@@ -66,6 +171,72 @@ USE_AUDIO_GUARDRAIL = os.getenv("USE_AUDIO_GUARDRAIL", "true").lower() == "true"
 AUDIO_SOURCE_MODE = os.getenv("AUDIO_SOURCE_MODE", "extract")  # "separate", "extract", "both"
 AUDIO_EXTRACT_FORMAT = os.getenv("AUDIO_EXTRACT_FORMAT", "mp3")
 AUDIO_EXTRACT_BITRATE = os.getenv("AUDIO_EXTRACT_BITRATE", "128k")
+AUDIO_LOOKUP_NEGATIVE_TTL = int(os.getenv("AUDIO_LOOKUP_NEGATIVE_TTL", "60"))
+
+# Transcription configuration
+WHISPER_BACKEND = os.getenv("WHISPER_BACKEND", "groq").lower()  # "groq" or "openai" (any compatible API)
+WHISPER_BASE_URL = os.getenv("WHISPER_BASE_URL")  # e.g. a self-hosted Whisper server or a local stub
+TRANSCRIBE_CHUNK_SECONDS = int(os.getenv("TRANSCRIBE_CHUNK_SECONDS", "300"))
+TRANSCRIBE_CONCURRENCY = int(os.getenv("TRANSCRIBE_CONCURRENCY", "4"))
+TRANSCRIBE_RETRIES = int(os.getenv("TRANSCRIBE_RETRIES", "2"))
+SILENCE_NOISE_DB = float(os.getenv("SILENCE_NOISE_DB", "-35"))  # silencedetect threshold
+SILENCE_MIN_SECONDS = float(os.getenv("SILENCE_MIN_SECONDS", "0.5"))
+SILENT_TRACK_MAX_DB = float(os.getenv("SILENT_TRACK_MAX_DB", "-50"))  # quieter peaks are skipped
+TRANSCRIPT_CACHE_DIR = os.getenv("TRANSCRIPT_CACHE_DIR", "./transcript_cache")
+TRANSCRIPT_CACHE_MAX_MB = int(os.getenv("TRANSCRIPT_CACHE_MAX_MB", "64"))
+
+# Job scheduler configuration
+CAPTION_QUEUE_SIZE = int(os.getenv("CAPTION_QUEUE_SIZE", "64"))
+QUEUE_RETRY_AFTER = int(os.getenv("QUEUE_RETRY_AFTER", "30"))
+JOB_HISTORY_SIZE = int(os.getenv("JOB_HISTORY_SIZE", "1000"))
+
+# Bulk captioning (/caption/batch): items are fed into the pipeline a few at a
+# time, leaving admission slots for single /caption requests
+BULK_MAX_ITEMS = int(os.getenv("BULK_MAX_ITEMS", "10000"))
+BULK_CONCURRENCY = int(os.getenv("BULK_CONCURRENCY", "16"))  # bulk jobs in the pipeline at once, all batches
+BULK_RESULT_CHUNK = int(os.getenv("BULK_RESULT_CHUNK", "50"))  # results per webhook payload
+BULK_FLUSH_SECONDS = float(os.getenv("BULK_FLUSH_SECONDS", "30"))  # max wait for a chunk to fill
+BULK_HISTORY_SIZE = int(os.getenv("BULK_HISTORY_SIZE", "100"))
+
+# Micro-batching configuration
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "4"))
+BATCH_MAX_WAIT_MS = int(os.getenv("BATCH_MAX_WAIT_MS", "200"))
+BATCH_MAX_VISUAL_TOKENS = int(os.getenv("BATCH_MAX_VISUAL_TOKENS", "32768"))
+
+# Model replicas: "" shards one replica over every GPU (device_map="auto"),
+# "all" loads one replica per visible GPU, or list devices ("cuda:0,cuda:1")
+CAPTION_DEVICES = os.getenv("CAPTION_DEVICES", "")
+REPLICA_MAX_FAILURES = int(os.getenv("REPLICA_MAX_FAILURES", "3"))  # consecutive, before cooldown
+REPLICA_COOLDOWN = int(os.getenv("REPLICA_COOLDOWN", "60"))
+
+# GPU memory admission: jobs are held until their estimated KV cache and
+# activations fit in this fraction of a replica's free memory (0 disables)
+ADMISSION_MEMORY_FRACTION = float(os.getenv("ADMISSION_MEMORY_FRACTION", "0.9"))
+ADMISSION_OVERHEAD = float(os.getenv("ADMISSION_OVERHEAD", "1.5"))  # activations on top of the KV cache
+OOM_MAX_RETRIES = int(os.getenv("OOM_MAX_RETRIES", "3"))  # downscaled retries after a CUDA OOM
+
+# Caption result cache configuration (0 MB disables the cache)
+CAPTION_CACHE_DIR = os.getenv("CAPTION_CACHE_DIR", "./caption_cache")
+CAPTION_CACHE_MAX_MB = int(os.getenv("CAPTION_CACHE_MAX_MB", "256"))
+
+# Pipeline stage configuration: <STAGE>_WORKERS and <STAGE>_QUEUE_SIZE.
+# The download stage reads straight from the CAPTION_QUEUE_SIZE admission queue.
+def stage_config(name: str, workers: int, queue_size: int) -> tuple[int, int]:
+    prefix = name.upper()
+    return (int(os.getenv(f"{prefix}_WORKERS", str(workers))),
+            int(os.getenv(f"{prefix}_QUEUE_SIZE", str(queue_size))))
+
+PIPELINE_CONFIG = {
+    "download": stage_config("download", 4, CAPTION_QUEUE_SIZE),
+    "preprocess": stage_config("preprocess", 2, 4),
+    "transcribe": stage_config("transcribe", 2, 4),
+    # Jobs waiting on the batcher hold decoded frames, so keep this queue short.
+    # 0 workers: 2 * BATCH_MAX_SIZE per model replica, sized once the replicas are known
+    "generate": stage_config("generate", 0, BATCH_MAX_SIZE),
+    "deliver": stage_config("deliver", 2, 16),
+}
+
+MB = 1024 * 1024
 
 # File extensions (defined once)
 VIDEO_EXTENSIONS = ('.mp4', '.mov', '.avi', '.webm', '.mkv', '.gif', '.flv')
@@ -77,30 +248,38 @@ LLM_CONFIGS = {
         "api_key_env": "OPENAI_API_KEY",
         "model_env": "OPENAI_MODEL",
         "default_model": "gpt-4o-mini",
-        "base_url": os.getenv("OPENAI_BASE_URL"),
+        "base_url_env": "OPENAI_BASE_URL",
+        "stream_usage": True,  # accepts stream_options={"include_usage": True}
     },
     "groq": {
         "api_key_env": "GROQ_API_KEY",
         "model_env": "GROQ_MODEL",
         "default_model": "llama-3.3-70b-versatile",
         "base_url": "https://api.groq.com/openai/v1",
+        "base_url_env": "GROQ_CHAT_BASE_URL",  # GROQ_BASE_URL belongs to the Groq SDK (Whisper)
+        "stream_usage": True,
     },
     "together": {
         "api_key_env": "TOGETHER_API_KEY",
         "model_env": "TOGETHER_MODEL",
         "default_model": "meta-llama/Meta-Llama-3.1-70B-Instruct-Turbo",
         "base_url": "https://api.together.xyz/v1",
+        "base_url_env": "TOGETHER_BASE_URL",
+        "stream_usage": True,
     },
     "openrouter": {
         "api_key_env": "OPENROUTER_API_KEY",
         "model_env": "OPENROUTER_MODEL",
         "default_model": "anthropic/claude-3.5-sonnet",
         "base_url": "https://openrouter.ai/api/v1",
+        "base_url_env": "OPENROUTER_BASE_URL",
+        "stream_usage": True,
     },
     "anthropic": {
         "api_key_env": "ANTHROPIC_API_KEY",
         "model_env": "ANTHROPIC_MODEL",
         "default_model": "claude-3-5-sonnet-20241022",
+        "base_url_env": "ANTHROPIC_BASE_URL",
     },
 }
 
@@ -108,21 +287,20 @@ LLM_CONFIGS = {
 # GLOBAL STATE
 # =============================================================================
 
-model = None
-processor = None
-http_client: Optional[httpx.Client] = None
+http_client: Optional[httpx.AsyncClient] = None
 
 # =============================================================================
 # HTTP CLIENT WITH CONNECTION POOLING
 # =============================================================================
 
-def get_http_client() -> httpx.Client:
-    """Get or create HTTP client with connection pooling."""
+def get_http_client() -> httpx.AsyncClient:
+    """Get or create the async HTTP client with connection pooling."""
     global http_client
     if http_client is None:
-        http_client = httpx.Client(
+        http_client = httpx.AsyncClient(
             timeout=httpx.Timeout(300.0, connect=10.0),
-            limits=httpx.Limits(max_keepalive_connections=10, max_connections=20),
+            limits=httpx.Limits(max_keepalive_connections=10 * DOWNLOAD_CONCURRENCY,
+                                max_connections=20 * DOWNLOAD_CONCURRENCY),
         )
     return http_client
 
@@ -140,7 +318,11 @@ def get_webhook_headers() -> dict:
 # =============================================================================
 
 class LLMClient:
-    """Unified LLM client supporting multiple providers."""
+    """Unified LLM client supporting multiple providers.
+
+    Provider errors propagate unchanged; LLMRouter turns them into failover
+    decisions and HTTP errors.
+    """
 
     def __init__(self, provider: str = LLM_PROVIDER):
         self.provider = provider.lower()
@@ -161,7 +343,8 @@ class LLMClient:
         api_key = os.getenv(config["api_key_env"])
         if not api_key:
             raise ValueError(f"{config['api_key_env']} not set")
-        self.client = anthropic.Anthropic(api_key=api_key)
+        import anthropic
+        self.client = anthropic.AsyncAnthropic(api_key=api_key, base_url=os.getenv(config["base_url_env"]))
         self.model = os.getenv(config["model_env"], config["default_model"])
 
     def _init_openai_compatible(self):
@@ -173,66 +356,424 @@ class LLMClient:
         if not api_key:
             raise ValueError(f"{config['api_key_env']} not set")
         
-        self.client = OpenAI(api_key=api_key, base_url=config.get("base_url"))
+        base_url = os.getenv(config["base_url_env"], config.get("base_url"))
+        from openai import AsyncOpenAI
+        self.client = AsyncOpenAI(api_key=api_key, base_url=base_url)
         self.model = os.getenv(config["model_env"], config["default_model"])
+        self.stream_usage = config.get("stream_usage", False)
 
-    def chat(self, messages: List[dict], max_tokens: int = CHAT_MAX_TOKENS,
-             temperature: float = CHAT_TEMPERATURE) -> str:
+    async def chat(self, messages: List[dict], max_tokens: int = CHAT_MAX_TOKENS,
+                   temperature: float = CHAT_TEMPERATURE) -> str:
         """Send chat request and return response text."""
-        try:
-            if self.provider == "anthropic":
-                return self._chat_anthropic(messages, max_tokens, temperature)
-            return self._chat_openai(messages, max_tokens, temperature)
-        except Exception as e:
-            logger.error(f"LLM API error ({self.provider}): {e}")
-            raise HTTPException(status_code=500, detail=f"LLM API error: {e}")
+        if self.provider == "anthropic":
+            return await self._chat_anthropic(messages, max_tokens, temperature)
+        return await self._chat_openai(messages, max_tokens, temperature)
 
-    def _chat_anthropic(self, messages: List[dict], max_tokens: int, temperature: float) -> str:
-        system_msg = next((m["content"] for m in messages if m["role"] == "system"), None)
-        filtered_msgs = [{"role": m["role"], "content": m["content"]} 
+    @staticmethod
+    def _anthropic_messages(messages: List[dict]) -> tuple:
+        """Split out system blocks, with cache_control on those marked "cache".
+
+        Marked blocks end the stable prefix (system prompt, initial content,
+        summary), so Anthropic's prompt cache serves it on later turns.
+        """
+        system = [{"type": "text", "text": m["content"],
+                   **({"cache_control": {"type": "ephemeral"}} if m.get("cache") else {})}
+                  for m in messages if m["role"] == "system"]
+        filtered_msgs = [{"role": m["role"], "content": m["content"]}
                         for m in messages if m["role"] != "system"]
+        from anthropic import NOT_GIVEN
+        return system or NOT_GIVEN, filtered_msgs
+
+    @staticmethod
+    def _openai_messages(messages: List[dict]) -> List[dict]:
+        # OpenAI-compatible APIs cache identical prompt prefixes on their own
+        return [{"role": m["role"], "content": m["content"]} for m in messages]
+
+    async def _chat_anthropic(self, messages: List[dict], max_tokens: int, temperature: float) -> str:
+        system, filtered_msgs = self._anthropic_messages(messages)
         
-        response = self.client.messages.create(
+        response = await self.client.messages.create(
             model=self.model,
             max_tokens=max_tokens,
             temperature=temperature,
-            system=system_msg,
+            system=system,
             messages=filtered_msgs
         )
         return response.content[0].text
 
-    def _chat_openai(self, messages: List[dict], max_tokens: int, temperature: float) -> str:
-        response = self.client.chat.completions.create(
+    async def _chat_openai(self, messages: List[dict], max_tokens: int, temperature: float) -> str:
+        response = await self.client.chat.completions.create(
             model=self.model,
-            messages=messages,
+            messages=self._openai_messages(messages),
             max_tokens=max_tokens,
             temperature=temperature
         )
         return response.choices[0].message.content
 
+    async def stream(self, messages: List[dict], max_tokens: int = CHAT_MAX_TOKENS,
+                     temperature: float = CHAT_TEMPERATURE,
+                     stats: Optional["ChatStreamStats"] = None) -> AsyncIterator[str]:
+        """Yield response text as it is generated, timing it into stats."""
+        stats = stats or ChatStreamStats()
+        if self.provider == "anthropic":
+            deltas = self._stream_anthropic(messages, max_tokens, temperature, stats)
+        else:
+            deltas = self._stream_openai(messages, max_tokens, temperature, stats)
+        async for text in deltas:
+            stats.on_delta()
+            yield text
+        stats.finish()
+
+    async def _stream_anthropic(self, messages: List[dict], max_tokens: int, temperature: float,
+                                stats: "ChatStreamStats") -> AsyncIterator[str]:
+        system, filtered_msgs = self._anthropic_messages(messages)
+        async with self.client.messages.stream(
+            model=self.model,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            system=system,
+            messages=filtered_msgs
+        ) as stream:
+            async for text in stream.text_stream:
+                yield text
+            final = await stream.get_final_message()
+        stats.tokens = final.usage.output_tokens
+
+    async def _stream_openai(self, messages: List[dict], max_tokens: int, temperature: float,
+                             stats: "ChatStreamStats") -> AsyncIterator[str]:
+        response = await self.client.chat.completions.create(
+            model=self.model,
+            messages=self._openai_messages(messages),
+            max_tokens=max_tokens,
+            temperature=temperature,
+            stream=True,
+            **({"stream_options": {"include_usage": True}} if self.stream_usage else {}),
+        )
+        async for chunk in response:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+            # Usage arrives on a final chunk with no choices
+            usage = getattr(chunk, "usage", None)
+            if usage and usage.completion_tokens:
+                stats.tokens = usage.completion_tokens
+
+
+@dataclass
+class ChatStreamStats:
+    """Latency of one streamed completion.
+
+    Tokens are counted as stream deltas unless the provider reports usage.
+    """
+    started: float = field(default_factory=time.monotonic)
+    first_token_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    deltas: int = 0
+    tokens: Optional[int] = None
+
+    def on_delta(self):
+        if self.first_token_at is None:
+            self.first_token_at = time.monotonic()
+        self.deltas += 1
+
+    def finish(self):
+        self.finished_at = time.monotonic()
+
+    def as_dict(self) -> dict:
+        end = self.finished_at or time.monotonic()
+        tokens = self.tokens or self.deltas
+        generating = end - self.first_token_at if self.first_token_at else 0.0
+        return {
+            "ttft_ms": round((self.first_token_at - self.started) * 1000, 1) if self.first_token_at else None,
+            "tokens": tokens,
+            "seconds": round(end - self.started, 3),
+            "tokens_per_sec": round(tokens / generating, 1) if generating > 0 else None,
+        }
+
+
+class ChatMetrics:
+    """Recent streamed chat requests and their latency, reported in /health."""
+
+    def __init__(self, history: int = 200):
+        self.recent: deque = deque(maxlen=history)
+
+    def record(self, job_id: str, stats: ChatStreamStats, mode: str):
+        entry = dict(stats.as_dict(), job_id=job_id, mode=mode)
+        self.recent.append(entry)
+        logger.info(f"[{job_id}] Chat stream ({mode}): ttft={entry['ttft_ms']}ms, "
+                    f"{entry['tokens']} tokens, {entry['tokens_per_sec']} tok/s")
+
+    def stats(self) -> dict:
+        ttfts = [e["ttft_ms"] for e in self.recent if e["ttft_ms"] is not None]
+        rates = [e["tokens_per_sec"] for e in self.recent if e["tokens_per_sec"]]
+        return {
+            "streams": len(self.recent),
+            "avg_ttft_ms": round(sum(ttfts) / len(ttfts), 1) if ttfts else None,
+            "avg_tokens_per_sec": round(sum(rates) / len(rates), 1) if rates else None,
+        }
+
+
+chat_metrics = ChatMetrics()
+
+
+def is_overload_error(error: Exception) -> bool:
+    """429s, 5xx and network failures count against a provider's circuit breaker."""
+    status = getattr(error, "status_code", None)
+    return status is None or status == 429 or status >= 500
+
+
+def is_config_error(error: Exception) -> bool:
+    """Bad key, forbidden or unknown model: retrying won't help until the config changes."""
+    return getattr(error, "status_code", None) in (401, 403, 404)
+
+
+class ProviderStats:
+    """Rolling latency and error history for one provider, plus its circuit breaker.
+
+    After LLM_BREAKER_FAILURES consecutive overload errors the breaker opens
+    for LLM_BREAKER_COOLDOWN seconds; a 401/403/404 opens it at once. Once it
+    expires the provider is tried again, and a single further failure
+    reopens it.
+    """
+
+    def __init__(self):
+        self.samples: deque = deque(maxlen=200)  # (time, seconds) of successful calls
+        self.failure_times: deque = deque(maxlen=200)
+        self.requests = self.failures = 0
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self.hedges_won = 0
+        self.last_error: Optional[str] = None
+
+    def _recent(self) -> List[float]:
+        cutoff = time.monotonic() - LLM_STATS_WINDOW
+        return sorted(seconds for at, seconds in self.samples if at >= cutoff)
+
+    def percentile(self, q: float) -> Optional[float]:
+        recent = self._recent()
+        return recent[min(len(recent) - 1, int(q * len(recent)))] if recent else None
+
+    @property
+    def available(self) -> bool:
+        return time.monotonic() >= self.open_until
+
+    @property
+    def failing(self) -> bool:
+        """Failed recently without a success in the same window."""
+        cutoff = time.monotonic() - LLM_STATS_WINDOW
+        return any(at >= cutoff for at in self.failure_times) and not self._recent()
+
+    def record_success(self, seconds: float):
+        self.requests += 1
+        self.consecutive_failures = 0
+        self.samples.append((time.monotonic(), seconds))
+
+    def record_failure(self, error: Exception) -> bool:
+        """Count a failed call; True if it opened the breaker."""
+        self.requests += 1
+        self.failures += 1
+        self.last_error = f"{type(error).__name__}: {error}"[:200]
+        self.failure_times.append(time.monotonic())
+        if is_config_error(error):
+            self.consecutive_failures = LLM_BREAKER_FAILURES
+        elif not is_overload_error(error):
+            return False
+        else:
+            self.consecutive_failures += 1
+        if self.consecutive_failures >= LLM_BREAKER_FAILURES:
+            self.open_until = time.monotonic() + LLM_BREAKER_COOLDOWN
+            return True
+        return False
+
+    def as_dict(self) -> dict:
+        p50, p95 = self.percentile(0.5), self.percentile(0.95)
+        return {
+            "requests": self.requests,
+            "failures": self.failures,
+            "p50_ms": round(p50 * 1000) if p50 is not None else None,
+            "p95_ms": round(p95 * 1000) if p95 is not None else None,
+            "breaker_open": not self.available,
+            "failing": self.failing,
+            "hedges_won": self.hedges_won,
+            "last_error": self.last_error,
+        }
+
+
+class LLMRouter:
+    """Routes chat requests across LLM providers.
+
+    Each request goes to the healthy provider with the lowest recent median
+    latency. Providers with no recent samples rank first, in the configured
+    order, so every provider gets measured, unless they have only failed
+    lately. A failed call fails over to the next provider. With
+    LLM_HEDGE on, a second provider is also started if the first has not
+    answered within its p95 latency, and the first answer wins.
+    """
+
+    def __init__(self, clients: List[LLMClient]):
+        self.clients = clients
+        self.stats = {c.provider: ProviderStats() for c in clients}
+        self.hedges = 0
+        if len(clients) > 1:
+            # Fail over to another provider rather than let the SDK retry this one
+            for c in clients:
+                c.client = c.client.with_options(max_retries=0)
+
+    @property
+    def provider(self) -> str:
+        return self.ranked()[0].provider
+
+    @property
+    def model(self) -> str:
+        return self.ranked()[0].model
+
+    def ranked(self) -> List[LLMClient]:
+        """Healthy providers fastest first, then recently failing ones, then
+        those with an open breaker as a last resort; ties keep the configured order."""
+        def key(client: LLMClient):
+            stats = self.stats[client.provider]
+            median = stats.percentile(0.5)
+            return (not stats.available, stats.failing, median or 0.0)
+        return sorted(self.clients, key=key)  # stable
+
+    def hedge_delay(self, client: LLMClient) -> float:
+        p95 = self.stats[client.provider].percentile(0.95)
+        delay = p95 if p95 is not None else LLM_HEDGE_DEFAULT_MS / 1000
+        return max(delay, LLM_HEDGE_MIN_MS / 1000)
+
+    def _record_failure(self, client: LLMClient, error: Exception):
+        logger.warning(f"LLM API error ({client.provider}): {error}")
+        if self.stats[client.provider].record_failure(error):
+            logger.warning(f"LLM circuit breaker open for {client.provider} ({LLM_BREAKER_COOLDOWN}s)")
+
+    async def _call(self, client: LLMClient, messages: List[dict], max_tokens: int, temperature: float) -> str:
+        start = time.monotonic()
+        try:
+            text = await client.chat(messages, max_tokens, temperature)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self._record_failure(client, e)
+            raise
+        self.stats[client.provider].record_success(time.monotonic() - start)
+        return text
+
+    async def chat(self, messages: List[dict], max_tokens: int = CHAT_MAX_TOKENS,
+                   temperature: float = CHAT_TEMPERATURE) -> str:
+        """Send chat request and return response text."""
+        candidates = iter(self.ranked())
+        owners: dict = {}
+        errors: List[str] = []
+        hedged = False
+
+        def launch() -> bool:
+            client = next(candidates, None)
+            if client is None:
+                return False
+            task = asyncio.create_task(self._call(client, messages, max_tokens, temperature))
+            owners[task] = client
+            return True
+
+        launch()
+        try:
+            while owners:
+                first = next(iter(owners.values()))
+                timeout = self.hedge_delay(first) if LLM_HEDGE and not hedged and len(owners) == 1 else None
+                done, _ = await asyncio.wait(owners, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    hedged = True
+                    if launch():
+                        self.hedges += 1
+                        logger.info(f"Hedging {first.provider} after {timeout * 1000:.0f}ms")
+                    continue
+                for task in done:
+                    client = owners.pop(task)
+                    if task.exception() is None:
+                        if hedged and client is not first:
+                            self.stats[client.provider].hedges_won += 1
+                        return task.result()
+                    errors.append(f"{client.provider}: {task.exception()}")
+                if not owners:
+                    launch()  # fail over to the next provider
+        finally:
+            for task in owners:
+                task.cancel()
+        raise HTTPException(status_code=500, detail=f"LLM API error: {'; '.join(errors)}")
+
+    async def stream(self, messages: List[dict], max_tokens: int = CHAT_MAX_TOKENS,
+                     temperature: float = CHAT_TEMPERATURE,
+                     stats: Optional[ChatStreamStats] = None) -> AsyncIterator[str]:
+        """Yield response text as it is generated.
+
+        Fails over only until the first delta; a reply is never stitched
+        together from two providers. Streams are not hedged.
+        """
+        errors: List[str] = []
+        for client in self.ranked():
+            start = time.monotonic()
+            started = False
+            try:
+                async for text in client.stream(messages, max_tokens, temperature, stats):
+                    started = True
+                    yield text
+            except Exception as e:
+                self._record_failure(client, e)
+                errors.append(f"{client.provider}: {e}")
+                if started:
+                    break
+                continue
+            self.stats[client.provider].record_success(time.monotonic() - start)
+            return
+        raise HTTPException(status_code=500, detail=f"LLM API error: {'; '.join(errors)}")
+
+    def as_dict(self) -> dict:
+        return {
+            "providers": {name: s.as_dict() for name, s in self.stats.items()},
+            "order": [c.provider for c in self.ranked()],
+            "hedging": LLM_HEDGE,
+            "hedges": self.hedges,
+        }
+
 
 # Initialize clients
-llm_client: Optional[LLMClient] = None
-groq_whisper_client: Optional[Groq] = None
+llm_client: Optional[LLMRouter] = None
+whisper_backend: Optional["WhisperBackend"] = None
 
 def init_llm_client():
     global llm_client
+    names = LLM_PROVIDERS or [LLM_PROVIDER]
+    clients = []
+    for name in dict.fromkeys(names):
+        try:
+            clients.append(LLMClient(name))
+        except Exception as e:
+            logger.warning(f"LLM client init failed ({name}): {e}")
+    if clients:
+        llm_client = LLMRouter(clients)
+
+def init_whisper_client():
+    global whisper_backend
     try:
-        llm_client = LLMClient()
+        if WHISPER_BACKEND == "openai":
+            api_key = os.getenv("WHISPER_API_KEY") or os.getenv("OPENAI_API_KEY") or "unused"
+            from openai import AsyncOpenAI
+            client = AsyncOpenAI(api_key=api_key, base_url=WHISPER_BASE_URL)
+        else:
+            api_key = os.getenv("GROQ_API_KEY")
+            if not api_key:
+                logger.warning("GROQ_API_KEY not set - audio transcription disabled")
+                return
+            from groq import AsyncGroq
+            client = AsyncGroq(api_key=api_key, base_url=WHISPER_BASE_URL)
+        whisper_backend = SDKWhisperBackend(client, WHISPER_BACKEND)
+        logger.info(f"Whisper backend initialized: {WHISPER_BACKEND} ({WHISPER_MODEL})")
     except Exception as e:
-        logger.warning(f"LLM client init failed: {e}")
+        logger.warning(f"Whisper client init failed: {e}")
 
-def init_whisper_client():
-    global groq_whisper_client
-    api_key = os.getenv("GROQ_API_KEY")
-    if api_key:
-        try:
-            groq_whisper_client = Groq(api_key=api_key)
-            logger.info("Groq Whisper client initialized")
-        except Exception as e:
-            logger.warning(f"Whisper client init failed: {e}")
-    else:
-        logger.warning("GROQ_API_KEY not set - audio transcription disabled")
+
+def set_whisper_backend(backend: Optional["WhisperBackend"]):
+    """Swap the transcription backend, e.g. for a local stub in tests."""
+    global whisper_backend
+    whisper_backend = backend
 
 # =============================================================================
 # UTILITY FUNCTIONS
@@ -253,16 +794,69 @@ def read_prompt() -> str:
         return DEFAULT_PROMPT
 
 
+@lru_cache(maxsize=1)
+def read_merge_prompt() -> str:
+    """Read and cache the long-video merge prompt from file."""
+    try:
+        with open(MERGE_PROMPT_FILE_PATH, 'r', encoding='utf-8') as f:
+            return f.read().strip() or DEFAULT_MERGE_PROMPT
+    except FileNotFoundError:
+        return DEFAULT_MERGE_PROMPT
+    except Exception as e:
+        logger.error(f"Error reading merge prompt: {e}")
+        return DEFAULT_MERGE_PROMPT
+
+
+def file_sha256(path: str) -> str:
+    """Hex SHA-256 of a file's contents."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def read_bytes(path: str) -> bytes:
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+@lru_cache(maxsize=1)
 def get_s3_client():
-    """Create S3 client with configured credentials."""
+    """Create (once) the process-wide S3 client, used only to sign requests."""
+    import boto3
     return boto3.client(
         's3',
         aws_access_key_id=AWS_ACCESS_KEY_ID,
         aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-        region_name=AWS_REGION
+        region_name=AWS_REGION,
+        endpoint_url=S3_ENDPOINT_URL,
     )
 
 
+def s3_errors() -> tuple:
+    """botocore's exception types, imported on first use like boto3 itself."""
+    from botocore.exceptions import BotoCoreError, ClientError
+    return BotoCoreError, ClientError
+
+
+def s3_presign(operation: str, bucket: str, key: Optional[str] = None, **params) -> str:
+    """Presigned URL for an S3 operation, so it can be sent on the async HTTP client.
+
+    Signing is local; boto3 itself never touches the network.
+    """
+    params["Bucket"] = bucket
+    if key is not None:
+        params["Key"] = key
+    return get_s3_client().generate_presigned_url(operation, Params=params, ExpiresIn=3600)
+
+
+def parse_s3_list_keys(body: bytes) -> List[str]:
+    """Object keys from a ListObjectsV2 XML response."""
+    root = ElementTree.fromstring(body)
+    return [el.text for el in root.iter() if el.tag.rsplit('}', 1)[-1] == 'Key' and el.text]
+
+
 def parse_s3_path(s3_path: str) -> tuple[str, str]:
     """Parse s3://bucket/key into (bucket, key)."""
     if not s3_path.startswith('s3://'):
@@ -271,36 +865,285 @@ def parse_s3_path(s3_path: str) -> tuple[str, str]:
     return parts[0], parts[1] if len(parts) > 1 else ''
 
 
+def video_identity(url: str) -> str:
+    """The object a URL points at: s3://bucket/key for S3 paths and presigned
+    S3 URLs (whose signatures differ on every presign), else the URL itself."""
+    if url.startswith('s3://'):
+        return url
+    parts = urlsplit(url)
+    query = parse_qs(parts.query)
+    if not ({'X-Amz-Signature', 'Signature'} & query.keys()):
+        return url
+    host = parts.hostname or ''
+    path = unquote(parts.path.lstrip('/'))
+    endpoint_host = urlsplit(S3_ENDPOINT_URL).hostname if S3_ENDPOINT_URL else None
+    if host == endpoint_host or host.startswith(('s3.', 's3-')):
+        return f"s3://{path}"  # path-style: bucket is the first path segment
+    match = re.match(r'(.+?)\.s3[.-]', host)
+    if match:
+        return f"s3://{match.group(1)}/{path}"  # virtual-hosted style
+    return f"{parts.scheme}://{parts.netloc}{parts.path}"
+
+
+# =============================================================================
+# DISK CACHE
+# =============================================================================
+
+class DiskCache:
+    """Size-bounded on-disk LRU of JSON values, one file per key.
+
+    File mtimes record recency, so LRU order survives restarts. The
+    directory is created and indexed on open() or first use, not on import.
+    """
+
+    def __init__(self, label: str, directory: str, max_bytes: int):
+        self.label = label
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = self.misses = self.evictions = 0
+        self._index: "OrderedDict[str, int]" = OrderedDict()  # key -> size, oldest first
+        self._lock = threading.Lock()
+        self._loaded = False
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def open(self):
+        """Create and index the cache directory; later calls are no-ops."""
+        with self._lock:
+            self._ensure_loaded()
+
+    def _ensure_loaded(self):
+        if self.enabled and not self._loaded:
+            self._loaded = True
+            try:
+                self._load()
+            except OSError as e:
+                # Runs on first use, so it must not fail the request; writes will log their own errors
+                logger.warning(f"{self.label} cache unavailable in {self.directory}: {e}")
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def _load(self):
+        os.makedirs(self.directory, exist_ok=True)
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.json'):
+                st = os.stat(os.path.join(self.directory, name))
+                entries.append((st.st_mtime, name[:-5], st.st_size))
+        for _, key, size in sorted(entries):
+            self._index[key] = size
+        logger.info(f"{self.label} cache: {len(self._index)} entries in {self.directory}")
+
+    def get(self, key: str):
+        with self._lock:
+            self._ensure_loaded()
+            if key not in self._index:
+                self.misses += 1
+                return None
+            try:
+                with open(self._path(key), 'r', encoding='utf-8') as f:
+                    value = json.load(f)["value"]
+                os.utime(self._path(key))
+            except (OSError, ValueError, KeyError) as e:
+                logger.warning(f"Dropping unreadable cache entry {key}: {e}")
+                self._index.pop(key, None)
+                self.misses += 1
+                return None
+            self._index.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: str, value):
+        data = json.dumps({"value": value, "created_at": time.time()})
+        with self._lock:
+            self._ensure_loaded()
+            tmp_path = self._path(key) + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(data)
+            os.replace(tmp_path, self._path(key))
+            self._index[key] = len(data.encode())
+            self._index.move_to_end(key)
+            self._evict()
+
+    def _evict(self):
+        total = sum(self._index.values())
+        while total > self.max_bytes and len(self._index) > 1:
+            key, size = self._index.popitem(last=False)
+            cleanup_file(self._path(key))
+            total -= size
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "entries": len(self._index),
+            "bytes": sum(self._index.values()),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
 # =============================================================================
 # FILE OPERATIONS
 # =============================================================================
 
-def download_file(source_url: str, local_path: str):
-    """Download file from S3 or presigned URL."""
+class DownloadMetrics:
+    """Process-wide download throughput counters, reported in /health."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._by_mode: dict = {}
+
+    def record(self, mode: str, nbytes: int, seconds: float):
+        with self._lock:
+            m = self._by_mode.setdefault(mode, {"count": 0, "bytes": 0, "seconds": 0.0})
+            m["count"] += 1
+            m["bytes"] += nbytes
+            m["seconds"] += seconds
+
+    def stats(self) -> dict:
+        with self._lock:
+            by_mode = {mode: dict(m, avg_mbps=round(m["bytes"] / MB / m["seconds"], 2) if m["seconds"] else 0.0)
+                       for mode, m in self._by_mode.items()}
+        return by_mode
+
+
+download_metrics = DownloadMetrics()
+
+
+async def download_http_ranged(url: str, local_path: str, size: int, offset: int = 0) -> int:
+    """Fetch byte ranges concurrently, pwrite-ing each into a preallocated file.
+
+    Bytes before `offset` are already in the file and kept. Returns the
+    number of parts.
+    """
+    client = get_http_client()
+    part_size = DOWNLOAD_PART_MB * MB
+    ranges = [(start, min(start + part_size, size) - 1) for start in range(offset, size, part_size)]
+    limit = asyncio.Semaphore(DOWNLOAD_CONCURRENCY)
+    
+    async def fetch(start: int, end: int):
+        offset = start
+        async with limit, client.stream('GET', url, headers={'Range': f'bytes={start}-{end}'}) as response:
+            response.raise_for_status()
+            if response.status_code != 206:
+                raise OSError(f"Range bytes={start}-{end} not honoured ({response.status_code})")
+            async for chunk in response.aiter_bytes(chunk_size=MB):
+                os.pwrite(fd, chunk, offset)
+                offset += len(chunk)
+        if offset != end + 1:
+            raise OSError(f"Short read for bytes={start}-{end}: got {offset - start}")
+    
+    fd = os.open(local_path, os.O_WRONLY | os.O_CREAT | (0 if offset else os.O_TRUNC), 0o644)
+    tasks = [asyncio.create_task(fetch(start, end)) for start, end in ranges]
+    try:
+        os.ftruncate(fd, size)
+        await asyncio.gather(*tasks)
+    finally:
+        # One failed part must not leave the others writing to a closed fd
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        os.close(fd)
+    return len(ranges)
+
+
+async def download_http_stream(url: str, local_path: str, offset: int = 0) -> tuple[int, Optional[int]]:
+    """Stream a URL to disk over a single connection, from `offset` on.
+
+    Returns (bytes written, total size), the total only if the server
+    answered with a byte range. From offset 0 the request still asks for
+    the first DOWNLOAD_PART_MB only, so it doubles as the probe for ranged
+    downloads; a server that ignores Range sends the whole file instead.
+    """
+    if offset:
+        headers = {'Range': f'bytes={offset}-'}
+    else:
+        headers = {'Range': f'bytes=0-{DOWNLOAD_PART_MB * MB - 1}'} if DOWNLOAD_CONCURRENCY > 1 else {}
+    async with get_http_client().stream('GET', url, headers=headers) as response:
+        response.raise_for_status()
+        if offset and response.status_code != 206:
+            raise OSError(f"Range bytes={offset}- not honoured ({response.status_code})")
+        written = 0
+        with open(local_path, 'ab' if offset else 'wb') as f:
+            async for chunk in response.aiter_bytes(chunk_size=MB):
+                f.write(chunk)
+                written += len(chunk)
+    total = response.headers.get('content-range', '').rpartition('/')[2] if response.status_code == 206 else ''
+    return written, int(total) if total.isdigit() else None
+
+
+async def download_http(url: str, local_path: str) -> tuple[str, int]:
+    """Download a URL; returns (mode, parts).
+
+    The first part is fetched on its own and tells us the size. Files of
+    at least DOWNLOAD_PARALLEL_MIN_MB get the rest as concurrent Range
+    requests; smaller ones, one more request for the remainder.
+    """
+    written, size = await download_http_stream(url, local_path)
+    if size is None or written >= size:
+        return "stream", 1
+    if size >= DOWNLOAD_PARALLEL_MIN_MB * MB:
+        return "ranged", 1 + await download_http_ranged(url, local_path, size, offset=written)
+    more, _ = await download_http_stream(url, local_path, offset=written)
+    if written + more != size:
+        raise OSError(f"Short read: got {written + more} of {size} bytes")
+    return "stream", 2
+
+
+async def download_file(source_url: str, local_path: str, stats: Optional[dict] = None):
+    """Download file from S3 or presigned URL.
+
+    s3:// objects are presigned and fetched like any other URL. Large
+    objects are fetched as concurrent Range requests.
+    """
+    start = time.monotonic()
     try:
-        if source_url.startswith(('http://', 'https://')):
-            # Presigned URL - use streaming download
-            client = get_http_client()
-            with client.stream('GET', source_url) as response:
-                response.raise_for_status()
-                with open(local_path, 'wb') as f:
-                    for chunk in response.iter_bytes(chunk_size=8192):
-                        f.write(chunk)
-        elif source_url.startswith('s3://'):
-            bucket, key = parse_s3_path(source_url)
-            get_s3_client().download_file(bucket, key, local_path)
+        if source_url.startswith('s3://'):
+            url = s3_presign('get_object', *parse_s3_path(source_url))
+        elif source_url.startswith(('http://', 'https://')):
+            url = source_url
         else:
             raise ValueError("URL must be s3:// or http(s)://")
-        
-        logger.info(f"Downloaded: {local_path}")
-    except (httpx.HTTPError, ClientError) as e:
-        logger.error(f"Download failed: {e}")
-        raise HTTPException(status_code=400, detail=f"Download failed: {e}")
+        mode, parts = await download_http(url, local_path)
+        if source_url.startswith('s3://'):
+            mode = f"s3-{mode}"
+    except (httpx.HTTPError, OSError, *s3_errors()) as e:
+        # Status errors quote the URL, which for S3 carries a signature
+        reason = f"HTTP {e.response.status_code}" if isinstance(e, httpx.HTTPStatusError) else e
+        logger.error(f"Download failed for {source_url}: {reason}")
+        raise HTTPException(status_code=400, detail=f"Download failed: {reason}")
+    
+    elapsed = time.monotonic() - start
+    nbytes = os.path.getsize(local_path)
+    mbps = nbytes / MB / elapsed if elapsed else 0.0
+    download_metrics.record(mode, nbytes, elapsed)
+    logger.info(f"Downloaded: {local_path} ({nbytes / MB:.1f} MB in {elapsed:.2f}s, "
+                f"{mbps:.1f} MB/s, {mode}, {parts} part(s))")
+    if stats is not None:
+        stats["download"] = {"mode": mode, "bytes": nbytes, "parts": parts,
+                             "seconds": round(elapsed, 3), "mbps": round(mbps, 2)}
+
 
+async def get_s3_etag(s3_path: str) -> Optional[str]:
+    """ETag of an S3 object, or None if it can't be read."""
+    try:
+        response = await get_http_client().head(s3_presign('head_object', *parse_s3_path(s3_path)))
+        response.raise_for_status()
+        return response.headers["etag"].strip('"')
+    except Exception as e:
+        logger.warning(f"S3 HEAD failed for {s3_path}: {e}")
+        return None
 
-def run_ffmpeg(args: List[str], timeout: int = 300) -> bool:
+
+def run_ffmpeg(args: List[str], timeout: int = FFMPEG_TIMEOUT) -> bool:
     """Run ffmpeg command with error handling."""
-    import subprocess
     try:
         subprocess.run(
             ['ffmpeg'] + args,
@@ -321,118 +1164,755 @@ def run_ffmpeg(args: List[str], timeout: int = 300) -> bool:
         return False
 
 
-def preprocess_video(video_path: str) -> str:
-    """Preprocess video for consistent format. Returns path to use."""
-    output_path = video_path.rsplit('.', 1)[0] + '_preprocessed.mp4'
+async def run_process(cmd: List[str], timeout: int = FFMPEG_TIMEOUT) -> Optional[tuple[int, str]]:
+    """Run a command as an asyncio subprocess; (returncode, stderr), or None if it never finished."""
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            *cmd, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE)
+    except FileNotFoundError:
+        logger.error(f"{cmd[0]} not found")
+        return None
+    try:
+        _, stderr = await asyncio.wait_for(proc.communicate(), timeout)
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
+        logger.error(f"{cmd[0]} timed out")
+        return None
+    return proc.returncode, stderr.decode(errors='replace')
+
+
+async def run_ffmpeg_async(args: List[str], timeout: int = FFMPEG_TIMEOUT) -> bool:
+    """run_ffmpeg without tying up a thread while ffmpeg runs."""
+    result = await run_process(['ffmpeg'] + args, timeout)
+    if result is None:
+        return False
+    returncode, stderr = result
+    if returncode != 0:
+        logger.error(f"ffmpeg error: {stderr}")
+        return False
+    return True
+
+
+def run_ffmpeg_pipe(args: List[str], into: memoryview, timeout: int = FFMPEG_TIMEOUT) -> Optional[int]:
+    """Run ffmpeg reading stdout into a buffer. Returns bytes read, or None on failure."""
+    try:
+        proc = subprocess.Popen(['ffmpeg'] + args, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    except FileNotFoundError:
+        logger.error("ffmpeg not found")
+        return None
     
-    args = [
-        '-i', video_path,
-        '-c:v', 'libx264', '-preset', 'fast', '-crf', '23',
-        '-vf', 'scale=trunc(iw/2)*2:trunc(ih/2)*2',
-        '-r', '30', '-pix_fmt', 'yuv420p',
-        '-movflags', '+faststart', '-y', output_path
-    ]
+    timer = threading.Timer(timeout, proc.kill)
+    timer.start()
+    filled = 0
+    try:
+        while filled < len(into):
+            n = proc.stdout.readinto(into[filled:])
+            if not n:
+                break
+            filled += n
+        # Keep draining so other outputs (e.g. demuxed audio) can finish
+        while proc.stdout.read(1024 * 1024):
+            pass
+    finally:
+        timer.cancel()
+        proc.stdout.close()
+        proc.wait()
     
-    if run_ffmpeg(args) and os.path.exists(output_path) and os.path.getsize(output_path) > 0:
-        return output_path
-    return video_path
+    if proc.returncode != 0:
+        logger.error(f"ffmpeg pipe exited with {proc.returncode}")
+        return None
+    return filled
 
 
-def extract_audio(video_path: str) -> Optional[str]:
-    """Extract audio from video file."""
-    output_path = video_path.rsplit('.', 1)[0] + f'_extracted.{AUDIO_EXTRACT_FORMAT}'
-    
+def audio_output_args(output_path: str) -> List[str]:
+    """ffmpeg output options for the extracted audio track."""
     codec = 'libmp3lame' if AUDIO_EXTRACT_FORMAT == 'mp3' else 'copy'
-    args = [
-        '-i', video_path, '-vn',
-        '-acodec', codec, '-ab', AUDIO_EXTRACT_BITRATE,
-        '-ar', '44100', '-y', output_path
-    ]
-    
-    if run_ffmpeg(args) and os.path.exists(output_path) and os.path.getsize(output_path) > 0:
-        return output_path
-    return None
+    return ['-map', '0:a:0', '-vn', '-acodec', codec, '-ab', AUDIO_EXTRACT_BITRATE,
+            '-ar', '44100', '-y', output_path]
 
 
-def find_s3_audio(video_s3_path: str, local_dir: str) -> Optional[str]:
-    """Try to find and download corresponding audio file from S3."""
-    s3_dir = os.path.dirname(video_s3_path)
-    basename = os.path.splitext(os.path.basename(video_s3_path))[0]
-    
-    for ext in AUDIO_EXTENSIONS:
-        audio_s3_path = f"{s3_dir}/{basename}{ext}"
-        local_path = os.path.join(local_dir, f"{basename}{ext}")
-        try:
-            bucket, key = parse_s3_path(audio_s3_path)
-            get_s3_client().download_file(bucket, key, local_path)
-            logger.info(f"Found S3 audio: {audio_s3_path}")
-            return local_path
-        except Exception:
-            continue
-    return None
+def extracted_audio_path(video_path: str) -> str:
+    return video_path.rsplit('.', 1)[0] + f'_extracted.{AUDIO_EXTRACT_FORMAT}'
 
 
-def get_audio_for_video(video_path: str, video_s3_path: str) -> Optional[str]:
-    """Get audio based on configured mode."""
-    local_dir = os.path.dirname(video_path)
-    
-    if AUDIO_SOURCE_MODE == "separate":
-        return find_s3_audio(video_s3_path, local_dir)
-    elif AUDIO_SOURCE_MODE == "extract":
-        return extract_audio(video_path)
-    elif AUDIO_SOURCE_MODE == "both":
-        audio = find_s3_audio(video_s3_path, local_dir)
-        return audio if audio else extract_audio(video_path)
-    return None
+def has_output(path: Optional[str]) -> bool:
+    return bool(path) and os.path.exists(path) and os.path.getsize(path) > 0
 
 
-# =============================================================================
-# AUDIO TRANSCRIPTION
-# =============================================================================
+@dataclass
+class VideoProbe:
+    """Stream and container metadata from ffprobe."""
+    codec: str
+    pix_fmt: str
+    width: int
+    height: int
+    fps: float
+    duration: float
+    format_name: str
+    has_audio: bool
 
-def transcribe_audio(audio_path: str) -> Optional[str]:
-    """Transcribe audio using Groq Whisper."""
-    if not groq_whisper_client:
+
+def parse_rate(rate: Optional[str]) -> float:
+    """Parse an ffprobe frame rate such as '30000/1001'."""
+    try:
+        num, _, den = (rate or '').partition('/')
+        return float(num) / float(den or 1)
+    except (ValueError, ZeroDivisionError):
+        return 0.0
+
+
+def probe_video(video_path: str) -> Optional[VideoProbe]:
+    """Read the first video stream's metadata, or None if ffprobe fails."""
+    try:
+        result = subprocess.run(
+            ['ffprobe', '-v', 'error', '-print_format', 'json',
+             '-show_streams', '-show_format', video_path],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            timeout=60,
+            check=True
+        )
+        info = json.loads(result.stdout)
+    except (FileNotFoundError, subprocess.SubprocessError, ValueError) as e:
+        logger.warning(f"ffprobe failed for {video_path}: {e}")
         return None
     
-    try:
-        logger.info(f"Transcribing: {audio_path}")
-        with open(audio_path, "rb") as f:
-            result = groq_whisper_client.audio.transcriptions.create(
-                file=(os.path.basename(audio_path), f.read()),
-                model=WHISPER_MODEL,
-                temperature=0,
-                response_format="verbose_json",
-            )
-        text = getattr(result, 'text', str(result))
-        logger.info(f"Transcription: {len(text)} chars")
-        return text
-    except Exception as e:
-        logger.error(f"Transcription error: {e}")
+    streams = info.get('streams', [])
+    video = next((st for st in streams if st.get('codec_type') == 'video'), None)
+    if not video:
         return None
+    fmt = info.get('format', {})
+    return VideoProbe(
+        codec=video.get('codec_name', ''),
+        pix_fmt=video.get('pix_fmt', ''),
+        width=int(video.get('width', 0)),
+        height=int(video.get('height', 0)),
+        fps=parse_rate(video.get('avg_frame_rate')) or parse_rate(video.get('r_frame_rate')),
+        duration=float(fmt.get('duration') or video.get('duration') or 0),
+        format_name=fmt.get('format_name', ''),
+        has_audio=any(st.get('codec_type') == 'audio' for st in streams),
+    )
 
 
-# =============================================================================
-# MODEL FUNCTIONS
-# =============================================================================
+def fit_dimensions(width: int, height: int, max_pixels: int) -> tuple[int, int]:
+    """Scale down to at most max_pixels, keeping aspect ratio and even sides."""
+    scale = min(1.0, (max_pixels / (width * height)) ** 0.5) if width and height else 1.0
+    return max(2, int(width * scale) // 2 * 2), max(2, int(height * scale) // 2 * 2)
 
-def build_bnb_config(quant: str):
-    """Build quantization config."""
-    if quant == "8-bit":
-        return BitsAndBytesConfig(load_in_8bit=True)
-    if quant == "4-bit":
-        return BitsAndBytesConfig(load_in_4bit=True, bnb_4bit_compute_dtype=torch.float16)
-    return None
 
+def choose_preprocess_path(probe: Optional[VideoProbe]) -> str:
+    """Pick "passthrough", "remux", "reencode" or (without a probe) "legacy"."""
+    if probe is None:
+        return "legacy"
+    decodable = (probe.codec == 'h264' and probe.pix_fmt == 'yuv420p'
+                 and probe.width % 2 == 0 and probe.height % 2 == 0)
+    if not decodable:
+        return "reencode"
+    if 'mp4' in probe.format_name or 'mov' in probe.format_name:
+        return "passthrough"
+    return "remux"
 
-def pick_model_class(model_id: str):
-    """Select model class based on model ID."""
-    from transformers import AutoModelForVision2Seq
-    try:
-        if "Qwen3-VL" in model_id:
-            from transformers import Qwen3VLForConditionalGeneration
-            return Qwen3VLForConditionalGeneration
-        if "Qwen2.5-VL" in model_id or "Qwen2_5-VL" in model_id:
+
+def preprocess_video(video_path: str, stats: Optional[dict] = None,
+                     probe: Optional[VideoProbe] = None, plan: Optional["SamplingPlan"] = None,
+                     audio_path: Optional[str] = None) -> str:
+    """Preprocess video for consistent format. Returns path to use.
+
+    ffprobe decides between using the file as-is, remuxing it into mp4, or
+    re-encoding at the fps and frame size of the sampling plan. If
+    audio_path is given, the audio track is written there by the same ffmpeg
+    process; if that run fails, the video is retried without the audio.
+    """
+    start = time.monotonic()
+    output_path = video_path.rsplit('.', 1)[0] + '_preprocessed.mp4'
+    probe = probe or probe_video(video_path)
+    plan = plan or plan_sampling(probe)
+    path = choose_preprocess_path(probe)
+    
+    if path == "passthrough":
+        args = None
+    elif path == "remux":
+        args = ['-i', video_path, '-map', '0:v:0', '-c', 'copy',
+                '-movflags', '+faststart', '-y', output_path]
+    elif path == "reencode":
+        width, height = fit_dimensions(probe.width, probe.height, plan.max_pixels)
+        fps = min(plan.fps, probe.fps) if probe.fps else plan.fps
+        args = [
+            '-i', video_path, '-an',
+            '-vf', f'fps={fps},scale={width}:{height}',
+            '-c:v', 'libx264', '-preset', 'veryfast', '-crf', '23',
+            '-pix_fmt', 'yuv420p', '-movflags', '+faststart', '-y', output_path
+        ]
+    else:
+        args = [
+            '-i', video_path,
+            '-c:v', 'libx264', '-preset', 'fast', '-crf', '23',
+            '-vf', 'scale=trunc(iw/2)*2:trunc(ih/2)*2',
+            '-r', '30', '-pix_fmt', 'yuv420p',
+            '-movflags', '+faststart', '-y', output_path
+        ]
+    
+    result = video_path
+    if args is None:
+        if audio_path:
+            run_ffmpeg(['-i', video_path] + audio_output_args(audio_path))
+    else:
+        ok = run_ffmpeg(args + audio_output_args(audio_path) if audio_path else args) and has_output(output_path)
+        if not ok and audio_path:
+            logger.warning(f"Preprocess with audio failed for {video_path}; retrying without audio")
+            cleanup_file(audio_path)
+            ok = run_ffmpeg(args) and has_output(output_path)
+        if ok:
+            result = output_path
+        else:
+            path = f"{path}-failed"
+    
+    elapsed = time.monotonic() - start
+    logger.info(f"Preprocess {os.path.basename(video_path)}: {path} in {elapsed:.2f}s")
+    if stats is not None:
+        stats["preprocess"] = {"path": path, "seconds": round(elapsed, 3)}
+    return result
+
+
+async def extract_audio(video_path: str) -> Optional[str]:
+    """Extract audio from video file."""
+    output_path = extracted_audio_path(video_path)
+    
+    if await run_ffmpeg_async(['-i', video_path] + audio_output_args(output_path)) and has_output(output_path):
+        return output_path
+    return None
+
+
+# S3 prefix -> expiry of a cached "no audio here"; one TTL, so insertion order is expiry order
+_audio_misses: "OrderedDict[tuple, float]" = OrderedDict()
+_audio_misses_lock = threading.Lock()
+
+
+async def find_s3_audio(video_s3_path: str, local_dir: str) -> Optional[str]:
+    """Find and download the audio file stored next to an S3 video.
+
+    One ListObjectsV2 call on "<dir>/<basename>." finds every candidate; the
+    first extension in AUDIO_EXTENSIONS wins. Prefixes with no audio are
+    remembered for AUDIO_LOOKUP_NEGATIVE_TTL seconds.
+    """
+    if not video_s3_path.startswith('s3://'):
+        return None
+    bucket, video_key = parse_s3_path(video_s3_path)
+    prefix = os.path.splitext(video_key)[0] + '.'
+    
+    with _audio_misses_lock:
+        if _audio_misses.get((bucket, prefix), 0) > time.monotonic():
+            return None
+    
+    try:
+        response = await get_http_client().get(
+            s3_presign('list_objects_v2', bucket, Prefix=prefix, MaxKeys=100))
+        response.raise_for_status()
+        keys = set(parse_s3_list_keys(response.content)) - {video_key}
+    except (httpx.HTTPError, ElementTree.ParseError, *s3_errors()) as e:
+        logger.warning(f"S3 audio lookup failed for {video_s3_path}: {e}")
+        return None
+    audio_key = next((prefix + ext[1:] for ext in AUDIO_EXTENSIONS if prefix + ext[1:] in keys), None)
+    
+    if not audio_key:
+        now = time.monotonic()
+        with _audio_misses_lock:
+            while _audio_misses and next(iter(_audio_misses.values())) <= now:
+                _audio_misses.popitem(last=False)
+            _audio_misses[(bucket, prefix)] = now + AUDIO_LOOKUP_NEGATIVE_TTL
+            _audio_misses.move_to_end((bucket, prefix))
+        return None
+    
+    ext = os.path.splitext(audio_key)[1]
+    with tempfile.NamedTemporaryFile(delete=False, suffix=ext, dir=local_dir) as f:
+        local_path = f.name
+    try:
+        await download_file(f"s3://{bucket}/{audio_key}", local_path)
+    except HTTPException:
+        cleanup_file(local_path)
+        return None
+    logger.info(f"Found S3 audio: s3://{bucket}/{audio_key}")
+    return local_path
+
+
+async def get_audio_for_video(video_path: str, video_s3_path: str,
+                              extracted: Optional[str] = None,
+                              s3_audio: Optional[asyncio.Task] = None) -> Optional[str]:
+    """Get audio based on configured mode.
+
+    `extracted` is audio already demuxed alongside the video decode, and
+    `s3_audio` a find_s3_audio lookup started alongside the video download;
+    each is used instead of repeating that work.
+    """
+    local_dir = os.path.dirname(video_path)
+    
+    async def separate_audio() -> Optional[str]:
+        return await (s3_audio or find_s3_audio(video_s3_path, local_dir))
+    
+    if AUDIO_SOURCE_MODE == "separate":
+        return await separate_audio()
+    elif AUDIO_SOURCE_MODE == "extract":
+        return extracted or await extract_audio(video_path)
+    elif AUDIO_SOURCE_MODE == "both":
+        return await separate_audio() or extracted or await extract_audio(video_path)
+    return None
+
+
+# =============================================================================
+# FRAME SAMPLING
+# =============================================================================
+
+# Visual-token budget, sampling fps and max pixels per frame for each mode
+RESOLUTION_PRESETS = {
+    "low": (4096, 1.0, 256 * 28 * 28),
+    "auto": (16384, 2.0, 768 * 28 * 28),
+    "high": (32768, 2.0, 768 * 28 * 28),
+}
+PIXELS_PER_TOKEN = 28 * 28  # one token per 28x28 patch...
+FRAMES_PER_TOKEN = 2        # ...spanning two frames
+MIN_FRAMES = 4
+MAX_FRAMES = 768
+
+
+@dataclass
+class SamplingPlan:
+    """Per-video frame and pixel limits passed to qwen_vl_utils."""
+    fps: float
+    max_frames: int
+    max_pixels: int
+    min_pixels: int
+    visual_tokens: int
+
+    def video_options(self) -> dict:
+        return {
+            "fps": self.fps,
+            "min_frames": MIN_FRAMES,
+            "max_frames": self.max_frames,
+            "max_pixels": self.max_pixels,
+            "min_pixels": self.min_pixels,
+        }
+
+
+@lru_cache(maxsize=8)
+def parse_resolution_mode(mode: str) -> tuple[int, float, int]:
+    """Resolve a RESOLUTION_MODE string to (token budget, fps, max pixels)."""
+    mode = mode.strip().lower()
+    if mode in RESOLUTION_PRESETS:
+        return RESOLUTION_PRESETS[mode]
+    if mode.startswith("budget:"):
+        try:
+            _, fps, max_pixels = RESOLUTION_PRESETS["auto"]
+            return max(int(mode[7:]), 1), fps, max_pixels
+        except ValueError:
+            pass
+    logger.warning(f"Unknown RESOLUTION_MODE {mode!r}, using auto")
+    return RESOLUTION_PRESETS["auto"]
+
+
+def plan_sampling(probe: Optional[VideoProbe], mode: str = RESOLUTION_MODE) -> SamplingPlan:
+    """Choose fps, frame count and frame size that fit the mode's token budget.
+
+    Frame size shrinks first as clips get longer; once it reaches
+    RESOLUTION_MIN_PIXELS, frames are dropped (lower fps) instead.
+    """
+    budget, fps, max_pixels = parse_resolution_mode(mode)
+    budget_pixels = budget * FRAMES_PER_TOKEN * PIXELS_PER_TOKEN  # pixel area summed over all frames
+    source_pixels = probe.width * probe.height if probe and probe.width and probe.height else max_pixels
+    duration = probe.duration if probe and probe.duration > 0 else None
+    
+    if duration:
+        frames = int(min(max(duration * fps, MIN_FRAMES), MAX_FRAMES)) // 2 * 2
+    else:
+        frames = max(MIN_FRAMES, budget_pixels // max_pixels // 2 * 2)
+    pixels = int(min(source_pixels, max_pixels, budget_pixels / frames))
+    
+    if pixels < RESOLUTION_MIN_PIXELS:
+        pixels = min(RESOLUTION_MIN_PIXELS, source_pixels)
+        frames = max(MIN_FRAMES, min(int(budget_pixels / pixels), MAX_FRAMES) // 2 * 2)
+    if duration:
+        # Don't decode (or re-encode) more frames than will be kept
+        fps = min(fps, max(frames, MIN_FRAMES) / duration)
+    
+    return SamplingPlan(
+        fps=round(fps, 4),
+        max_frames=frames,
+        max_pixels=pixels,
+        min_pixels=min(pixels, RESOLUTION_MIN_PIXELS),
+        visual_tokens=frames // FRAMES_PER_TOKEN * pixels // PIXELS_PER_TOKEN,
+    )
+
+
+def read_scene_scores(path: str) -> List[float]:
+    """Per-frame lavfi.scene_score values from ffmpeg's metadata=print output."""
+    scores = []
+    try:
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                if line.startswith("lavfi.scene_score="):
+                    scores.append(float(line.split("=", 1)[1]))
+    except (OSError, ValueError) as e:
+        logger.warning(f"Could not read scene scores: {e}")
+    return scores
+
+
+def frame_dhash(frame) -> int:
+    """64-bit difference hash of an (H, W, 3) uint8 frame."""
+    import numpy as np
+    height, width = frame.shape[0] // 8 * 8, frame.shape[1] // 9 * 9
+    gray = frame[:height, :width].mean(axis=2)
+    small = gray.reshape(8, height // 8, 9, width // 9).mean(axis=(1, 3))
+    return int.from_bytes(np.packbits(small[:, 1:] > small[:, :-1]).tobytes(), 'big')
+
+
+def select_frames(frames, scene_scores: Optional[List[float]], mode: str = FRAME_SELECT) -> List[int]:
+    """Indices of frames that change the content, in order.
+
+    "scene" keeps frames whose ffmpeg scene score (difference from the
+    previous sampled frame) exceeds SCENE_THRESHOLD; "phash" drops frames
+    whose dHash is within PHASH_DISTANCE bits of the last kept frame. The
+    first frame is always kept, and evenly spaced frames are added back
+    when fewer than SELECT_MIN_FRAMES survive.
+    """
+    count = len(frames)
+    keep = list(range(count))
+    if "scene" in mode and scene_scores:
+        keep = [i for i in keep if i == 0 or (i < len(scene_scores) and scene_scores[i] > SCENE_THRESHOLD)]
+    if "phash" in mode:
+        deduped, last = [], None
+        for i in keep:
+            digest = frame_dhash(frames[i])
+            if last is None or (digest ^ last).bit_count() > PHASH_DISTANCE:
+                deduped.append(i)
+                last = digest
+        keep = deduped
+    minimum = min(count, max(SELECT_MIN_FRAMES, MIN_FRAMES))
+    if len(keep) < minimum:
+        step = (count - 1) / max(1, minimum - 1)
+        keep = sorted(set(keep) | {round(i * step) for i in range(minimum)})
+    return keep
+
+
+def decode_frames(video_path: str, probe: Optional[VideoProbe], plan: SamplingPlan,
+                  stats: Optional[dict] = None,
+                  audio_path: Optional[str] = None) -> Optional[tuple["torch.Tensor", List[int]]]:
+    """Decode sampled, resized RGB frames from an ffmpeg rawvideo pipe.
+
+    Frames are read into one preallocated uint8 buffer and returned as a
+    (T, C, H, W) tensor already sized for the processor, along with each
+    frame's index on the plan.fps grid (its timestamp times plan.fps).
+    With FRAME_SELECT other than "uniform", near-duplicate frames are
+    dropped. If audio_path is given, the same ffmpeg process also writes
+    the audio track there; if that run fails, the frames are decoded again
+    without it. Returns None when the pipe path can't be used, so the
+    caller falls back to the file path.
+    """
+    if not (probe and probe.width and probe.height and probe.duration):
+        return None
+    import numpy as np
+    import torch
+    from qwen_vl_utils import smart_resize
+    
+    start = time.monotonic()
+    height, width = smart_resize(probe.height, probe.width, factor=28,
+                                 min_pixels=plan.min_pixels, max_pixels=plan.max_pixels)
+    nframes = min(plan.max_frames, max(MIN_FRAMES, math.ceil(probe.duration * plan.fps)))
+    nframes += nframes % 2
+    frame_bytes = height * width * 3
+    buffer = np.empty((nframes, height, width, 3), dtype=np.uint8)
+    
+    video_filter = f'fps={plan.fps},scale={width}:{height}:flags=bicubic'
+    scores_path = None
+    if "scene" in FRAME_SELECT:
+        # Score every sampled frame against the previous one; selection happens below
+        scores_path = video_path.rsplit('.', 1)[0] + '_scene.txt'
+        video_filter += f',select=gte(scene\\,0),metadata=mode=print:key=lavfi.scene_score:file={scores_path}'
+    args = [
+        '-v', 'error', '-i', video_path, '-map', '0:v:0', '-an',
+        '-vf', video_filter,
+        '-frames:v', str(nframes), '-pix_fmt', 'rgb24', '-f', 'rawvideo', 'pipe:1'
+    ]
+    if audio_path:
+        args += audio_output_args(audio_path)
+    filled = run_ffmpeg_pipe(args, memoryview(buffer).cast('B'))
+    scene_scores = None
+    if scores_path:
+        scene_scores = read_scene_scores(scores_path)
+        cleanup_file(scores_path)
+    
+    count = (filled or 0) // frame_bytes
+    if count < 2 and audio_path:
+        logger.warning(f"Frame pipe with audio failed for {video_path}; retrying without audio")
+        cleanup_file(audio_path)
+        return decode_frames(video_path, probe, plan, stats)
+    if count < 2:
+        logger.warning(f"Frame pipe failed for {video_path} (frames={count})")
+        return None
+    indices = list(range(count))
+    if FRAME_SELECT != "uniform":
+        indices = select_frames(buffer[:count], scene_scores, FRAME_SELECT)
+        if len(indices) < count:
+            buffer[:len(indices)] = buffer[indices]
+    sampled, kept = count, len(indices)
+    # The model consumes frames in pairs; repeat the last one if needed
+    if kept % 2:
+        buffer[kept] = buffer[kept - 1]
+        indices.append(indices[-1])
+        kept += 1
+    
+    elapsed = time.monotonic() - start
+    logger.info(f"Decoded {kept} frames at {width}x{height} via pipe in {elapsed:.2f}s"
+                + (f" ({sampled - len(set(indices))} of {sampled} dropped by {FRAME_SELECT})"
+                   if FRAME_SELECT != "uniform" else ""))
+    if stats is not None:
+        stats["decode"] = {"path": "pipe", "frames": kept, "size": [width, height],
+                           "seconds": round(elapsed, 3), "select": FRAME_SELECT,
+                           "sampled_frames": sampled, "frames_dropped": sampled - len(set(indices))}
+    return torch.from_numpy(buffer[:kept]).permute(0, 3, 1, 2), indices
+
+
+# =============================================================================
+# AUDIO TRANSCRIPTION
+# =============================================================================
+
+class WhisperBackend(ABC):
+    """Transcribes one audio file and returns the verbose_json payload as a dict.
+
+    Subclasses can be passed to set_whisper_backend(), which is how a local
+    stub stands in for the hosted API.
+    """
+    name = "none"
+
+    @abstractmethod
+    async def transcribe(self, file_name: str, data: bytes) -> dict:
+        ...
+
+
+class SDKWhisperBackend(WhisperBackend):
+    """Whisper through the async Groq SDK or any OpenAI-compatible transcription API."""
+
+    def __init__(self, client, name: str, model: str = WHISPER_MODEL):
+        self.client = client
+        self.name = name
+        self.model = model
+
+    async def transcribe(self, file_name: str, data: bytes) -> dict:
+        result = await self.client.audio.transcriptions.create(
+            file=(file_name, data),
+            model=self.model,
+            temperature=0,
+            response_format="verbose_json",
+        )
+        if hasattr(result, "model_dump"):
+            return result.model_dump()
+        return {"text": getattr(result, 'text', str(result))}
+
+
+@dataclass
+class Transcript:
+    text: str
+    segments: List[dict]  # {"start", "end", "text"}, seconds from the start of the track
+
+
+@dataclass
+class AudioAnalysis:
+    duration: Optional[float]
+    max_volume: float  # dBFS; -inf for digital silence
+    silences: List[tuple[float, float]]
+
+
+transcript_cache = DiskCache("Transcript", TRANSCRIPT_CACHE_DIR, TRANSCRIPT_CACHE_MAX_MB * MB)
+transcribe_slots = asyncio.Semaphore(TRANSCRIBE_CONCURRENCY)  # Whisper requests in flight, across jobs
+
+DURATION_RE = re.compile(r"Duration: (\d+):(\d+):(\d+(?:\.\d+)?)")
+MAX_VOLUME_RE = re.compile(r"max_volume: (-?(?:inf|\d+(?:\.\d+)?)) dB")
+SILENCE_START_RE = re.compile(r"silence_start: (-?\d+(?:\.\d+)?)")
+SILENCE_END_RE = re.compile(r"silence_end: (\d+(?:\.\d+)?)")
+
+
+async def analyze_audio(audio_path: str) -> Optional[AudioAnalysis]:
+    """Peak level and silent intervals from one volumedetect + silencedetect pass."""
+    args = ['ffmpeg', '-hide_banner', '-nostats', '-i', audio_path, '-vn',
+            '-af', f'silencedetect=noise={SILENCE_NOISE_DB}dB:d={SILENCE_MIN_SECONDS},volumedetect',
+            '-f', 'null', '-']
+    result = await run_process(args)
+    if result is None:
+        return None
+    returncode, log = result
+    volume = MAX_VOLUME_RE.search(log)
+    if returncode != 0 or not volume:
+        logger.warning(f"Audio analysis failed: {log[-300:]}")
+        return None
+
+    duration = None
+    match = DURATION_RE.search(log)
+    if match:
+        hours, minutes, seconds = match.groups()
+        duration = int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+    starts = [max(0.0, float(v)) for v in SILENCE_START_RE.findall(log)]
+    ends = [float(v) for v in SILENCE_END_RE.findall(log)]
+    if len(ends) < len(starts):  # silence runs to the end of the track
+        ends.append(duration if duration is not None else starts[-1])
+    return AudioAnalysis(duration, float(volume.group(1)), list(zip(starts, ends)))
+
+
+def plan_chunks(duration: float, silences: List[tuple[float, float]],
+                chunk_seconds: float = TRANSCRIBE_CHUNK_SECONDS) -> List[tuple[float, float]]:
+    """Split [0, duration] into spans of at most chunk_seconds.
+
+    Each cut goes at the middle of the latest silence in the last quarter of
+    the span, or exactly at the limit when there is none.
+    """
+    cuts = [0.0]
+    while duration - cuts[-1] > chunk_seconds:
+        limit = cuts[-1] + chunk_seconds
+        window_start = limit - chunk_seconds / 4
+        gaps = [(start + end) / 2 for start, end in silences
+                if window_start <= (start + end) / 2 <= limit]
+        cuts.append(max(gaps) if gaps else limit)
+    spans = list(zip(cuts, cuts[1:] + [duration]))
+    # Spans that fall entirely inside a silence have nothing to transcribe
+    return [(a, b) for a, b in spans
+            if not any(start <= a and b <= end for start, end in silences)]
+
+
+async def transcribe_chunk(path: str, offset: float) -> Optional[List[dict]]:
+    """Transcribe one file, shifting segment times by offset; None after retries fail."""
+    data = await asyncio.to_thread(read_bytes, path)
+    for attempt in range(TRANSCRIBE_RETRIES + 1):
+        try:
+            async with transcribe_slots:
+                result = await whisper_backend.transcribe(os.path.basename(path), data)
+            break
+        except Exception as e:
+            logger.warning(f"Transcription of {os.path.basename(path)} failed "
+                           f"(attempt {attempt + 1}): {e}")
+            if attempt == TRANSCRIBE_RETRIES:
+                return None
+            await asyncio.sleep(2 ** attempt)
+
+    segments = [{"start": round(seg["start"] + offset, 3), "end": round(seg["end"] + offset, 3),
+                 "text": seg["text"].strip()}
+                for seg in result.get("segments") or [] if seg.get("text", "").strip()]
+    if not segments and result.get("text", "").strip():
+        segments = [{"start": offset, "end": offset, "text": result["text"].strip()}]
+    return segments
+
+
+async def transcribe_chunks(audio_path: str, spans: List[tuple[float, float]]) -> tuple[List[dict], int]:
+    """Cut spans out of the track and transcribe them concurrently.
+
+    Returns the stitched segments and the number of spans that failed.
+    """
+    ext = os.path.splitext(audio_path)[1] or f".{AUDIO_EXTRACT_FORMAT}"
+    with tempfile.TemporaryDirectory(prefix="transcribe_") as chunk_dir:
+        async def cut_and_transcribe(i: int, start: float, end: float) -> Optional[List[dict]]:
+            chunk_path = os.path.join(chunk_dir, f"chunk_{i:04d}{ext}")
+            if not (await run_ffmpeg_async(['-y', '-ss', f'{start:.3f}', '-t', f'{end - start:.3f}',
+                                            '-i', audio_path, '-vn', '-c', 'copy', chunk_path])
+                    and has_output(chunk_path)):
+                logger.warning(f"Could not cut audio span {start:.1f}-{end:.1f}s")
+                return None
+            return await transcribe_chunk(chunk_path, start)
+
+        results = await asyncio.gather(*(cut_and_transcribe(i, start, end)
+                                         for i, (start, end) in enumerate(spans)))
+    segments = [seg for result in results if result for seg in result]
+    segments.sort(key=lambda seg: seg["start"])
+    return segments, sum(1 for result in results if result is None)
+
+
+async def transcribe_track(audio_path: str, stats: Optional[dict] = None) -> Optional[Transcript]:
+    """Transcribe a track: skip silence, chunk long audio, stitch and cache the result."""
+    if not whisper_backend:
+        return None
+    t0 = time.time()
+    info = {"backend": whisper_backend.name, "cached": False, "silent": False, "chunks": 0}
+    if stats is not None:
+        stats["transcription"] = info
+
+    key = None
+    if transcript_cache.enabled:
+        audio_hash = await asyncio.to_thread(file_sha256, audio_path)
+        key = hashlib.sha256(f"{audio_hash}\0{whisper_backend.name}\0{WHISPER_MODEL}".encode()).hexdigest()
+        cached = await asyncio.to_thread(transcript_cache.get, key)
+        if cached is not None:
+            info.update(cached=True, seconds=round(time.time() - t0, 3))
+            logger.info(f"Transcript cache hit: {audio_path}")
+            return Transcript(**cached) if cached["text"] else None
+
+    analysis = await analyze_audio(audio_path)
+    if analysis and analysis.max_volume < SILENT_TRACK_MAX_DB:
+        logger.info(f"Skipping silent track ({analysis.max_volume} dB peak): {audio_path}")
+        info.update(silent=True, seconds=round(time.time() - t0, 3))
+        transcript = Transcript("", [])
+    else:
+        if analysis and analysis.duration:
+            spans = plan_chunks(analysis.duration, analysis.silences)
+            info["duration"] = round(analysis.duration, 3)
+        else:
+            spans = None
+        logger.info(f"Transcribing: {audio_path} ({len(spans) if spans else 1} chunks)")
+
+        if spans is None or (len(spans) == 1 and spans[0][0] == 0):
+            segments = await transcribe_chunk(audio_path, 0.0)
+            failed = int(segments is None)
+            segments = segments or []
+        else:
+            segments, failed = await transcribe_chunks(audio_path, spans)
+        info.update(chunks=len(spans) if spans else 1, failed_chunks=failed,
+                    seconds=round(time.time() - t0, 3))
+        if failed and not segments:
+            logger.error(f"Transcription failed: {audio_path}")
+            return None
+        transcript = Transcript(" ".join(seg["text"] for seg in segments), segments)
+        if failed:
+            # Partial results are returned but not cached, so a retry can fill the gaps
+            key = None
+
+    if key:
+        try:
+            await asyncio.to_thread(transcript_cache.put, key,
+                                    {"text": transcript.text, "segments": transcript.segments})
+        except OSError as e:
+            logger.warning(f"Transcript cache write failed: {e}")
+    logger.info(f"Transcription: {len(transcript.text)} chars in {info['seconds']}s")
+    return transcript if transcript.text else None
+
+
+async def transcribe_audio(audio_path: str, stats: Optional[dict] = None) -> Optional[Transcript]:
+    """Transcribe audio with the configured Whisper backend; None on failure or silence."""
+    try:
+        return await transcribe_track(audio_path, stats)
+    except Exception as e:
+        logger.error(f"Transcription error: {e}")
+        return None
+
+
+# =============================================================================
+# MODEL FUNCTIONS
+# =============================================================================
+
+def build_bnb_config(quant: str):
+    """Build quantization config."""
+    import torch
+    from transformers import BitsAndBytesConfig
+    if quant == "8-bit":
+        return BitsAndBytesConfig(load_in_8bit=True)
+    if quant == "4-bit":
+        return BitsAndBytesConfig(load_in_4bit=True, bnb_4bit_compute_dtype=torch.float16)
+    return None
+
+
+def pick_model_class(model_id: str):
+    """Select model class based on model ID."""
+    from transformers import AutoModelForVision2Seq
+    try:
+        if "Qwen3-VL" in model_id:
+            from transformers import Qwen3VLForConditionalGeneration
+            return Qwen3VLForConditionalGeneration
+        if "Qwen2.5-VL" in model_id or "Qwen2_5-VL" in model_id:
             from transformers import Qwen2_5_VLForConditionalGeneration
             return Qwen2_5_VLForConditionalGeneration
     except ImportError:
@@ -440,15 +1920,15 @@ def pick_model_class(model_id: str):
     return AutoModelForVision2Seq
 
 
-def load_model():
-    """Load VLM model and processor."""
-    global model, processor
+def load_model(device: str = "auto") -> tuple:
+    """Load the VLM and its processor onto one device; "auto" shards across all GPUs."""
+    import torch
     
-    logger.info(f"Loading model: {MODEL_ID} (quant={QUANTIZATION}, attn={ATTENTION_IMPL})")
+    logger.info(f"Loading model: {MODEL_ID} on {device} (quant={QUANTIZATION}, attn={ATTENTION_IMPL})")
     
     kwargs = {
         "dtype": torch.float16,
-        "device_map": "auto",
+        "device_map": "auto" if device == "auto" else {"": device},
         "attn_implementation": ATTENTION_IMPL,
     }
     
@@ -470,188 +1950,1735 @@ def load_model():
     
     from transformers import AutoProcessor
     processor = AutoProcessor.from_pretrained(MODEL_ID, use_fast=True)
-    logger.info("Model loaded successfully")
+    # Batched generation needs prompts aligned on the right edge
+    processor.tokenizer.padding_side = "left"
+    configure_generation(model)
+    logger.info(f"Model loaded on {device}")
+    return model, processor
+
+
+def configure_generation(model):
+    """Apply GENERATION_COMPILE to the model's generation config.
+
+    "static" preallocates the KV cache so decode steps keep fixed shapes;
+    "compile" also lets generate() torch.compile the decode step. Prefill
+    varies with the video, so it stays eager either way.
+    """
+    if GENERATION_COMPILE not in ("static", "compile"):
+        return
+    model.generation_config.cache_implementation = "static"
+    if GENERATION_COMPILE == "compile":
+        from transformers import CompileConfig
+        model.generation_config.compile_config = CompileConfig(dynamic=None)
+    else:
+        model.generation_config.disable_compile = True
+    logger.info(f"Generation: static KV cache{', compiled decode' if GENERATION_COMPILE == 'compile' else ''}")
+
+
+@dataclass
+class PreparedCaption:
+    """Model-ready inputs for one caption request."""
+    text: str
+    images: Optional[list]
+    videos: Optional[list]
+    video_kwargs: dict
+    visual_tokens: int
+    degradations: List[dict] = field(default_factory=list)  # downscales applied after CUDA OOM
+    followups: List[str] = field(default_factory=list)  # texts of further prompts about the same video
+
+
+def estimate_visual_tokens(videos: Optional[list]) -> int:
+    """Approximate visual tokens: 2-frame temporal patches of 28x28 pixels."""
+    total = 0
+    for video in videos or []:
+        frames, _, height, width = video.shape
+        total += max(1, frames // 2) * (height // 28) * (width // 28)
+    return total
+
+
+@dataclass
+class DecodedVideo:
+    """Decoded frames (or a preprocessed file) plus audio demuxed in the same pass."""
+    video_path: str
+    plan: SamplingPlan
+    videos: Optional[list]
+    video_kwargs: dict
+    audio_path: Optional[str] = None
+
+
+def decode_video(video_path: str, stats: Optional[dict] = None, demux_audio: bool = False,
+                 probe: Optional[VideoProbe] = None) -> DecodedVideo:
+    """Validate, probe and decode a video into processor-ready frames.
+
+    With demux_audio, the audio track is extracted by the same ffmpeg
+    invocation that produces the model video, so the input is read once.
+    If that combined run fails, the video is decoded without it and the
+    audio is extracted on its own, so audio never degrades the video path.
+    """
+    # Validate file
+    if not os.path.exists(video_path):
+        raise FileNotFoundError(f"Video not found: {video_path}")
+    
+    ext = os.path.splitext(video_path)[-1].lower()
+    if ext not in VIDEO_EXTENSIONS:
+        raise ValueError(f"Unsupported format: {ext}")
+    
+    # Plan frame sampling within the token budget
+    probe = probe or probe_video(video_path)
+    plan = plan_sampling(probe)
+    if stats is not None:
+        stats["sampling"] = {"mode": RESOLUTION_MODE, **plan.video_options(),
+                             "estimated_tokens": plan.visual_tokens}
+    audio_path = extracted_audio_path(video_path) if demux_audio and probe and probe.has_audio else None
+    
+    # Decode straight to memory, or preprocess to a file for qwen_vl_utils
+    frames = None
+    if FRAME_DECODE_MODE == "pipe":
+        frames = decode_frames(video_path, probe, plan, stats, audio_path)
+    if frames is not None:
+        frames, indices = frames
+        # Exact per-frame timestamps for processors that use them (Qwen3-VL);
+        # the mean rate for those that assume uniform spacing
+        metadata = {"fps": plan.fps, "frames_indices": indices, "total_num_frames": indices[-1] + 1}
+        fps = plan.fps * len(indices) / (indices[-1] + 1)
+        decoded = DecodedVideo(video_path, plan, [frames],
+                               {"do_sample_frames": False, "fps": [fps], "video_metadata": [metadata]})
+    else:
+        model_path = preprocess_video(video_path, stats, probe, plan,
+                                      None if has_output(audio_path) else audio_path)
+        messages = [{"role": "user", "content": [{"type": "video", "video": model_path, **plan.video_options()}]}]
+        from qwen_vl_utils import process_vision_info
+        _, video_inputs, video_kwargs = process_vision_info(messages, return_video_kwargs=True)
+        # Same shape of kwargs as the pipe path, so the two can share a batch
+        frames = len(video_inputs[0])
+        video_kwargs["video_metadata"] = [{"fps": video_kwargs["fps"][0], "frames_indices": list(range(frames)),
+                                           "total_num_frames": frames}]
+        decoded = DecodedVideo(model_path, plan, video_inputs, video_kwargs)
+    
+    if audio_path and not has_output(audio_path):
+        run_ffmpeg(['-i', video_path] + audio_output_args(audio_path))
+    decoded.audio_path = audio_path if has_output(audio_path) else None
+    return decoded
+
+
+def build_caption_inputs(decoded: DecodedVideo, prompt: str, transcript: Optional[str] = None,
+                         extra_prompts: Sequence[str] = ()) -> PreparedCaption:
+    """Combine decoded video with the prompt (and transcript) into model inputs.
+
+    Extra prompts become followups answered about the same video.
+    """
+    def render(prompt: str) -> str:
+        # Build prompt with transcript context
+        full_prompt = prompt
+        if transcript and USE_AUDIO_GUARDRAIL:
+            full_prompt = f"{prompt}\n\nAudio transcript for context:\n{transcript}"
+        
+        # Build messages; the video comes first so every prompt shares the same prefix
+        messages = [{
+            "role": "user",
+            "content": [
+                {"type": "video", "video": decoded.video_path, **decoded.plan.video_options()},
+                {"type": "text", "text": full_prompt},
+            ],
+        }]
+        return caption_replicas.processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+    
+    return PreparedCaption(
+        text=render(prompt),
+        images=None,
+        videos=decoded.videos,
+        video_kwargs=decoded.video_kwargs,
+        visual_tokens=estimate_visual_tokens(decoded.videos),
+        followups=[render(p) for p in extra_prompts],
+    )
+
+
+def prepare_caption_inputs(video_path: str, prompt: str, transcript: Optional[str] = None,
+                           stats: Optional[dict] = None) -> PreparedCaption:
+    """Validate, preprocess and decode a video into processor inputs."""
+    return build_caption_inputs(decode_video(video_path, stats), prompt, transcript)
+
+
+def merge_video_kwargs(batch: List[PreparedCaption]) -> dict:
+    """Combine per-request video kwargs; list values (e.g. fps) are concatenated."""
+    merged = {}
+    for item in batch:
+        for key, value in item.video_kwargs.items():
+            if isinstance(value, list):
+                merged.setdefault(key, []).extend(value)
+            else:
+                merged[key] = value
+    return merged
+
+
+def generate_captions(model, processor, batch: List[PreparedCaption],
+                      stats: Optional[dict] = None) -> list:
+    """Run one padded generate call over a batch of prepared inputs.
+
+    Items with followups are answered separately, as a list of captions;
+    the rest still share one padded call.
+    """
+    import torch
+    
+    if any(item.followups for item in batch):
+        plain = [item for item in batch if not item.followups]
+        captions = iter(generate_captions(model, processor, plain, stats) if plain else [])
+        return [generate_multi_prompt(model, processor, item) if item.followups else next(captions)
+                for item in batch]
+    
+    images = [img for item in batch for img in (item.images or [])]
+    videos = [vid for item in batch for vid in (item.videos or [])]
+    
+    inputs = processor(
+        text=[item.text for item in batch],
+        images=images or None,
+        videos=videos or None,
+        padding=True,
+        return_tensors="pt",
+        **merge_video_kwargs(batch),
+    ).to(model.device)
+    
+    if stats is not None:
+        mask = inputs.attention_mask
+        stats["total_tokens"] = int(mask.numel())
+        stats["padded_tokens"] = int(mask.numel() - mask.sum())
+    
+    # Generate
+    with torch.no_grad():
+        generated_ids = model.generate(**inputs, max_new_tokens=MAX_TOKENS)
+    
+    trimmed_ids = [out[len(inp):] for inp, out in zip(inputs.input_ids, generated_ids)]
+    captions = processor.batch_decode(trimmed_ids, skip_special_tokens=True)
+    
+    logger.info(f"Generated {len(captions)} caption(s) ({', '.join(str(len(c)) for c in captions)} chars)")
+    return captions
+
+
+def generate_multi_prompt(model, processor, item: PreparedCaption) -> List[str]:
+    """Answer the item's prompt and followups with one processor pass over the video.
+
+    Every prompt's text starts with the same tokens up to the end of the
+    video, so the prefix (and the vision tower) is run once and its KV
+    cache is reused for each prompt, cropped back after each answer. If
+    the model cannot continue from a cache, each prompt is generated in
+    full from the shared pixel values instead.
+    """
+    import torch
+    
+    texts = [item.text] + item.followups
+    inputs = processor(
+        text=texts[:1],
+        images=item.images or None,
+        videos=item.videos or None,
+        return_tensors="pt",
+        **item.video_kwargs,
+    ).to(model.device)
+    
+    marker = getattr(processor, "vision_end_token", "<|vision_end|>")
+    marker_id = processor.tokenizer.convert_tokens_to_ids(marker)
+    prefix_len = int((inputs.input_ids[0] == marker_id).nonzero()[-1]) + 1
+    per_token = [k for k, v in inputs.items() if torch.is_tensor(v) and v.shape[:2] == inputs.input_ids.shape]
+    shared = {k: v for k, v in inputs.items() if k not in per_token}  # pixel_values_videos, video_grid_thw
+    prefix = {k: inputs[k][:, :prefix_len] for k in per_token}
+    
+    def prompt_inputs(text: str) -> dict:
+        """Per-token inputs for the shared prefix followed by this prompt's tokens."""
+        suffix = text[text.rindex(marker) + len(marker):]
+        ids = processor.tokenizer(suffix, add_special_tokens=False, return_tensors="pt").input_ids.to(model.device)
+        fill = {"input_ids": ids, "attention_mask": torch.ones_like(ids)}
+        return {k: torch.cat([prefix[k], fill.get(k, torch.zeros_like(ids)).to(prefix[k].dtype)], dim=1)
+                for k in per_token}
+    
+    # A static cache (GENERATION_COMPILE) can't be continued from a prefilled dynamic one
+    cache = None
+    if PREFIX_CACHE and getattr(model.generation_config, "cache_implementation", None) is None:
+        with torch.no_grad():
+            cache = model(**prefix, **shared, use_cache=True, logits_to_keep=1).past_key_values
+    
+    answers = []
+    for text in texts:
+        full = prompt_inputs(text)
+        output = None
+        if cache is not None:
+            try:
+                with torch.no_grad():
+                    output = model.generate(input_ids=full["input_ids"], attention_mask=full["attention_mask"],
+                                            past_key_values=cache, max_new_tokens=MAX_TOKENS)
+            except Exception as e:
+                if is_oom_error(e):
+                    raise
+                logger.warning(f"Prefix cache reuse failed ({e}); encoding the video per prompt")
+                cache = None
+            else:
+                cache.crop(-(cache.get_seq_length() - prefix_len))
+        if output is None:
+            with torch.no_grad():
+                output = model.generate(**full, **shared, max_new_tokens=MAX_TOKENS)
+        answers.append(processor.batch_decode(output[:, full["input_ids"].shape[1]:], skip_special_tokens=True)[0])
+    
+    logger.info(f"Answered {len(answers)} prompts over {prefix_len} shared tokens "
+                f"({'prefix cache reused' if cache is not None else 'video encoded per prompt'})")
+    return answers
+
+
+async def warmup_model():
+    """Caption a synthetic clip on every replica so CUDA context setup, kernel
+    autotuning, allocator growth and any compilation happen before real traffic.
+
+    The clip is decoded like a real request, so sampling uses the
+    configured RESOLUTION_MODE.
+    """
+    with tempfile.TemporaryDirectory(prefix="warmup_") as tmp:
+        path = os.path.join(tmp, "warmup.mp4")
+        made = await run_ffmpeg_async([
+            '-v', 'error', '-f', 'lavfi', '-i', f'testsrc2=size={WARMUP_RESOLUTION}:rate=30',
+            '-t', str(WARMUP_SECONDS), '-pix_fmt', 'yuv420p', '-c:v', 'mpeg4', '-q:v', '5', path
+        ])
+        if not made:
+            raise RuntimeError("Could not generate warm-up clip")
+        prepared = await asyncio.to_thread(prepare_caption_inputs, path, read_prompt())
+        replicas = [r for r in caption_replicas.replicas if r.loaded]
+        for run in range(1, WARMUP_RUNS + 1):
+            start = time.monotonic()
+            await asyncio.gather(*(asyncio.wrap_future(r.batcher.submit(prepared)) for r in replicas))
+            logger.info(f"Warm-up run {run}/{WARMUP_RUNS}: {time.monotonic() - start:.2f}s")
+
+
+# =============================================================================
+# CAPTION BATCHER
+# =============================================================================
+
+class CaptionBatcher:
+    """Single GPU thread that groups queued caption inputs into padded batches.
+
+    A batch closes when it reaches `max_size`, when `max_wait_ms` has passed
+    since its first item, or when the next item would exceed the visual-token
+    budget (that item then opens the following batch).
+    """
+
+    def __init__(self, generate_fn, max_size: int = BATCH_MAX_SIZE,
+                 max_wait_ms: int = BATCH_MAX_WAIT_MS,
+                 max_visual_tokens: int = BATCH_MAX_VISUAL_TOKENS):
+        self.generate_fn = generate_fn
+        self.max_size = max(1, max_size)
+        self.max_wait = max_wait_ms / 1000
+        self.max_visual_tokens = max_visual_tokens
+        self._queue: "queue.Queue[Optional[tuple]]" = queue.Queue()
+        self._carry: Optional[tuple] = None
+        self._stopping = False
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._metrics = {
+            "batches": 0,
+            "jobs": 0,
+            "batch_sizes": {},
+            "total_tokens": 0,
+            "padded_tokens": 0,
+            "generate_seconds": 0.0,
+        }
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name="caption-batcher", daemon=True)
+        self._thread.start()
+        logger.info(f"Batcher started: max_size={self.max_size}, max_wait={self.max_wait * 1000:.0f}ms, "
+                    f"token_budget={self.max_visual_tokens}")
+
+    def stop(self, timeout: float = 30):
+        if self._thread:
+            self._queue.put(None)
+            self._thread.join(timeout)
+            self._thread = None
+
+    def submit(self, prepared: PreparedCaption) -> Future:
+        future: Future = Future()
+        self._queue.put((prepared, future))
+        return future
+
+    def metrics(self) -> dict:
+        with self._lock:
+            m = dict(self._metrics, batch_sizes=dict(self._metrics["batch_sizes"]))
+        m["avg_batch_size"] = round(m["jobs"] / m["batches"], 2) if m["batches"] else 0.0
+        m["padding_waste"] = round(m["padded_tokens"] / m["total_tokens"], 4) if m["total_tokens"] else 0.0
+        m["pending"] = self._queue.qsize()
+        return m
+
+    def _collect(self) -> List[tuple]:
+        first = self._carry or self._queue.get()
+        self._carry = None
+        if first is None:
+            self._stopping = True
+            return []
+        
+        batch = [first]
+        tokens = first[0].visual_tokens
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is None:
+                self._stopping = True
+                break
+            if tokens + item[0].visual_tokens > self.max_visual_tokens:
+                self._carry = item
+                break
+            batch.append(item)
+            tokens += item[0].visual_tokens
+        return batch
+
+    def _run(self):
+        while not self._stopping:
+            batch = self._collect()
+            if batch:
+                self._run_batch(batch)
+        # Fail anything still waiting so callers don't block forever
+        pending = [self._carry] if self._carry else []
+        while not self._queue.empty():
+            pending.append(self._queue.get_nowait())
+        for item in filter(None, pending):
+            item[1].set_exception(RuntimeError("Batcher stopped"))
+
+    def _run_batch(self, batch: List[tuple]):
+        stats = {}
+        start = time.monotonic()
+        try:
+            captions = self.generate_fn([p for p, _ in batch], stats)
+        except Exception as e:
+            if len(batch) == 1:
+                batch[0][1].set_exception(e)
+                return
+            # One bad input shouldn't fail its batch-mates; retry individually
+            logger.warning(f"Batch of {len(batch)} failed ({e}); retrying individually")
+            for item in batch:
+                self._run_batch([item])
+            return
+        
+        elapsed = time.monotonic() - start
+        for (_, future), caption in zip(batch, captions):
+            future.set_result(caption)
+        
+        with self._lock:
+            m = self._metrics
+            m["batches"] += 1
+            m["jobs"] += len(batch)
+            m["batch_sizes"][len(batch)] = m["batch_sizes"].get(len(batch), 0) + 1
+            m["total_tokens"] += stats.get("total_tokens", 0)
+            m["padded_tokens"] += stats.get("padded_tokens", 0)
+            m["generate_seconds"] += elapsed
+        logger.info(f"Batch of {len(batch)} done in {elapsed:.1f}s "
+                    f"(padding {stats.get('padded_tokens', 0)}/{stats.get('total_tokens', 0)} tokens)")
+
+
+# =============================================================================
+# MEMORY ADMISSION
+# =============================================================================
+
+def kv_bytes_per_token(model) -> int:
+    """KV-cache bytes per token from the model config; 0 if it can't be read."""
+    config = getattr(model, "config", None)
+    config = getattr(config, "text_config", None) or config
+    try:
+        heads = config.num_attention_heads
+        kv_heads = getattr(config, "num_key_value_heads", None) or heads
+        head_dim = getattr(config, "head_dim", None) or config.hidden_size // heads
+        return 2 * config.num_hidden_layers * kv_heads * head_dim * model.dtype.itemsize
+    except AttributeError:
+        return 0
+
+
+def estimate_caption_bytes(prepared: PreparedCaption, per_token: int) -> int:
+    """GPU memory for one caption: KV cache over prompt, video and output tokens, plus overhead."""
+    # Followups run one after another on a cache cropped back to the video, so the longest text counts
+    text = max([prepared.text, *prepared.followups], key=len)
+    tokens = prepared.visual_tokens + len(text) // 4 + MAX_TOKENS
+    return int(tokens * per_token * ADMISSION_OVERHEAD)
+
+
+def device_free_bytes(device: str) -> Optional[int]:
+    """Memory this process can still allocate on a CUDA device (all GPUs for "auto")."""
+    if device.startswith("cpu"):
+        return None
+    import torch
+    if not torch.cuda.is_available():
+        return None
+    indices = range(torch.cuda.device_count()) if device == "auto" else [torch.device(device).index or 0]
+    # Blocks cached by torch's allocator are free to us but not to mem_get_info
+    return sum(torch.cuda.mem_get_info(i)[0] + torch.cuda.memory_reserved(i) - torch.cuda.memory_allocated(i)
+               for i in indices)
+
+
+def is_oom_error(error: Exception) -> bool:
+    return "out of memory" in str(error).lower()
+
+
+def release_cuda_cache():
+    import torch
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+def downscale_prepared(prepared: PreparedCaption) -> tuple[PreparedCaption, Optional[dict]]:
+    """Halve the frames or shrink frame area by about half, whichever has more headroom.
+
+    Returns the smaller inputs and a note describing the change, or None
+    for the note when the video is already at the minimum size.
+    """
+    if not prepared.videos:
+        return prepared, None
+    import torch
+    video = prepared.videos[0]
+    frames, _, height, width = video.shape
+    frame_room = frames / (2 * MIN_FRAMES)
+    pixel_room = height * width / (2 * RESOLUTION_MIN_PIXELS)
+    video_kwargs = dict(prepared.video_kwargs)
+    
+    if frame_room >= 1 and frame_room >= pixel_room:
+        smaller = video[::2]
+        smaller = smaller[:len(smaller) // 2 * 2]
+        if isinstance(video_kwargs.get("fps"), list):
+            video_kwargs["fps"] = [video_kwargs["fps"][0] / 2] + video_kwargs["fps"][1:]
+        if video_kwargs.get("video_metadata"):
+            metadata = dict(video_kwargs["video_metadata"][0])
+            metadata["frames_indices"] = metadata["frames_indices"][::2][:len(smaller)]
+            video_kwargs["video_metadata"] = [metadata] + video_kwargs["video_metadata"][1:]
+        change = {"reduced": "frames", "from": frames, "to": len(smaller)}
+    elif pixel_room >= 1:
+        new_height = max(28, round(height * 0.7 / 28) * 28)
+        new_width = max(28, round(width * 0.7 / 28) * 28)
+        smaller = torch.nn.functional.interpolate(video.float(), size=(new_height, new_width),
+                                                  mode="bilinear", antialias=True)
+        if not video.is_floating_point():
+            smaller = smaller.round().clamp(0, 255)
+        smaller = smaller.to(video.dtype)
+        change = {"reduced": "resolution", "from": [width, height], "to": [new_width, new_height]}
+    else:
+        return prepared, None
+    
+    videos = [smaller] + prepared.videos[1:]
+    return replace(prepared, videos=videos, video_kwargs=video_kwargs,
+                   visual_tokens=estimate_visual_tokens(videos)), change
+
+
+# =============================================================================
+# MODEL REPLICAS
+# =============================================================================
+
+def resolve_caption_devices(spec: str = CAPTION_DEVICES) -> List[str]:
+    """Devices to load replicas on; ["auto"] is a single replica sharded over all GPUs."""
+    spec = spec.strip()
+    if not spec:
+        return ["auto"]
+    if spec == "all":
+        import torch
+        return [f"cuda:{i}" for i in range(torch.cuda.device_count())] or ["auto"]
+    return [device.strip() for device in spec.split(",") if device.strip()]
+
+
+class ModelReplica:
+    """One model/processor pair on one device, fed by its own batcher.
+
+    After REPLICA_MAX_FAILURES consecutive failed jobs the replica sits out
+    for REPLICA_COOLDOWN seconds unless no other replica is available.
+    """
+
+    def __init__(self, device: str, loader=load_model, generate_fn=generate_captions):
+        self.device = device
+        self.loader = loader
+        self.generate_fn = generate_fn
+        self.model = None
+        self.processor = None
+        self.error: Optional[str] = None
+        self.batcher = CaptionBatcher(self.generate)
+        self.capacity: Optional[int] = None  # admission budget in bytes; None = unlimited
+        self.kv_bytes_per_token = 0
+        self.reserved = 0  # estimated bytes of admitted, unfinished jobs
+        self.oom_retries = 0
+        self.in_flight = 0
+        self.completed = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.unhealthy_until = 0.0
+
+    @property
+    def loaded(self) -> bool:
+        return self.model is not None and self.processor is not None
+
+    @property
+    def available(self) -> bool:
+        return self.loaded and self.batcher.running
+
+    @property
+    def healthy(self) -> bool:
+        return self.available and time.monotonic() >= self.unhealthy_until
+
+    def load(self):
+        try:
+            self.model, self.processor = self.loader(self.device)
+            self.error = None
+        except Exception as e:
+            self.error = str(e)
+            logger.error(f"Model load failed on {self.device}: {e}")
+            raise
+        self.kv_bytes_per_token = kv_bytes_per_token(self.model)
+        free = device_free_bytes(self.device) if ADMISSION_MEMORY_FRACTION > 0 else None
+        if free and self.kv_bytes_per_token:
+            self.capacity = int(free * ADMISSION_MEMORY_FRACTION)
+            logger.info(f"Replica {self.device}: {self.capacity / MB:.0f} MB for captions, "
+                        f"{self.kv_bytes_per_token / 1024:.0f} KB KV cache per token")
+
+    def estimate(self, prepared: PreparedCaption) -> int:
+        return estimate_caption_bytes(prepared, self.kv_bytes_per_token)
+
+    def fits(self, size: int) -> bool:
+        """Whether a job fits next to those already admitted; an idle replica takes anything."""
+        return self.capacity is None or self.reserved == 0 or self.reserved + size <= self.capacity
+
+    def unload(self):
+        self.model = self.processor = None
+
+    def generate(self, batch: List[PreparedCaption], stats: Optional[dict] = None) -> List[str]:
+        """Generate captions; a lone input that hits CUDA OOM is retried downscaled."""
+        if not self.loaded:
+            raise RuntimeError(f"Model not loaded on {self.device}")
+        try:
+            return self.generate_fn(self.model, self.processor, batch, stats)
+        except Exception as e:
+            if not is_oom_error(e):
+                raise
+            release_cuda_cache()
+            if len(batch) > 1:
+                raise  # the batcher retries each input on its own
+            error = e
+        
+        prepared = batch[0]
+        for _ in range(OOM_MAX_RETRIES):
+            prepared, change = downscale_prepared(prepared)
+            if change is None:
+                break
+            self.oom_retries += 1
+            batch[0].degradations.append(change)
+            logger.warning(f"CUDA OOM on {self.device}; retrying with {change['reduced']} "
+                           f"{change['from']} -> {change['to']}")
+            try:
+                return self.generate_fn(self.model, self.processor, [prepared], stats)
+            except Exception as e:
+                if not is_oom_error(e):
+                    raise
+                release_cuda_cache()
+                error = e
+        raise error
+
+    def record(self, ok: bool):
+        self.in_flight -= 1
+        if ok:
+            self.completed += 1
+            self.consecutive_failures = 0
+            return
+        self.failures += 1
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= REPLICA_MAX_FAILURES:
+            if time.monotonic() >= self.unhealthy_until:
+                logger.warning(f"Replica {self.device} failing; skipping it for {REPLICA_COOLDOWN}s")
+            self.consecutive_failures = 0
+            self.unhealthy_until = time.monotonic() + REPLICA_COOLDOWN
+
+    def as_dict(self) -> dict:
+        info = {
+            "device": self.device,
+            "loaded": self.loaded,
+            "healthy": self.healthy,
+            "error": self.error,
+            "in_flight": self.in_flight,
+            "reserved_mb": round(self.reserved / MB, 1),
+            "capacity_mb": round(self.capacity / MB, 1) if self.capacity else None,
+            "oom_retries": self.oom_retries,
+            "completed": self.completed,
+            "failures": self.failures,
+            "cooldown_seconds": round(max(0.0, self.unhealthy_until - time.monotonic()), 1),
+            "batching": self.batcher.metrics(),
+        }
+        if self.loaded and self.device.startswith("cuda"):
+            import torch
+            info["memory_allocated_mb"] = round(torch.cuda.memory_allocated(self.device) / MB, 1)
+        return info
+
+
+class ReplicaDispatcher:
+    """Sends each caption job to the least-loaded healthy model replica.
+
+    Load is the replica's in-flight job count, which includes jobs still
+    waiting in its batcher. A job is only admitted to a replica whose memory
+    budget has room for its estimated footprint; otherwise it is held, in
+    arrival order, until a running job finishes. Tests can pass a stub
+    loader and generate_fn with CPU "devices" to exercise routing without
+    a GPU.
+    """
+
+    def __init__(self, devices: List[str], loader=load_model, generate_fn=generate_captions):
+        self.loader = loader
+        self.generate_fn = generate_fn
+        self.configure(devices)
+        self.held_total = 0
+        self._held: "deque[tuple]" = deque()  # (prepared, future, held_since)
+        self._lock = threading.Lock()
+
+    def configure(self, devices: List[str]):
+        """Replace the replica set with unloaded replicas on these devices."""
+        self.replicas = [ModelReplica(device, self.loader, self.generate_fn) for device in devices]
+
+    @property
+    def loaded(self) -> bool:
+        return any(r.loaded for r in self.replicas)
+
+    @property
+    def processor(self):
+        """Processor of the first loaded replica, for CPU-side prompt templating."""
+        return next((r.processor for r in self.replicas if r.loaded), None)
+
+    async def load(self):
+        """Load every replica in parallel; fails only if none could be loaded."""
+        results = await asyncio.gather(*(asyncio.to_thread(r.load) for r in self.replicas),
+                                       return_exceptions=True)
+        if not self.loaded:
+            raise results[0]
+        ready = sum(r.loaded for r in self.replicas)
+        logger.info(f"{ready}/{len(self.replicas)} model replica(s) loaded")
+
+    def unload(self):
+        for replica in self.replicas:
+            replica.unload()
+        if any(r.device != "cpu" for r in self.replicas):
+            import torch
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+        logger.info("Model unloaded")
+
+    def start(self):
+        for replica in self.replicas:
+            replica.batcher.start()
+
+    def stop(self):
+        for replica in self.replicas:
+            replica.batcher.stop()
+        with self._lock:
+            held, self._held = self._held, deque()
+        for _, future, _ in held:
+            future.set_exception(RuntimeError("Dispatcher stopped"))
+
+    def _pick(self, prepared: PreparedCaption) -> Optional[tuple[ModelReplica, int]]:
+        """Least-loaded healthy replica with room for the job, falling back to any
+        usable one if all are cooling down; None when none has room yet."""
+        candidates = ([r for r in self.replicas if r.healthy]
+                      or [r for r in self.replicas if r.available])
+        if not candidates:
+            raise RuntimeError("Model not loaded")
+        sized = [(r, r.estimate(prepared)) for r in candidates]
+        fitting = [(r, size) for r, size in sized if r.fits(size)]
+        return min(fitting, key=lambda item: item[0].in_flight) if fitting else None
+
+    def _admit(self) -> List[tuple]:
+        """Admit held jobs in arrival order while they fit (lock held)."""
+        admitted = []
+        while self._held:
+            prepared, future, held_since = self._held[0]
+            try:
+                choice = self._pick(prepared)
+            except RuntimeError as e:
+                self._held.popleft()
+                future.set_exception(e)
+                continue
+            if choice is None:
+                break
+            self._held.popleft()
+            replica, size = choice
+            replica.in_flight += 1
+            replica.reserved += size
+            admitted.append((replica, size, prepared, future, held_since))
+        return admitted
+
+    def _dispatch(self, admitted: List[tuple]):
+        for replica, size, prepared, future, held_since in admitted:
+            waited = time.monotonic() - held_since
+            if waited > 0.5:
+                logger.info(f"Admitted caption job to {replica.device} after {waited:.1f}s "
+                            f"(~{size / MB:.0f} MB)")
+            inner = replica.batcher.submit(prepared)
+            inner.add_done_callback(partial(self._settle, replica, size, future))
+
+    def _settle(self, replica: ModelReplica, size: int, future: Future, inner: Future):
+        error = inner.exception()
+        with self._lock:
+            replica.record(error is None)
+            replica.reserved -= size
+            admitted = self._admit()
+        if error:
+            future.set_exception(error)
+        else:
+            future.set_result(inner.result())
+        self._dispatch(admitted)
+
+    def submit(self, prepared: PreparedCaption) -> Future:
+        """Queue a caption on the best replica, or hold it until memory frees up."""
+        future: Future = Future()
+        with self._lock:
+            if not any(r.available for r in self.replicas):
+                raise RuntimeError("Model not loaded")
+            self._held.append((prepared, future, time.monotonic()))
+            admitted = self._admit()
+            if self._held and self._held[-1][1] is future:
+                self.held_total += 1
+                logger.info(f"Holding caption job for GPU memory ({len(self._held)} held)")
+        self._dispatch(admitted)
+        return future
+
+    def metrics(self) -> dict:
+        """Batching metrics summed over replicas."""
+        totals = {"batches": 0, "jobs": 0, "total_tokens": 0, "padded_tokens": 0,
+                  "generate_seconds": 0.0, "pending": 0}
+        for replica in self.replicas:
+            m = replica.batcher.metrics()
+            for key in totals:
+                totals[key] += m[key]
+        totals["avg_batch_size"] = round(totals["jobs"] / totals["batches"], 2) if totals["batches"] else 0.0
+        totals["padding_waste"] = (round(totals["padded_tokens"] / totals["total_tokens"], 4)
+                                   if totals["total_tokens"] else 0.0)
+        totals["held"] = len(self._held)
+        totals["held_total"] = self.held_total
+        return totals
+
+    def as_dict(self) -> List[dict]:
+        return [r.as_dict() for r in self.replicas]
+
+
+caption_replicas = ReplicaDispatcher([])  # replicas are configured at startup
+
+
+# =============================================================================
+# WEBHOOK
+# =============================================================================
+
+class WebhookOutbox:
+    """Durable queue of webhook payloads drained by an async sender.
+
+    Payloads are committed to SQLite before send_to_webhook returns, so
+    workers never wait on the dashboard and results survive restarts. The
+    sender retries with exponential backoff and jitter, caps in-flight
+    requests per endpoint and can post several payloads as one JSON list.
+    Delivered rows are deleted at once; rows that gave up ("dead") are
+    deleted WEBHOOK_DEAD_RETENTION_HOURS after they were queued, swept when
+    the sender starts and every WEBHOOK_PRUNE_INTERVAL seconds.
+    """
+
+    def __init__(self, path: str = WEBHOOK_OUTBOX_PATH, concurrency: int = WEBHOOK_CONCURRENCY,
+                 batch_size: int = WEBHOOK_BATCH_SIZE, max_attempts: int = WEBHOOK_MAX_ATTEMPTS):
+        self.path = path
+        self.concurrency = max(1, concurrency)
+        self.batch_size = max(1, batch_size)
+        self.max_attempts = max(1, max_attempts)
+        self.delivered = self.failed_attempts = self.pruned = 0
+        self._next_prune = 0.0
+        self._db: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self._limits: dict[str, asyncio.Semaphore] = {}
+        self._inflight = 0
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wake: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._sends: set[asyncio.Task] = set()
+        self._client: Optional[httpx.AsyncClient] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("""CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                endpoint TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL,
+                created_at REAL NOT NULL,
+                last_error TEXT)""")
+            self._db.execute("CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, next_attempt_at)")
+        return self._db
+
+    def enqueue(self, payload: dict, endpoint: str = CAPTION_RESULT_ENDPOINT) -> int:
+        """Persist a payload for delivery; safe to call from any thread."""
+        now = time.time()
+        with self._lock:
+            cursor = self._connect().execute(
+                "INSERT INTO outbox (endpoint, payload, next_attempt_at, created_at) VALUES (?, ?, ?, ?)",
+                (endpoint, json.dumps(payload), now, now))
+        if self._loop and self._wake:
+            self._loop.call_soon_threadsafe(self._wake.set)
+        return cursor.lastrowid
+
+    def _claim_due(self, limit: int) -> List[tuple[int, str, str, int]]:
+        """Lease up to limit due rows so a restart mid-send retries them later."""
+        now = time.time()
+        with self._lock:
+            db = self._connect()
+            rows = db.execute(
+                "SELECT id, endpoint, payload, attempts FROM outbox "
+                "WHERE status = 'pending' AND next_attempt_at <= ? ORDER BY id LIMIT ?",
+                (now, limit)).fetchall()
+            if rows:
+                lease = now + 4 * RESULT_API_TIMEOUT
+                db.executemany("UPDATE outbox SET next_attempt_at = ? WHERE id = ?",
+                               [(lease, row[0]) for row in rows])
+        return rows
+
+    def _next_due_in(self) -> float:
+        with self._lock:
+            (due,) = self._connect().execute(
+                "SELECT MIN(next_attempt_at) FROM outbox WHERE status = 'pending'").fetchone()
+        if due is None:
+            return WEBHOOK_POLL_INTERVAL
+        return min(max(0.0, due - time.time()), WEBHOOK_POLL_INTERVAL)
+
+    def _finish(self, rows: List[tuple], error: Optional[str], retryable: bool, retry_after: Optional[float]):
+        with self._lock:
+            db = self._connect()
+            if error is None:
+                db.executemany("DELETE FROM outbox WHERE id = ?", [(row[0],) for row in rows])
+                return
+            for row_id, _, _, attempts in rows:
+                attempts += 1
+                if not retryable or attempts >= self.max_attempts:
+                    db.execute("UPDATE outbox SET status = 'dead', attempts = ?, last_error = ? WHERE id = ?",
+                               (attempts, error, row_id))
+                    continue
+                delay = min(WEBHOOK_BACKOFF_MAX, WEBHOOK_BACKOFF_BASE * 2 ** (attempts - 1))
+                delay = max(delay * random.uniform(0.5, 1.0), retry_after or 0.0)
+                db.execute("UPDATE outbox SET attempts = ?, next_attempt_at = ?, last_error = ? WHERE id = ?",
+                           (attempts, time.time() + delay, error, row_id))
+
+    def _prune(self, now: Optional[float] = None) -> int:
+        """Delete dead rows older than the retention period; returns how many."""
+        if WEBHOOK_DEAD_RETENTION_HOURS <= 0:
+            return 0
+        cutoff = (now or time.time()) - WEBHOOK_DEAD_RETENTION_HOURS * 3600
+        with self._lock:
+            deleted = self._connect().execute(
+                "DELETE FROM outbox WHERE status = 'dead' AND created_at < ?", (cutoff,)).rowcount
+        if deleted:
+            self.pruned += deleted
+            logger.info(f"Webhook outbox: pruned {deleted} dead payload(s)")
+        return deleted
+
+    async def start(self):
+        await asyncio.to_thread(self._connect)
+        self._loop = asyncio.get_running_loop()
+        self._wake = asyncio.Event()
+        self._client = httpx.AsyncClient(
+            timeout=httpx.Timeout(RESULT_API_TIMEOUT, connect=10.0),
+            limits=httpx.Limits(max_keepalive_connections=self.concurrency,
+                                max_connections=self.concurrency * 4),
+        )
+        self._task = asyncio.create_task(self._run(), name="webhook-outbox")
+        logger.info(f"Webhook outbox started ({await asyncio.to_thread(self.pending)} pending in {self.path})")
+
+    async def stop(self):
+        """Stop sending; undelivered payloads stay in the outbox for the next start."""
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._sends:
+            await asyncio.wait(self._sends, timeout=RESULT_API_TIMEOUT)
+        if self._client:
+            await self._client.aclose()
+            self._client = None
+        self._loop = self._wake = None
+
+    async def _run(self):
+        while True:
+            self._wake.clear()
+            if time.monotonic() >= self._next_prune:
+                self._next_prune = time.monotonic() + WEBHOOK_PRUNE_INTERVAL
+                try:
+                    await asyncio.to_thread(self._prune)
+                except sqlite3.Error as e:
+                    logger.warning(f"Webhook outbox prune failed: {e}")
+            capacity = self.concurrency * self.batch_size - self._inflight
+            rows = await asyncio.to_thread(self._claim_due, capacity) if capacity > 0 else []
+            by_endpoint: dict[str, list] = {}
+            for row in rows:
+                by_endpoint.setdefault(row[1], []).append(row)
+            for endpoint, group in by_endpoint.items():
+                for i in range(0, len(group), self.batch_size):
+                    batch = group[i:i + self.batch_size]
+                    self._inflight += len(batch)
+                    task = asyncio.create_task(self._deliver(endpoint, batch))
+                    self._sends.add(task)
+                    task.add_done_callback(self._sends.discard)
+            # At capacity, only a finished send (or a new payload) is worth waking for
+            if self._inflight >= self.concurrency * self.batch_size:
+                timeout = None
+            else:
+                timeout = await asyncio.to_thread(self._next_due_in)
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _deliver(self, endpoint: str, rows: List[tuple]):
+        payloads = [json.loads(row[2]) for row in rows]
+        body = payloads if self.batch_size > 1 else payloads[0]
+        error, retryable, retry_after = None, True, None
+        try:
+            async with self._limits.setdefault(endpoint, asyncio.Semaphore(self.concurrency)):
+                response = await self._client.post(endpoint, json=body, headers=get_webhook_headers())
+            response.raise_for_status()
+        except httpx.HTTPStatusError as e:
+            status = e.response.status_code
+            error = f"HTTP {status}"
+            retryable = status in (408, 429) or status >= 500
+            header = e.response.headers.get("retry-after", "")
+            retry_after = float(header) if header.isdigit() else None
+        except httpx.HTTPError as e:
+            error = f"{type(e).__name__}: {e}"
+        try:
+            await asyncio.to_thread(self._finish, rows, error, retryable, retry_after)
+        finally:
+            self._inflight -= len(rows)
+            if self._wake:
+                self._wake.set()
+        ids = [row[0] for row in rows]
+        if error is None:
+            self.delivered += len(rows)
+            logger.info(f"Webhook delivered: outbox {ids}")
+        else:
+            self.failed_attempts += len(rows)
+            logger.warning(f"Webhook delivery failed for outbox {ids}: {error}")
+
+    def pending(self) -> int:
+        with self._lock:
+            return self._connect().execute(
+                "SELECT COUNT(*) FROM outbox WHERE status = 'pending'").fetchone()[0]
+
+    def stats(self) -> dict:
+        with self._lock:
+            counts = dict(self._connect().execute(
+                "SELECT status, COUNT(*) FROM outbox GROUP BY status").fetchall())
+        return {
+            "pending": counts.get("pending", 0),
+            "dead": counts.get("dead", 0),
+            "in_flight": self._inflight,
+            "delivered": self.delivered,
+            "failed_attempts": self.failed_attempts,
+            "pruned": self.pruned,
+            "running": self._task is not None,
+        }
+
+
+webhook_outbox = WebhookOutbox()
+
+
+def send_to_webhook(video_url: str, message: str, job_id: Optional[str] = None,
+                    extra: Optional[dict] = None) -> dict:
+    """Queue a result for delivery to the webhook endpoint."""
+    if not CAPTION_RESULT_ENDPOINT:
+        logger.warning("No webhook endpoint configured")
+        return {"status": "no-endpoint"}
+    
+    payload = {"message": message, "id": job_id, **(extra or {})}
+    outbox_id = webhook_outbox.enqueue(payload)
+    logger.info(f"Webhook queued: outbox {outbox_id}")
+    return {"status": "queued", "outbox_id": outbox_id}
+
+
+async def post_partial_webhook(job_id: str, message: str, seq: int):
+    """Post in-progress text straight to the webhook (best effort).
+
+    Partials are superseded by the next one, so they skip the outbox and
+    are never retried. Receivers can order them by seq.
+    """
+    if not CAPTION_RESULT_ENDPOINT:
+        return
+    payload = {"message": message, "id": job_id, "partial": True, "seq": seq}
+    try:
+        response = await get_http_client().post(
+            CAPTION_RESULT_ENDPOINT, json=payload, headers=get_webhook_headers(), timeout=RESULT_API_TIMEOUT)
+        response.raise_for_status()
+    except httpx.HTTPError as e:
+        logger.warning(f"[{job_id}] Partial webhook {seq} failed: {e}")
+
+
+# =============================================================================
+# CAPTION CACHE
+# =============================================================================
+
+def caption_cache_key(content_id: str, prompts: Optional[List[str]] = None) -> str:
+    """Cache key over video identity plus everything that shapes the caption."""
+    use_transcript = USE_AUDIO_GUARDRAIL and whisper_backend is not None
+    prompt = json.dumps(prompts) if prompts else read_prompt()
+    parts = [content_id, prompt, MODEL_ID, QUANTIZATION, str(MAX_TOKENS), str(use_transcript)]
+    return hashlib.sha256("\0".join(parts).encode()).hexdigest()
+
+
+caption_cache = DiskCache("Caption", CAPTION_CACHE_DIR, CAPTION_CACHE_MAX_MB * MB)
+
+
+# =============================================================================
+# CHAT CONTEXT
+# =============================================================================
+
+CHARS_PER_TOKEN = {"anthropic": 3.5}  # rough ratios when no tokenizer is available; default 4
+SUMMARY_PROMPT = """You compress chat history. Summarize the earlier part of a conversation between a user and an assistant refining video captions or processing steps.
+Keep every decision, requested change, constraint and open question, and the current state of the content. Drop pleasantries. Write terse notes."""
+
+chat_summary_cache = DiskCache("Chat summary", CHAT_SUMMARY_CACHE_DIR, CHAT_SUMMARY_CACHE_MAX_MB * MB)
+_summary_locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+
+@lru_cache(maxsize=8)
+def get_token_encoder(provider: str):
+    if provider != "openai":
+        return None
+    try:
+        import tiktoken  # optional: exact token counts for OpenAI models
+    except ImportError:
+        return None
+    try:
+        return tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        logger.warning(f"tiktoken unavailable, estimating tokens: {e}")
+        return None
+
+
+def count_tokens(text: str, provider: str) -> int:
+    encoder = get_token_encoder(provider)
+    if encoder is not None:
+        return len(encoder.encode(text))
+    return math.ceil(len(text) / CHARS_PER_TOKEN.get(provider, 4.0))
+
+
+def message_tokens(messages: List[dict], provider: str) -> int:
+    return sum(count_tokens(m["content"], provider) + 4 for m in messages)
+
+
+def history_digest(turns: List[dict]) -> str:
+    return hashlib.sha256(json.dumps(turns, sort_keys=True).encode()).hexdigest()
+
+
+async def rolling_summary(job_id: str, older: List[dict]) -> Optional[str]:
+    """Summary of older, extended from the job's cached summary when it covers a prefix.
+
+    The cache stores how many messages the summary covers and their digest,
+    so an edited history is summarized again from scratch.
+    """
+    key = hashlib.sha256(f"chat-summary:{job_id}".encode()).hexdigest()
+    lock = _summary_locks.setdefault(job_id, asyncio.Lock())
+    async with lock:
+        previous, covered = None, 0
+        cached = await asyncio.to_thread(chat_summary_cache.get, key)
+        if cached and cached["covered"] <= len(older) and cached["digest"] == history_digest(older[:cached["covered"]]):
+            if cached["covered"] == len(older):
+                return cached["summary"]
+            previous, covered = cached["summary"], cached["covered"]
+        
+        transcript = "\n\n".join(f"{m['role'].upper()}: {m['content']}" for m in older[covered:])
+        content = f"Summary so far:\n{previous}\n\nLater messages:\n{transcript}" if previous else transcript
+        try:
+            summary = await llm_client.chat(
+                [{"role": "system", "content": SUMMARY_PROMPT}, {"role": "user", "content": content}],
+                max_tokens=CHAT_SUMMARY_MAX_TOKENS, temperature=0)
+        except HTTPException as e:
+            logger.warning(f"[{job_id}] History summary failed: {e.detail}")
+            return None
+        if chat_summary_cache.enabled:
+            try:
+                await asyncio.to_thread(chat_summary_cache.put, key,
+                                        {"covered": len(older), "digest": history_digest(older), "summary": summary})
+            except OSError as e:
+                logger.warning(f"[{job_id}] Chat summary cache write failed: {e}")
+        logger.info(f"[{job_id}] History summary now covers {len(older)} messages")
+        return summary
+
+
+async def build_chat_context(request: "ChatRequest") -> List[dict]:
+    """Chat messages whose history fits CHAT_CONTEXT_TOKENS, counted for the provider likely to serve them.
+
+    The system prompt and initial content are not counted; they stay first
+    so providers can cache that prefix. When the history is too long, the
+    last CHAT_KEEP_MESSAGES stay verbatim and everything before them becomes
+    the job's rolling summary; if that is still over budget, more of the
+    history moves into the summary, CHAT_SUMMARY_STEP messages at a time,
+    down to the last exchange. Nothing is dropped without being summarized:
+    if summarizing fails, the full history is sent.
+    """
+    messages = build_chat_messages(request)
+    if not CHAT_CONTEXT_TOKENS or not llm_client:
+        return messages
+    provider = llm_client.provider
+    history = [{"role": m.role, "content": m.content} for m in request.history]
+    head, current = messages[:len(messages) - len(history) - 1], messages[-1]
+    before = message_tokens(history + [current], provider)
+    if before <= CHAT_CONTEXT_TOKENS:
+        return messages
+    
+    older_count = max(0, len(history) - CHAT_KEEP_MESSAGES) // CHAT_SUMMARY_STEP * CHAT_SUMMARY_STEP
+    while (older_count < len(history) - 2
+           and message_tokens(history[older_count:] + [current], provider) > CHAT_CONTEXT_TOKENS):
+        older_count = min(older_count + CHAT_SUMMARY_STEP, len(history) - 2)
+    summary = await rolling_summary(request.job_id, history[:older_count]) if older_count else None
+    if not summary:
+        logger.warning(f"[{request.job_id}] Chat history over budget ({before} tokens) but not summarized; "
+                       f"sending it in full")
+        return messages
+    
+    summary_message = {"role": "system", "content": f"Summary of the earlier conversation:\n\n{summary}",
+                       "cache": True}
+    recent = history[older_count:]
+    compacted = head + [summary_message] + recent + [current]
+    logger.info(f"[{request.job_id}] Chat history {before} -> "
+                f"{message_tokens([summary_message] + recent + [current], provider)} tokens "
+                f"({older_count} messages summarized, {len(recent)} kept)")
+    return compacted
+
+
+# =============================================================================
+# CHAT CACHE
+# =============================================================================
+
+class ChatResponseCache:
+    """Exact-match cache of chat replies: in-memory LRU plus an optional disk tier.
+
+    Entries expire after CHAT_CACHE_TTL. A request that matches one already
+    in flight waits for that call's reply instead of making its own, and
+    gets its error if the call fails. If the call ends with neither (its
+    client went away), one waiter takes over the call and the rest wait on it.
+    """
+
+    def __init__(self, size: int = CHAT_CACHE_SIZE, ttl: int = CHAT_CACHE_TTL,
+                 directory: str = CHAT_CACHE_DIR, max_bytes: int = CHAT_CACHE_MAX_MB * MB):
+        self.size = size
+        self.ttl = ttl
+        self.disk = DiskCache("Chat response", directory, max_bytes) if directory and size > 0 else None
+        self.hits = self.disk_hits = self.coalesced = self.misses = 0
+        self._memory: "OrderedDict[str, tuple[float, str]]" = OrderedDict()  # key -> (expires_at, text)
+        self._inflight: dict[str, asyncio.Future] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.size > 0
+
+    async def _lookup(self, key: str) -> Optional[str]:
+        entry = self._memory.get(key)
+        if entry and entry[0] > time.time():
+            self._memory.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+        self._memory.pop(key, None)
+        if self.disk:
+            stored = await asyncio.to_thread(self.disk.get, key)
+            if stored and stored["expires_at"] > time.time():
+                self._remember(key, stored["text"], stored["expires_at"])
+                self.disk_hits += 1
+                return stored["text"]
+        return None
+
+    def _remember(self, key: str, text: str, expires_at: float):
+        self._memory[key] = (expires_at, text)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.size:
+            self._memory.popitem(last=False)
+
+    async def get(self, key: str) -> Optional[str]:
+        """Cached reply, or the reply of an identical in-flight call; None on a miss.
+
+        Raises the in-flight call's error if it failed. On None the caller
+        must claim() the key before its next await.
+        """
+        text = await self._lookup(key)
+        if text is not None:
+            return text
+        while (inflight := self._inflight.get(key)) is not None:
+            text = await asyncio.shield(inflight)
+            if text is not None:
+                self.coalesced += 1
+                return text
+        self.misses += 1
+        return None
+
+    def claim(self, key: str):
+        """Mark key as in flight; the caller must release() it."""
+        self._inflight[key] = asyncio.get_running_loop().create_future()
+
+    def release(self, key: str, text: Optional[str], error: Optional[Exception] = None):
+        """Store the reply (None if there is none) and wake waiting requests, raising error in them if given."""
+        future = self._inflight.pop(key, None)
+        if future and not future.done():
+            if error is not None:
+                future.set_exception(error)
+                future.exception()  # retrieved here, so no warning if nobody was waiting
+            else:
+                future.set_result(text)
+        if text is None:
+            return
+        expires_at = time.time() + self.ttl
+        self._remember(key, text, expires_at)
+        if self.disk:
+            # Off the event loop; memory already serves the reply meanwhile
+            asyncio.get_running_loop().run_in_executor(None, self._write, key, text, expires_at)
+
+    def _write(self, key: str, text: str, expires_at: float):
+        try:
+            self.disk.put(key, {"text": text, "expires_at": expires_at})
+        except OSError as e:
+            logger.warning(f"Chat cache write failed: {e}")
+
+    async def get_or_call(self, key: str, call) -> tuple[str, bool]:
+        """(reply, cached) from the cache, an in-flight twin, or await call()."""
+        text = await self.get(key)
+        if text is not None:
+            return text, True
+        self.claim(key)
+        error = None
+        try:
+            text = await call()
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self.release(key, text, error)
+        return text, False
 
+    def stats(self) -> dict:
+        served = self.hits + self.disk_hits + self.coalesced
+        lookups = served + self.misses
+        return {
+            "enabled": self.enabled,
+            "entries": len(self._memory),
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "coalesced": self.coalesced,
+            "misses": self.misses,
+            "hit_rate": round(served / lookups, 4) if lookups else 0.0,
+        }
 
-def unload_model():
-    """Unload model and free memory."""
-    global model, processor
-    model = processor = None
-    if torch.cuda.is_available():
-        torch.cuda.empty_cache()
-    logger.info("Model unloaded")
 
+chat_cache = ChatResponseCache()
 
-def generate_caption(video_path: str, prompt: str, transcript: Optional[str] = None) -> str:
-    """Generate video caption."""
-    if not model or not processor:
-        raise RuntimeError("Model not loaded")
-    
-    # Validate file
-    if not os.path.exists(video_path):
-        raise FileNotFoundError(f"Video not found: {video_path}")
-    
-    ext = os.path.splitext(video_path)[-1].lower()
-    if ext not in VIDEO_EXTENSIONS:
-        raise ValueError(f"Unsupported format: {ext}")
-    
-    # Preprocess video
-    video_path = preprocess_video(video_path)
-    
-    # Build prompt with transcript context
-    full_prompt = prompt
-    if transcript and USE_AUDIO_GUARDRAIL:
-        full_prompt = f"{prompt}\n\nAudio transcript for context:\n{transcript}"
-    
-    # Build messages
-    messages = [{
-        "role": "user",
-        "content": [
-            {"type": "video", "video": video_path},
-            {"type": "text", "text": full_prompt},
-        ],
-    }]
-    
-    # Process inputs
-    text = processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
-    vision_info = process_vision_info(messages)
-    
-    if len(vision_info) == 3:
-        image_inputs, video_inputs, _ = vision_info
-    else:
-        image_inputs, video_inputs = vision_info[:2]
-    
-    inputs = processor(
-        text=[text],
-        images=image_inputs,
-        videos=video_inputs,
-        padding=True,
-        return_tensors="pt",
-    ).to("cuda" if torch.cuda.is_available() else "cpu")
-    
-    # Generate
-    with torch.no_grad():
-        generated_ids = model.generate(**inputs, max_new_tokens=MAX_TOKENS)
-    
-    trimmed_ids = [out[len(inp):] for inp, out in zip(inputs.input_ids, generated_ids)]
-    caption = processor.batch_decode(trimmed_ids, skip_special_tokens=True)[0]
-    
-    logger.info(f"Caption generated ({len(caption)} chars)")
-    return caption
+
+def chat_cache_key(messages: List[dict], max_tokens: int, temperature: float) -> str:
+    """Canonical hash of everything that determines a reply.
+
+    Keyed on every configured (provider, model) rather than the one the
+    router picks, so a reply is reused whichever provider produced it.
+    """
+    parts = {
+        "models": sorted([c.provider, c.model] for c in llm_client.clients) if llm_client else [],
+        "messages": [{"role": m["role"], "content": m["content"]} for m in messages],
+        "max_tokens": max_tokens,
+        "temperature": temperature,
+    }
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+
+def use_chat_cache(request: "ChatRequest", temperature: float) -> bool:
+    if not chat_cache.enabled:
+        return False
+    return request.cache if request.cache is not None else temperature == 0
 
 
 # =============================================================================
-# WEBHOOK
+# LONG VIDEOS
 # =============================================================================
 
-def send_to_webhook(video_url: str, message: str, job_id: Optional[str] = None) -> dict:
-    """Send result to webhook endpoint."""
-    if not CAPTION_RESULT_ENDPOINT:
-        logger.warning("No webhook endpoint configured")
-        return {"status": "no-endpoint"}
-    
-    payload = {"message": message, "id": job_id}
-    
+@dataclass
+class VideoSegment:
+    """One time slice of a long video, captioned on its own."""
+    index: int
+    start: float
+    end: float
+    path: str
+    decoded: Optional[DecodedVideo] = None
+    prepared: Optional[PreparedCaption] = None
+    caption: Optional[str] = None
+    answers: List[str] = field(default_factory=list)  # one per prompt in multi-prompt jobs
+
+
+def is_long_video(probe: Optional[VideoProbe]) -> bool:
+    return bool(LONG_VIDEO_SECONDS > 0 and probe and probe.duration > LONG_VIDEO_SECONDS)
+
+
+def format_timestamp(seconds: float) -> str:
+    minutes, secs = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{secs:02d}" if hours else f"{minutes}:{secs:02d}"
+
+
+async def split_video(video_path: str, duration: float) -> List[VideoSegment]:
+    """Cut the video stream into about SEGMENT_SECONDS pieces without re-encoding.
+
+    Cuts land on keyframes, so the actual boundaries come from ffmpeg's
+    segment list rather than from the requested length.
+    """
+    count = max(1, min(LONG_VIDEO_MAX_SEGMENTS, math.ceil(duration / SEGMENT_SECONDS)))
+    base, ext = os.path.splitext(video_path)
+    list_path = f"{base}_segments.csv"
+    ok = await run_ffmpeg_async([
+        '-v', 'error', '-i', video_path, '-map', '0:v:0', '-c', 'copy',
+        '-f', 'segment', '-segment_time', f'{duration / count:.3f}', '-reset_timestamps', '1',
+        '-segment_list', list_path, '-segment_list_type', 'csv', '-y', f"{base}_seg%03d{ext}"
+    ])
+    segments = []
     try:
-        client = get_http_client()
-        response = client.post(
-            CAPTION_RESULT_ENDPOINT,
-            json=payload,
-            headers=get_webhook_headers(),
-            timeout=RESULT_API_TIMEOUT
-        )
-        response.raise_for_status()
-        logger.info(f"Webhook sent: {response.status_code}")
-        return response.json() if response.headers.get('content-type', '').startswith('application/json') else {"status": "success"}
-    except Exception as e:
-        logger.error(f"Webhook failed: {e}")
-        raise HTTPException(status_code=500, detail=f"Webhook failed: {e}")
+        with open(list_path, encoding='utf-8') as f:
+            for line in f:
+                name, start, end = line.strip().rsplit(',', 2)
+                path = os.path.join(os.path.dirname(video_path), os.path.basename(name))
+                segments.append(VideoSegment(len(segments), float(start), float(end), path))
+    except (OSError, ValueError) as e:
+        logger.warning(f"Could not read segment list for {video_path}: {e}")
+    finally:
+        cleanup_file(list_path)
+    if not ok:
+        for segment in segments:
+            cleanup_file(segment.path)
+        return []
+    return segments
+
+
+def segment_transcript(transcript: Optional[Transcript], start: float, end: float) -> Optional[str]:
+    """Transcript text whose midpoint falls inside [start, end)."""
+    if not transcript:
+        return None
+    text = " ".join(seg["text"].strip() for seg in transcript.segments
+                    if start <= (seg["start"] + seg["end"]) / 2 < end)
+    return text or None
+
+
+def join_segment_captions(segments: List[VideoSegment], captions: Optional[List[str]] = None) -> str:
+    """Per-segment captions (by default each segment's own) under their timestamps."""
+    captions = captions or [seg.caption for seg in segments]
+    return "\n\n".join(f"Segment {seg.index + 1} ({format_timestamp(seg.start)}-{format_timestamp(seg.end)}):\n"
+                       f"{caption}" for seg, caption in zip(segments, captions))
+
+
+async def merge_segment_captions(segments: List[VideoSegment], captions: Optional[List[str]] = None,
+                                 prompt: Optional[str] = None) -> str:
+    """Merge per-segment captions (by default each segment's own) into one caption for the whole video."""
+    messages = [
+        {"role": "system", "content": read_merge_prompt()},
+        {"role": "user", "content": join_segment_captions(segments, captions)
+         + f"\n\nInstructions:\n{prompt or read_prompt()}"},
+    ]
+    return await llm_client.chat(messages, max_tokens=MERGE_MAX_TOKENS, temperature=0)
 
 
 # =============================================================================
 # BACKGROUND JOBS
 # =============================================================================
 
-def process_caption_job(video_url: str, job_id: Optional[str]):
-    """Background job for video captioning."""
-    temp_files = []
+@dataclass
+class CaptionJob:
+    """A caption request and the intermediate results passed between stages."""
+    job_id: str
+    video_url: str
+    status: str = "queued"  # "queued", "running", "done", "failed"
+    stage: Optional[str] = None
+    seq: int = 0
+    submitted_at: float = field(default_factory=time.time)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    error: Optional[str] = None
+    video_path: Optional[str] = None
+    transcript: Optional[str] = None
+    transcript_incomplete: bool = False  # transcription failed or missed chunks
+    merge_error: Optional[str] = None  # long video delivered as timestamped segment captions
+    decoded: Optional[DecodedVideo] = None
+    s3_audio: Optional[asyncio.Task] = None
+    prepared: Optional[PreparedCaption] = None
+    caption: Optional[str] = None
+    prompts: Optional[List[str]] = None  # several prompts answered from one encoding of the video
+    answers: List[str] = field(default_factory=list)  # one per prompt; caption is the first
+    temp_files: List[str] = field(default_factory=list)
+    bypass_cache: bool = False
+    cache_key: Optional[str] = None
+    cache_hit: bool = False
+    skip_to: Optional[str] = None  # stage to jump to, e.g. "deliver" on a cache hit
+    segments: List[VideoSegment] = field(default_factory=list)  # long-video mode
+    degradations: List[dict] = field(default_factory=list)
+    metrics: dict = field(default_factory=dict)
+    bulk: Optional["BulkRequest"] = None  # set for /caption/batch jobs, whose results go out in chunks
+
+
+def check_caption_cache(job: CaptionJob, content_id: str) -> bool:
+    """Set the job's cache key; on a hit, fill in the caption and skip to delivery."""
+    job.cache_key = caption_cache_key(content_id, job.prompts)
+    if job.bypass_cache:
+        return False
+    cached = caption_cache.get(job.cache_key)
+    if cached is None:
+        return False
+    if job.prompts:
+        job.answers = cached
+        cached = cached[0]
+    job.caption = cached
+    job.cache_hit = True
+    job.skip_to = "deliver"
+    logger.info(f"[{job.job_id}] Caption cache hit ({content_id})")
+    return True
+
+
+async def stage_download(job: CaptionJob):
+    """Download the source video to a temp file, unless its caption is cached."""
+    logger.info(f"[{job.job_id}] Starting caption job")
+    # An S3 ETag identifies the content without downloading it
+    if caption_cache.enabled and job.video_url.startswith('s3://'):
+        etag = await get_s3_etag(job.video_url)
+        if etag and await asyncio.to_thread(check_caption_cache, job, f"s3-etag:{etag}"):
+            return
     
+    ext = os.path.splitext(job.video_url.split('?')[0])[-1] or '.mp4'
+    with tempfile.NamedTemporaryFile(delete=False, suffix=ext) as f:
+        job.video_path = f.name
+    job.temp_files.append(job.video_path)
+    
+    # Look up and fetch the separate audio track while the video downloads
+    if (USE_AUDIO_GUARDRAIL and whisper_backend and AUDIO_SOURCE_MODE in ("separate", "both")
+            and job.video_url.startswith('s3://')):
+        job.s3_audio = asyncio.create_task(
+            find_s3_audio(job.video_url, os.path.dirname(job.video_path)))
+    
+    await download_file(job.video_url, job.video_path, job.metrics)
+    
+    if caption_cache.enabled and not job.cache_key:
+        content_id = f"sha256:{await asyncio.to_thread(file_sha256, job.video_path)}"
+        await asyncio.to_thread(check_caption_cache, job, content_id)
+
+
+async def stage_preprocess(job: CaptionJob):
+    """Decode the video, demuxing audio for transcription in the same ffmpeg pass.
+
+    Videos longer than LONG_VIDEO_SECONDS are split into segments that are
+    decoded separately, each with the full visual-token budget.
+    """
+    job.temp_files.append(job.video_path.rsplit('.', 1)[0] + '_preprocessed.mp4')
+    job.temp_files.append(extracted_audio_path(job.video_path))
+    probe = await asyncio.to_thread(probe_video, job.video_path)
+    if is_long_video(probe):
+        if llm_client:
+            await preprocess_segments(job, probe)
+            if job.segments:
+                return
+        logger.warning(f"[{job.job_id}] Long video captioned in one pass "
+                       f"({'segment split failed' if llm_client else 'no LLM client to merge segments'})")
+    demux_audio = (USE_AUDIO_GUARDRAIL and whisper_backend is not None
+                   and AUDIO_SOURCE_MODE in ("extract", "both"))
+    # In "both" mode, skip the demux if the S3 audio track has already arrived
+    if demux_audio and job.s3_audio and job.s3_audio.done() and job.s3_audio.result():
+        demux_audio = False
+    # Frame decoding is CPU-bound, so it is the one step here that needs a thread
+    job.decoded = await asyncio.to_thread(decode_video, job.video_path, job.metrics, demux_audio, probe)
+
+
+async def preprocess_segments(job: CaptionJob, probe: VideoProbe):
+    """Split a long video and decode each segment; leaves job.segments empty on failure."""
+    start = time.monotonic()
+    segments = await split_video(job.video_path, probe.duration)
+    job.temp_files.extend(seg.path for seg in segments)
+    if not segments:
+        return
+    for seg in segments:
+        seg.decoded = await asyncio.to_thread(decode_video, seg.path)
+    job.segments = segments
+    job.metrics["segments"] = {
+        "count": len(segments),
+        "bounds": [[round(seg.start, 3), round(seg.end, 3)] for seg in segments],
+        "visual_tokens": sum(seg.decoded.plan.visual_tokens for seg in segments),
+        "seconds": round(time.monotonic() - start, 3),
+    }
+    logger.info(f"[{job.job_id}] Split {probe.duration:.0f}s video into {len(segments)} segments")
+
+
+async def stage_transcribe(job: CaptionJob):
+    """Transcribe audio if the guardrail is enabled, then build the model inputs.
+
+    In long-video mode each segment gets the part of the transcript that
+    falls inside its time range.
+    """
+    transcript = None
+    if USE_AUDIO_GUARDRAIL and whisper_backend:
+        audio_path = await get_audio_for_video(job.video_path, job.video_url,
+                                               job.decoded.audio_path if job.decoded else None, job.s3_audio)
+        if audio_path:
+            job.temp_files.append(audio_path)
+            transcript = await transcribe_audio(audio_path, job.metrics)
+            job.transcript = transcript.text if transcript else None
+            # Every successful path (cache hit, silence, full transcription) records its time
+            info = job.metrics.get("transcription", {})
+            job.transcript_incomplete = bool(info.get("failed_chunks")) or "seconds" not in info
+    prompt, *extra_prompts = job.prompts or [read_prompt()]
+    if job.segments:
+        for seg in job.segments:
+            seg.prepared = await asyncio.to_thread(build_caption_inputs, seg.decoded, prompt,
+                                                   segment_transcript(transcript, seg.start, seg.end), extra_prompts)
+            seg.decoded = None
+        return
+    job.prepared = await asyncio.to_thread(build_caption_inputs, job.decoded, prompt, job.transcript, extra_prompts)
+    job.decoded = None
+
+
+def stage_deliver(job: CaptionJob):
+    """Cache a fresh caption and queue it for webhook delivery.
+
+    Captions from downscaled retries are delivered with the changes listed
+    under "degraded" and are not cached, so a later request can do better;
+    the same goes for captions written without part of their transcript and
+    long videos whose segment captions could not be merged ("merge_failed").
+    Multi-prompt jobs send the first answer as the message and every
+    answer under "results". Bulk jobs are delivered with their batch.
+    """
+    if (job.cache_key and not job.cache_hit and not job.degradations and not job.transcript_incomplete
+            and not job.merge_error):
+        try:
+            caption_cache.put(job.cache_key, job.answers if job.prompts else job.caption)
+        except OSError as e:
+            logger.warning(f"[{job.job_id}] Caption cache write failed: {e}")
+    if not job.bulk:
+        send_to_webhook(job.video_url, job.caption, job.job_id, caption_result_extra(job) or None)
+    logger.info(f"[{job.job_id}] Caption job completed")
+
+
+def caption_result_extra(job: CaptionJob) -> dict:
+    """Webhook fields that accompany a finished job's caption."""
+    extra = {}
+    if job.prompts:
+        extra["results"] = [{"prompt": prompt, "caption": answer} for prompt, answer in zip(job.prompts, job.answers)]
+    if job.degradations:
+        extra["degraded"] = job.degradations
+    if job.merge_error:
+        extra["merge_failed"] = job.merge_error
+    if job.segments:
+        extra["segments"] = [{"start": round(seg.start, 3), "end": round(seg.end, 3),
+                              **({"captions": seg.answers} if job.prompts else {"caption": seg.caption})}
+                             for seg in job.segments]
+    return extra
+
+
+def fail_caption_job(job: CaptionJob, error: Exception):
+    """Report a failed job to the webhook (best effort)."""
+    logger.error(f"[{job.job_id}] Caption job failed in {job.stage or 'setup'}: {error}")
+    if job.bulk:
+        return  # reported in its batch's next chunk
     try:
-        prompt = read_prompt()
-        logger.info(f"[{job_id}] Starting caption job")
-        
-        # Create temp file for video
-        ext = os.path.splitext(video_url.split('?')[0])[-1] or '.mp4'
-        with tempfile.NamedTemporaryFile(delete=False, suffix=ext) as f:
-            temp_video = f.name
-        temp_files.append(temp_video)
-        
-        # Download video
-        download_file(video_url, temp_video)
-        
-        # Get audio transcript if enabled
-        transcript = None
-        if USE_AUDIO_GUARDRAIL and groq_whisper_client:
-            audio_path = get_audio_for_video(temp_video, video_url)
-            if audio_path:
-                temp_files.append(audio_path)
-                transcript = transcribe_audio(audio_path)
-        
-        # Generate caption
-        caption = generate_caption(temp_video, prompt, transcript)
-        
-        # Send to webhook
-        send_to_webhook(video_url, caption, job_id)
-        logger.info(f"[{job_id}] Caption job completed")
-        
-    except Exception as e:
-        logger.exception(f"[{job_id}] Caption job failed: {e}")
+        send_to_webhook(job.video_url, f"ERROR: {error}", job.job_id)
+    except Exception:
+        pass
+
+
+async def cleanup_job_files(job: CaptionJob):
+    if job.s3_audio:
+        # An unused prefetch still leaves a downloaded file behind
         try:
-            send_to_webhook(video_url, f"ERROR: {e}", job_id)
+            job.temp_files.append(await job.s3_audio)
         except Exception:
             pass
+        job.s3_audio = None
+    for path in job.temp_files:
+        cleanup_file(path)
+    job.temp_files.clear()
+    job.decoded = None
+    job.prepared = None
+    for seg in job.segments:
+        seg.decoded = seg.prepared = None
+
+
+def build_chat_messages(request: "ChatRequest") -> List[dict]:
+    """System prompt, optional initial content, history and the new message."""
+    messages = [{"role": "system", "content": request.system_prompt or CHAT_SYSTEM_PROMPT}]
+    
+    if request.initial_content:
+        messages.append({
+            "role": "system",
+            "content": f"Initial content from user:\n\n{request.initial_content}"
+        })
+    messages[-1]["cache"] = True  # end of the prefix that is identical on every turn
+    
+    messages.extend({"role": m.role, "content": m.content} for m in request.history)
+    messages.append({"role": "user", "content": request.message})
+    return messages
+
+
+async def stream_chat_to_webhook(job_id: str, messages: List[dict], max_tokens: int,
+                                 temperature: float) -> tuple[str, ChatStreamStats]:
+    """Stream a reply, posting the text so far every CHAT_STREAM_INTERVAL_MS or CHAT_STREAM_TOKENS.
+
+    At most one partial post is in flight; deltas arriving meanwhile are
+    coalesced into the next one.
+    """
+    stats = ChatStreamStats()
+    parts: List[str] = []
+    posting: Optional[asyncio.Task] = None
+    last_post, waiting, seq = time.monotonic(), 0, 0
+    try:
+        async for text in llm_client.stream(messages, max_tokens, temperature, stats):
+            parts.append(text)
+            waiting += 1
+            due = (time.monotonic() - last_post) * 1000 >= CHAT_STREAM_INTERVAL_MS or waiting >= CHAT_STREAM_TOKENS
+            if due and (posting is None or posting.done()):
+                seq += 1
+                posting = asyncio.create_task(post_partial_webhook(job_id, "".join(parts), seq))
+                last_post, waiting = time.monotonic(), 0
     finally:
-        # Cleanup temp files
-        for path in temp_files:
-            cleanup_file(path)
-            # Also check for preprocessed version
-            preprocessed = path.rsplit('.', 1)[0] + '_preprocessed.mp4'
-            cleanup_file(preprocessed)
+        # The final result (or error) must not overtake the last partial
+        if posting:
+            await posting
+    chat_metrics.record(job_id, stats, "webhook")
+    return "".join(parts), stats
 
 
-def process_chat_job(request: "ChatRequest"):
+async def process_chat_job(request: "ChatRequest"):
     """Background job for chat."""
     try:
         if not llm_client:
             raise RuntimeError("LLM client not initialized")
         
-        # Build messages
-        messages = [{"role": "system", "content": request.system_prompt or CHAT_SYSTEM_PROMPT}]
-        
-        if request.initial_content:
-            messages.append({
-                "role": "system",
-                "content": f"Initial content from user:\n\n{request.initial_content}"
-            })
-        
-        messages.extend({"role": m.role, "content": m.content} for m in request.history)
-        messages.append({"role": "user", "content": request.message})
+        max_tokens = request.max_tokens or CHAT_MAX_TOKENS
+        temperature = CHAT_TEMPERATURE if request.temperature is None else request.temperature
+        streaming = CHAT_STREAM_WEBHOOK if request.stream is None else request.stream
+        extra = {}
         
-        # Get response
-        response = llm_client.chat(
-            messages,
-            max_tokens=request.max_tokens or CHAT_MAX_TOKENS,
-            temperature=request.temperature or CHAT_TEMPERATURE
-        )
+        async def call() -> str:
+            messages = await build_chat_context(request)
+            if not streaming:
+                return await llm_client.chat(messages, max_tokens=max_tokens, temperature=temperature)
+            response, stats = await stream_chat_to_webhook(request.job_id, messages, max_tokens, temperature)
+            extra["metrics"] = stats.as_dict()
+            return response
         
-        # Send to webhook
-        send_to_webhook("", response, request.job_id)
-        logger.info(f"[{request.job_id}] Chat completed")
+        if use_chat_cache(request, temperature):
+            key = chat_cache_key(build_chat_messages(request), max_tokens, temperature)
+            response, cached = await chat_cache.get_or_call(key, call)
+            if cached:
+                extra["cached"] = True
+        else:
+            response = await call()
+        if streaming:
+            extra["partial"] = False
+        await asyncio.to_thread(send_to_webhook, "", response, request.job_id, extra or None)
+        logger.info(f"[{request.job_id}] Chat completed{' (cached)' if extra.get('cached') else ''}")
         
     except Exception as e:
         logger.exception(f"[{request.job_id}] Chat failed: {e}")
         try:
-            send_to_webhook("", f"ERROR: {e}", request.job_id)
+            await asyncio.to_thread(send_to_webhook, "", f"ERROR: {e}", request.job_id)
         except Exception:
             pass
 
@@ -666,25 +3693,566 @@ def cleanup_file(path: str):
             logger.warning(f"Cleanup failed for {path}: {e}")
 
 
+# =============================================================================
+# CAPTION PIPELINE
+# =============================================================================
+
+class QueueFullError(Exception):
+    """Raised when the caption queue cannot accept more jobs."""
+
+
+class PipelineStage:
+    """Pool of workers pulling jobs from a bounded hand-off queue.
+
+    A finished job is put on the next stage's queue, blocking while that
+    queue is full, so a slow stage backs up into the ones before it.
+    """
+
+    def __init__(self, name: str, handler, workers: int, queue_size: int):
+        self.name = name
+        self.handler = handler  # async callable taking a CaptionJob
+        self.num_workers = max(1, workers)
+        self.queue_size = queue_size
+        self.queue: Optional[asyncio.Queue] = None
+        self.next: Optional["PipelineStage"] = None
+        self.active = 0
+        self._workers: List[asyncio.Task] = []
+        self._callbacks: Optional[tuple] = None
+
+    async def start(self, on_done, on_error):
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+        self._callbacks = (on_done, on_error)
+        self._workers = [asyncio.create_task(self._worker(on_done, on_error))
+                         for _ in range(self.num_workers)]
+
+    def scale(self, workers: int):
+        """Grow the worker pool to `workers`; a started stage starts the new workers at once."""
+        self.num_workers = max(self.num_workers, workers)
+        if self._callbacks:
+            while len(self._workers) < self.num_workers:
+                self._workers.append(asyncio.create_task(self._worker(*self._callbacks)))
+
+    async def stop(self):
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.num_workers,
+            "active": self.active,
+            "queued": self.queue.qsize() if self.queue else 0,
+            "queue_size": self.queue_size,
+        }
+
+    async def _worker(self, on_done, on_error):
+        while True:
+            job = await self.queue.get()
+            if job.status == "queued":
+                job.status = "running"
+                job.started_at = time.time()
+            job.stage = self.name
+            self.active += 1
+            try:
+                await self.handler(job)
+            except Exception as e:
+                await on_error(job, e)
+                continue
+            finally:
+                self.active -= 1
+                self.queue.task_done()
+            nxt = self.next
+            if job.skip_to:
+                while nxt and nxt.name != job.skip_to:
+                    nxt = nxt.next
+                job.skip_to = None
+            if nxt:
+                await nxt.queue.put(job)
+            else:
+                await on_done(job)
+
+
+def threaded(fn):
+    """Adapt a blocking stage function into an async stage handler."""
+    async def handler(job: CaptionJob):
+        await asyncio.to_thread(fn, job)
+    return handler
+
+
+async def stage_generate(job: CaptionJob):
+    """Hand prepared inputs to the least-loaded replica and wait for the caption."""
+    if job.segments:
+        await generate_segments(job)
+        return
+    prepared = job.prepared
+    result = await asyncio.wrap_future(caption_replicas.submit(prepared))
+    job.answers = result if isinstance(result, list) else [result]
+    job.caption = job.answers[0]
+    job.prepared = None
+    if prepared.degradations:
+        job.degradations = prepared.degradations
+        job.metrics["degraded"] = prepared.degradations
+
+
+async def generate_segments(job: CaptionJob):
+    """Caption all segments together, so the batcher can group them, then merge."""
+    captions = await asyncio.gather(*(asyncio.wrap_future(caption_replicas.submit(seg.prepared))
+                                      for seg in job.segments))
+    for seg, result in zip(job.segments, captions):
+        seg.answers = result if isinstance(result, list) else [result]
+        seg.caption = seg.answers[0]
+        job.degradations.extend({"segment": seg.index, **change} for change in seg.prepared.degradations)
+        seg.prepared = None
+    if job.degradations:
+        job.metrics["degraded"] = job.degradations
+    start = time.monotonic()
+    if job.prompts:
+        job.answers = list(await asyncio.gather(*(
+            merge_or_join(job, [seg.answers[i] for seg in job.segments], prompt)
+            for i, prompt in enumerate(job.prompts))))
+        job.caption = job.answers[0]
+    else:
+        job.caption = await merge_or_join(job)
+    job.metrics["segments"]["merge_seconds"] = round(time.monotonic() - start, 3)
+    if job.merge_error:
+        job.metrics["segments"]["merge_error"] = job.merge_error
+
+
+async def merge_or_join(job: CaptionJob, captions: Optional[List[str]] = None,
+                        prompt: Optional[str] = None) -> str:
+    """Merged caption, or the timestamped segment captions if the LLM merge fails."""
+    try:
+        return await merge_segment_captions(job.segments, captions, prompt)
+    except Exception as e:
+        job.merge_error = str(e.detail if isinstance(e, HTTPException) else e)
+        logger.warning(f"[{job.job_id}] Segment merge failed, delivering segment captions: {job.merge_error}")
+        return join_segment_captions(job.segments, captions)
+
+
+def build_caption_stages() -> List[PipelineStage]:
+    handlers = {
+        "download": stage_download,
+        "preprocess": stage_preprocess,
+        "transcribe": stage_transcribe,
+        "generate": stage_generate,
+        "deliver": threaded(stage_deliver),
+    }
+    return [PipelineStage(name, handlers[name], *PIPELINE_CONFIG[name]) for name in handlers]
+
+
+class JobScheduler:
+    """Admission queue, job registry and staged pipeline for caption jobs.
+
+    Download, transcription and preprocessing for upcoming jobs run in their
+    own worker pools while the batcher thread generates, so the GPU does not
+    wait on network or ffmpeg. The first stage's queue is the admission queue.
+    Bulk jobs are tracked by their batch, not in the job registry, so their
+    ids cannot replace /caption jobs or push them out of the history.
+    """
+
+    def __init__(self, stages: List[PipelineStage], history: int = JOB_HISTORY_SIZE):
+        self.stages = stages
+        self.history = history
+        self.jobs: "OrderedDict[str, CaptionJob]" = OrderedDict()
+        self.bulk_jobs: dict[int, CaptionJob] = {}  # seq -> bulk job still in the pipeline
+        self._seq = itertools.count()
+        for stage, nxt in zip(stages, stages[1:]):
+            stage.next = nxt
+
+    @property
+    def max_queue(self) -> int:
+        return self.stages[0].queue_size
+
+    async def start(self):
+        for stage in self.stages:
+            await stage.start(self._on_done, self._on_error)
+        logger.info("Pipeline started: " + ", ".join(
+            f"{s.name}={s.num_workers}w/{s.queue_size}q" for s in self.stages))
+
+    async def stop(self):
+        for stage in self.stages:
+            await stage.stop()
+
+    def submit(self, job_id: str, video_url: str, bypass_cache: bool = False,
+               prompts: Optional[List[str]] = None) -> CaptionJob:
+        """Queue a job, or raise QueueFullError when at capacity."""
+        entry = self.stages[0].queue
+        if entry is None:
+            raise RuntimeError("Scheduler not started")
+
+        existing = self.jobs.get(job_id)
+        if existing and existing.status in ("queued", "running"):
+            return existing
+
+        job = CaptionJob(job_id=job_id, video_url=video_url, seq=next(self._seq),
+                         bypass_cache=bypass_cache, prompts=prompts)
+        try:
+            entry.put_nowait(job)
+        except asyncio.QueueFull:
+            raise QueueFullError(f"Caption queue full ({self.max_queue} jobs)")
+        self._remember(job)
+        return job
+
+    async def enqueue(self, job: CaptionJob):
+        """Queue a job, waiting for room in the admission queue instead of failing."""
+        entry = self.stages[0].queue
+        if entry is None:
+            raise RuntimeError("Scheduler not started")
+        job.seq = next(self._seq)
+        await entry.put(job)
+        self.bulk_jobs[job.seq] = job
+
+    def get(self, job_id: str) -> Optional[CaptionJob]:
+        return self.jobs.get(job_id)
+
+    def stage(self, name: str) -> PipelineStage:
+        return next(stage for stage in self.stages if stage.name == name)
+
+    def position(self, job: CaptionJob) -> Optional[int]:
+        """1-based position in the admission queue, or None once the job has started."""
+        if job.status != "queued":
+            return None
+        return 1 + sum(1 for j in self._all_jobs() if j.status == "queued" and j.seq < job.seq)
+
+    def stats(self) -> dict:
+        return {
+            "queued": sum(1 for j in self._all_jobs() if j.status == "queued"),
+            "running": sum(1 for j in self._all_jobs() if j.status == "running"),
+            "capacity": self.max_queue,
+            "stages": {s.name: s.stats() for s in self.stages},
+        }
+
+    def _all_jobs(self):
+        return itertools.chain(self.jobs.values(), self.bulk_jobs.values())
+
+    def _remember(self, job: CaptionJob):
+        self.jobs[job.job_id] = job
+        self.jobs.move_to_end(job.job_id)
+        # Drop the oldest finished jobs once history is full
+        while len(self.jobs) > self.history:
+            oldest = next((k for k, j in self.jobs.items() if j.status in ("done", "failed")), None)
+            if oldest is None:
+                break
+            del self.jobs[oldest]
+
+    async def _on_done(self, job: CaptionJob):
+        await cleanup_job_files(job)
+        job.status = "done"
+        job.finished_at = time.time()
+        logger.info(f"[{job.job_id}] Finished in {job.finished_at - job.submitted_at:.1f}s")
+        if job.bulk:
+            self.bulk_jobs.pop(job.seq, None)
+            await job.bulk.settle(job)
+
+    async def _on_error(self, job: CaptionJob, error: Exception):
+        job.error = str(error)
+        await asyncio.to_thread(fail_caption_job, job, error)
+        await cleanup_job_files(job)
+        job.status = "failed"
+        job.finished_at = time.time()
+        if job.bulk:
+            self.bulk_jobs.pop(job.seq, None)
+            await job.bulk.settle(job)
+
+
+caption_scheduler = JobScheduler(build_caption_stages())
+
+
+# =============================================================================
+# BULK CAPTIONING
+# =============================================================================
+
+class BulkRequest:
+    """One /caption/batch request: a job per distinct video and the items each serves.
+
+    Results are gathered per item and posted to the webhook in chunks of
+    BULK_RESULT_CHUNK (or after BULK_FLUSH_SECONDS), each entry shaped like
+    a single /caption payload.
+    """
+
+    def __init__(self, batch_id: str, slots: asyncio.Semaphore):
+        self.batch_id = batch_id
+        self.jobs: List[CaptionJob] = []
+        self.items: dict[str, List[tuple[str, str]]] = {}  # job_id -> (item job_id, video_url) served
+        self.total = 0
+        self.fed = self.settled = self.failed = self.cache_hits = self.chunks_sent = 0
+        self.submitted_at = time.time()
+        self.finished_at: Optional[float] = None
+        self._slots = slots
+        self._results: List[dict] = []
+
+    @property
+    def finished(self) -> bool:
+        return self.settled == len(self.jobs)
+
+    def add(self, job: CaptionJob, items: List[tuple[str, str]]):
+        job.bulk = self
+        self.jobs.append(job)
+        self.items[job.job_id] = items
+        self.total += len(items)
+
+    async def settle(self, job: CaptionJob, release_slot: bool = True):
+        """Record a finished job's result for every item it serves; send a chunk when one is due."""
+        for item_id, video_url in self.items[job.job_id]:
+            entry = {"id": item_id, "video_url": video_url}
+            if job.status == "failed":
+                entry["message"] = f"ERROR: {job.error}"
+            else:
+                entry.update(message=job.caption, **caption_result_extra(job))
+            if item_id != job.job_id:
+                entry["duplicate_of"] = job.job_id
+            self._results.append(entry)
+        self.settled += 1
+        self.failed += job.status == "failed"
+        self.cache_hits += job.cache_hit
+        if release_slot:
+            self._slots.release()
+        if self.finished:
+            self.finished_at = time.time()
+            logger.info(f"[batch {self.batch_id}] Finished {len(self.jobs)} jobs "
+                        f"({self.failed} failed) in {self.finished_at - self.submitted_at:.1f}s")
+        if self.finished or len(self._results) >= BULK_RESULT_CHUNK:
+            await self.flush()
+
+    async def flush(self):
+        """Post the results gathered so far, BULK_RESULT_CHUNK per webhook payload."""
+        while self._results:
+            chunk, self._results = self._results[:BULK_RESULT_CHUNK], self._results[BULK_RESULT_CHUNK:]
+            self.chunks_sent += 1
+            extra = {"batch_id": self.batch_id, "chunk": self.chunks_sent,
+                     "final": self.finished and not self._results, "results": chunk, "progress": self.progress()}
+            try:
+                await asyncio.to_thread(send_to_webhook, "", f"{len(chunk)} caption results", self.batch_id, extra)
+            except Exception as e:
+                logger.error(f"[batch {self.batch_id}] Chunk {self.chunks_sent} not queued: {e}")
+
+    def progress(self) -> dict:
+        started = [job for job in self.jobs[:self.fed] if job.status in ("queued", "running")]
+        return {
+            "items": self.total,
+            "unique": len(self.jobs),
+            "duplicates": self.total - len(self.jobs),
+            "waiting": len(self.jobs) - self.fed,
+            "queued": sum(1 for job in started if job.status == "queued"),
+            "running": sum(1 for job in started if job.status == "running"),
+            "done": self.settled - self.failed,
+            "failed": self.failed,
+            "cache_hits": self.cache_hits,
+        }
+
+    def as_dict(self) -> dict:
+        return {
+            "batch_id": self.batch_id,
+            "status": "done" if self.finished else "running",
+            "submitted_at": self.submitted_at,
+            "finished_at": self.finished_at,
+            "chunks_sent": self.chunks_sent,
+            **self.progress(),
+        }
+
+
+class BulkScheduler:
+    """Feeds /caption/batch jobs into the caption pipeline and tracks their batches.
+
+    Items are grouped by video_identity, so repeated URLs and presigned
+    URLs of the same S3 object are captioned once. At most `concurrency`
+    bulk jobs are in the pipeline at a time across all batches; each
+    batch's feeder waits for a slot, so backfills never fill the admission
+    queue that single /caption requests use.
+    """
+
+    def __init__(self, scheduler: JobScheduler, concurrency: int = BULK_CONCURRENCY,
+                 history: int = BULK_HISTORY_SIZE):
+        self.scheduler = scheduler
+        self.concurrency = max(1, concurrency)
+        self.history = history
+        self.batches: "OrderedDict[str, BulkRequest]" = OrderedDict()
+        self._slots = asyncio.Semaphore(self.concurrency)
+        self._tasks: set[asyncio.Task] = set()
+        self._ticker: Optional[asyncio.Task] = None
+
+    def submit(self, batch_id: str, items: List[tuple[str, Optional[str]]], bypass_cache: bool = False,
+               prompts: Optional[List[str]] = None) -> BulkRequest:
+        """Group (video_url, job_id) items into jobs and start feeding them.
+
+        Items without a job_id are numbered within the batch. Resubmitting
+        a batch that is still running returns it unchanged.
+        """
+        existing = self.batches.get(batch_id)
+        if existing and not existing.finished:
+            return existing
+        
+        groups: "OrderedDict[str, List[tuple[str, str]]]" = OrderedDict()
+        for index, (video_url, job_id) in enumerate(items):
+            groups.setdefault(video_identity(video_url), []).append((job_id or f"{batch_id}-{index}", video_url))
+        bulk = BulkRequest(batch_id, self._slots)
+        for members in groups.values():
+            job_id, video_url = members[0]
+            bulk.add(CaptionJob(job_id=job_id, video_url=video_url, bypass_cache=bypass_cache, prompts=prompts),
+                     members)
+        self._remember(bulk)
+        
+        task = asyncio.create_task(self._feed(bulk))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        if self._ticker is None or self._ticker.done():
+            self._ticker = asyncio.create_task(self._tick())
+        logger.info(f"[batch {batch_id}] Accepted {bulk.total} items as {len(bulk.jobs)} jobs")
+        return bulk
+
+    def get(self, batch_id: str) -> Optional[BulkRequest]:
+        return self.batches.get(batch_id)
+
+    def stats(self) -> dict:
+        running = [b for b in self.batches.values() if not b.finished]
+        return {
+            "batches_running": len(running),
+            "jobs_waiting": sum(len(b.jobs) - b.fed for b in running),
+            "jobs_in_pipeline": sum(b.fed - b.settled for b in running),
+            "concurrency": self.concurrency,
+        }
+
+    async def stop(self):
+        for task in [*self._tasks, self._ticker]:
+            if task:
+                task.cancel()
+        await asyncio.gather(*self._tasks, *filter(None, [self._ticker]), return_exceptions=True)
+        # Results already gathered go to the outbox, which survives the restart
+        for bulk in self.batches.values():
+            await bulk.flush()
+
+    async def _feed(self, bulk: BulkRequest):
+        try:
+            for job in bulk.jobs:
+                await self._slots.acquire()
+                await self.scheduler.enqueue(job)
+                bulk.fed += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"[batch {bulk.batch_id}] Feeding stopped after {bulk.fed} jobs: {e}")
+            self._slots.release()  # held for the job that could not be queued
+            for job in bulk.jobs[bulk.fed:]:
+                job.status, job.error = "failed", f"Not scheduled: {e}"
+                await bulk.settle(job, release_slot=False)
+
+    async def _tick(self):
+        """Flush partial chunks, so slow batches still report results regularly."""
+        while any(not b.finished for b in self.batches.values()):
+            await asyncio.sleep(BULK_FLUSH_SECONDS)
+            for bulk in list(self.batches.values()):
+                await bulk.flush()
+
+    def _remember(self, bulk: BulkRequest):
+        self.batches[bulk.batch_id] = bulk
+        self.batches.move_to_end(bulk.batch_id)
+        while len(self.batches) > self.history:
+            oldest = next((k for k, b in self.batches.items() if b.finished), None)
+            if oldest is None:
+                break
+            del self.batches[oldest]
+
+
+caption_bulk = BulkScheduler(caption_scheduler)
+
+
 # =============================================================================
 # FASTAPI APP
 # =============================================================================
 
+class StartupPhases:
+    """Timed startup phases; the instance is ready once all have finished."""
+
+    def __init__(self):
+        self.timings: dict[str, float] = {}
+        self.current: Optional[str] = None
+        self.ready = False
+        self.error: Optional[str] = None
+        self._start = time.monotonic()
+
+    @contextmanager
+    def phase(self, name: str):
+        self.current = name
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.timings[name] = round(time.monotonic() - start, 3)
+            logger.info(f"Startup phase {name}: {self.timings[name]:.2f}s")
+
+    def finish(self):
+        self.current = None
+        self.ready = True
+        logger.info(f"Ready after {time.monotonic() - self._start:.2f}s ({self.timings})")
+
+    def fail(self, error: Exception):
+        self.error = f"{self.current}: {error}"
+        logger.error(f"Startup failed in {self.error}")
+        self.current = None
+
+    def as_dict(self) -> dict:
+        return {
+            "ready": self.ready,
+            "phase": "failed" if self.error else self.current or ("ready" if self.ready else "starting"),
+            "error": self.error,
+            "timings": self.timings,
+        }
+
+
+startup_phases = StartupPhases()
+
+
+async def run_startup():
+    """Slow startup work, run after the server is already answering /health/live."""
+    try:
+        if SERVES_CHAT or (SERVES_CAPTIONS and LONG_VIDEO_SECONDS > 0):  # long videos merge via the LLM
+            with startup_phases.phase("llm_clients"):
+                init_llm_client()
+        if SERVES_CAPTIONS:
+            with startup_phases.phase("whisper_client"):
+                init_whisper_client()
+            with startup_phases.phase("model_load"):
+                caption_replicas.configure(await asyncio.to_thread(resolve_caption_devices))
+                if not PIPELINE_CONFIG["generate"][0]:
+                    caption_scheduler.stage("generate").scale(len(caption_replicas.replicas) * 2 * BATCH_MAX_SIZE)
+                caption_replicas.start()
+                await caption_replicas.load()
+            if WARMUP_RUNS > 0:
+                with startup_phases.phase("warmup"):
+                    await warmup_model()
+        startup_phases.finish()
+    except Exception as e:
+        startup_phases.fail(e)
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Startup and shutdown events."""
-    logger.info("Starting up...")
-    init_llm_client()
-    init_whisper_client()
-    try:
-        load_model()
-    except Exception as e:
-        logger.error(f"Model load failed: {e}")
+    logger.info(f"Starting up (role={SERVICE_ROLE})...")
+    with startup_phases.phase("services"):
+        if SERVES_CAPTIONS:
+            await asyncio.gather(asyncio.to_thread(caption_cache.open), asyncio.to_thread(transcript_cache.open))
+        if SERVES_CHAT:
+            await asyncio.to_thread(chat_summary_cache.open)
+            if chat_cache.disk:
+                await asyncio.to_thread(chat_cache.disk.open)
+        await webhook_outbox.start()
+        if SERVES_CAPTIONS:
+            await caption_scheduler.start()
+    startup = asyncio.create_task(run_startup())
     yield
     logger.info("Shutting down...")
-    unload_model()
+    startup.cancel()
+    if SERVES_CAPTIONS:
+        await caption_bulk.stop()
+        await caption_scheduler.stop()
+        caption_replicas.stop()
+    await webhook_outbox.stop()
+    if SERVES_CAPTIONS:
+        caption_replicas.unload()
     if http_client:
-        http_client.close()
+        await http_client.aclose()
 
 
 app = FastAPI(
@@ -693,6 +4261,8 @@ app = FastAPI(
     version="2.0.0",
     lifespan=lifespan
 )
+caption_router = APIRouter(tags=["caption"])
+chat_router = APIRouter(tags=["chat"])
 
 
 # =============================================================================
@@ -702,6 +4272,9 @@ app = FastAPI(
 class CaptionRequest(BaseModel):
     video_url: str = Field(..., description="S3 path or presigned URL to video")
     job_id: Optional[str] = Field(None, description="Job tracking ID")
+    bypass_cache: bool = Field(False, description="Skip the caption cache lookup")
+    prompts: Optional[List[str]] = Field(None, description="Prompts to answer from one encoding of the video, "
+                                                           "instead of the configured prompt")
 
 
 class CaptionResponse(BaseModel):
@@ -712,6 +4285,26 @@ class CaptionResponse(BaseModel):
     error: Optional[str] = None
 
 
+class CaptionBatchItem(BaseModel):
+    video_url: str = Field(..., description="S3 path or presigned URL to video")
+    job_id: Optional[str] = Field(None, description="Job tracking ID (default: <batch_id>-<index>)")
+
+
+class CaptionBatchRequest(BaseModel):
+    items: List[CaptionBatchItem] = Field(..., description="Videos to caption")
+    batch_id: Optional[str] = Field(None, description="Batch tracking ID")
+    bypass_cache: bool = Field(False, description="Skip the caption cache lookup")
+    prompts: Optional[List[str]] = Field(None, description="Prompts to answer for every video")
+
+
+class CaptionBatchResponse(BaseModel):
+    status: str
+    batch_id: str
+    items: int
+    unique: int
+    duplicates: int
+
+
 class ChatMessage(BaseModel):
     role: Literal["user", "assistant", "system"]
     content: str
@@ -725,6 +4318,10 @@ class ChatRequest(BaseModel):
     system_prompt: Optional[str] = None
     max_tokens: Optional[int] = None
     temperature: Optional[float] = None
+    stream: Optional[bool] = Field(None, description="Post partial replies to the webhook "
+                                                      "(default: CHAT_STREAM_WEBHOOK)")
+    cache: Optional[bool] = Field(None, description="Use the response cache "
+                                                     "(default: only when temperature is 0)")
 
 
 class ChatResponse(BaseModel):
@@ -744,52 +4341,156 @@ async def root():
     return {
         "service": "Video Caption API",
         "version": "2.0.0",
-        "model": MODEL_ID,
+        "role": SERVICE_ROLE,
+        "model": MODEL_ID if SERVES_CAPTIONS else None,
         "status": "running"
     }
 
 
+@app.get("/health/live")
+async def health_live():
+    """Liveness: the process is up and serving requests."""
+    return {"status": "alive"}
+
+
+@app.get("/health/ready")
+async def health_ready():
+    """Readiness: 200 once startup (model load and warm-up) has finished, else 503."""
+    info = startup_phases.as_dict()
+    if not startup_phases.ready:
+        raise HTTPException(503, info)
+    return {"status": "ready", **info}
+
+
 @app.get("/health")
 async def health():
-    """Health check."""
-    loaded = model is not None and processor is not None
-    return {
-        "status": "healthy" if loaded else "degraded",
-        "model_loaded": loaded,
-        "llm_available": llm_client is not None,
-        "whisper_available": groq_whisper_client is not None,
-        "cuda": torch.cuda.is_available()
-    }
+    """Health check, covering only the subsystems this role runs; healthy only once startup has finished."""
+    info = {"role": SERVICE_ROLE, "startup": startup_phases.as_dict(), "webhooks": await asyncio.to_thread(webhook_outbox.stats)}
+    if SERVES_CAPTIONS:
+        loaded = caption_replicas.loaded
+        cuda = None
+        if loaded:  # torch is imported by then; importing it here would stall the loop
+            import torch
+            cuda = torch.cuda.is_available()
+        info.update({
+            "model_loaded": loaded,
+            "whisper_available": whisper_backend is not None,
+            "cuda": cuda,
+            "queue": caption_scheduler.stats(),
+            "bulk": caption_bulk.stats(),
+            "batching": caption_replicas.metrics(),
+            "replicas": caption_replicas.as_dict(),
+            "caption_cache": caption_cache.stats(),
+            "transcript_cache": transcript_cache.stats(),
+            "downloads": download_metrics.stats(),
+        })
+    if SERVES_CHAT:
+        info.update({
+            "llm_available": llm_client is not None,
+            "llm": llm_client.as_dict() if llm_client else None,
+            "chat_streams": chat_metrics.stats(),
+            "chat_cache": chat_cache.stats(),
+        })
+    ok = startup_phases.ready and (info["model_loaded"] if SERVES_CAPTIONS else info["llm_available"])
+    return {"status": "healthy" if ok else "degraded", **info}
+
+
+def check_prompts(prompts: Optional[List[str]]):
+    if prompts is not None and not (0 < len(prompts) <= MAX_PROMPTS and all(p.strip() for p in prompts)):
+        raise HTTPException(400, f"prompts must list 1 to {MAX_PROMPTS} non-empty prompts")
 
 
-@app.post("/caption", response_model=CaptionResponse)
+@caption_router.post("/caption", response_model=CaptionResponse)
 async def create_caption(
-    background_tasks: BackgroundTasks,
     body: Optional[CaptionRequest] = Body(None),
     video_url: Optional[str] = Query(None),
-    job_id: Optional[str] = Query(None)
+    job_id: Optional[str] = Query(None),
+    bypass_cache: bool = Query(False)
 ):
     """
     Generate caption for a video (async).
     Returns immediately; result sent to webhook.
+    With `prompts` in the body, every prompt is answered from one decode
+    of the video and all answers arrive in one webhook payload.
+    Responds 503 with Retry-After when the caption queue is full.
     """
     url = body.video_url if body else video_url
-    jid = body.job_id if body else job_id
+    jid = (body.job_id if body else job_id) or uuid.uuid4().hex
+    bypass = body.bypass_cache if body else bypass_cache
+    prompts = body.prompts if body else None
     
     if not url:
         raise HTTPException(400, "video_url required")
+    check_prompts(prompts)
+    if not startup_phases.ready:
+        raise HTTPException(503, "Starting up", headers={"Retry-After": str(QUEUE_RETRY_AFTER)})
     
-    background_tasks.add_task(process_caption_job, url, jid)
+    try:
+        job = caption_scheduler.submit(jid, url, bypass_cache=bypass, prompts=prompts)
+    except QueueFullError as e:
+        raise HTTPException(503, str(e), headers={"Retry-After": str(QUEUE_RETRY_AFTER)})
     
     return CaptionResponse(
         status="accepted",
         job_id=jid,
         video_url=url,
-        message="Processing started"
+        message=f"Queued at position {caption_scheduler.position(job)}"
+                if job.status == "queued" else f"Job already {job.status}"
     )
 
 
-@app.post("/chat", response_model=ChatResponse)
+@caption_router.post("/caption/batch", response_model=CaptionBatchResponse)
+async def create_caption_batch(body: CaptionBatchRequest):
+    """
+    Caption many videos (async).
+    Repeated URLs, and presigned URLs of the same S3 object, are captioned
+    once. Results are sent to the webhook in chunks, each entry shaped like
+    a /caption result; progress is at /caption/batch/{batch_id}.
+    """
+    if not 0 < len(body.items) <= BULK_MAX_ITEMS:
+        raise HTTPException(400, f"items must list 1 to {BULK_MAX_ITEMS} videos")
+    job_ids = [item.job_id for item in body.items if item.job_id]
+    if len(job_ids) != len(set(job_ids)):
+        raise HTTPException(400, "job_id values must be unique within a batch")
+    check_prompts(body.prompts)
+    if not startup_phases.ready:
+        raise HTTPException(503, "Starting up", headers={"Retry-After": str(QUEUE_RETRY_AFTER)})
+    
+    bulk = caption_bulk.submit(body.batch_id or uuid.uuid4().hex,
+                               [(item.video_url, item.job_id) for item in body.items],
+                               bypass_cache=body.bypass_cache, prompts=body.prompts)
+    return CaptionBatchResponse(status="accepted", batch_id=bulk.batch_id, items=bulk.total,
+                                unique=len(bulk.jobs), duplicates=bulk.total - len(bulk.jobs))
+
+
+@caption_router.get("/caption/batch/{batch_id}")
+async def get_caption_batch(batch_id: str):
+    """Progress of a caption batch."""
+    bulk = caption_bulk.get(batch_id)
+    if not bulk:
+        raise HTTPException(404, f"Unknown batch: {batch_id}")
+    return bulk.as_dict()
+
+
+@caption_router.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """Caption job status and queue position (batch items are reported by their batch)."""
+    job = caption_scheduler.get(job_id)
+    if not job:
+        raise HTTPException(404, f"Unknown job: {job_id}")
+    return {
+        "job_id": job.job_id,
+        "status": job.status,
+        "queue_position": caption_scheduler.position(job),
+        "submitted_at": job.submitted_at,
+        "started_at": job.started_at,
+        "finished_at": job.finished_at,
+        "error": job.error,
+        "metrics": job.metrics,
+    }
+
+
+@chat_router.post("/chat", response_model=ChatResponse)
 async def chat(
     background_tasks: BackgroundTasks,
     body: Optional[ChatRequest] = Body(None),
@@ -816,23 +4517,116 @@ async def chat(
     )
 
 
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@chat_router.post("/chat/stream")
+async def chat_stream(request: ChatRequest):
+    """
+    Chat over Server-Sent Events.
+    Streams "delta" events as text arrives, then "done" with the full reply
+    and its timings (or "error"). The reply also goes to the webhook.
+    """
+    if not llm_client:
+        raise HTTPException(503, "LLM client not initialized")
+    max_tokens = request.max_tokens or CHAT_MAX_TOKENS
+    temperature = CHAT_TEMPERATURE if request.temperature is None else request.temperature
+    key = None
+    if use_chat_cache(request, temperature):
+        key = chat_cache_key(build_chat_messages(request), max_tokens, temperature)
+    
+    async def events():
+        try:
+            cached = await chat_cache.get(key) if key else None
+        except HTTPException as e:  # the identical call this one waited on failed
+            await asyncio.to_thread(send_to_webhook, "", f"ERROR: {e.detail}", request.job_id)
+            yield sse_event("error", {"error": e.detail})
+            return
+        if cached is not None:
+            await asyncio.to_thread(send_to_webhook, "", cached, request.job_id, {"cached": True})
+            yield sse_event("delta", {"text": cached})
+            yield sse_event("done", {"message": cached, "cached": True})
+            return
+        
+        stats = ChatStreamStats()
+        parts = []
+        reply = error = None
+        if key:
+            chat_cache.claim(key)
+        try:
+            messages = await build_chat_context(request)
+            async for text in llm_client.stream(messages, max_tokens, temperature, stats):
+                parts.append(text)
+                yield sse_event("delta", {"text": text})
+            reply = "".join(parts)
+        except HTTPException as e:
+            error = e
+            await asyncio.to_thread(send_to_webhook, "", f"ERROR: {e.detail}", request.job_id)
+            yield sse_event("error", {"error": e.detail})
+            return
+        finally:
+            if key:
+                chat_cache.release(key, reply, error)
+        chat_metrics.record(request.job_id, stats, "sse")
+        await asyncio.to_thread(send_to_webhook, "", reply, request.job_id, {"metrics": stats.as_dict()})
+        yield sse_event("done", {"message": reply, "metrics": stats.as_dict()})
+    
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
 @app.get("/config")
 async def get_config():
     """Current configuration."""
     return {
+        "service_role": SERVICE_ROLE,
         "model_id": MODEL_ID,
         "quantization": QUANTIZATION,
         "attention_impl": ATTENTION_IMPL,
         "max_tokens": MAX_TOKENS,
+        "resolution_mode": RESOLUTION_MODE,
+        "frame_decode_mode": FRAME_DECODE_MODE,
+        "frame_select": FRAME_SELECT,
+        "caption_devices": [r.device for r in caption_replicas.replicas],
+        "generation_compile": GENERATION_COMPILE,
+        "max_prompts": MAX_PROMPTS,
+        "bulk_concurrency": BULK_CONCURRENCY,
+        "bulk_result_chunk": BULK_RESULT_CHUNK,
+        "prefix_cache": PREFIX_CACHE,
+        "warmup_runs": WARMUP_RUNS,
         "llm_provider": LLM_PROVIDER,
         "llm_model": llm_client.model if llm_client else None,
+        "llm_providers": [c.provider for c in llm_client.clients] if llm_client else [],
+        "llm_hedge": LLM_HEDGE,
+        "chat_cache_size": CHAT_CACHE_SIZE,
+        "chat_cache_ttl": CHAT_CACHE_TTL,
         "audio_guardrail": USE_AUDIO_GUARDRAIL,
         "audio_source_mode": AUDIO_SOURCE_MODE,
         "whisper_model": WHISPER_MODEL,
-        "whisper_available": groq_whisper_client is not None
+        "whisper_available": whisper_backend is not None,
+        "whisper_backend": WHISPER_BACKEND,
+        "transcribe_chunk_seconds": TRANSCRIBE_CHUNK_SECONDS,
+        "transcribe_concurrency": TRANSCRIBE_CONCURRENCY,
+        "caption_cache_max_mb": CAPTION_CACHE_MAX_MB,
+        "webhook_concurrency": WEBHOOK_CONCURRENCY,
+        "webhook_batch_size": WEBHOOK_BATCH_SIZE,
+        "webhook_dead_retention_hours": WEBHOOK_DEAD_RETENTION_HOURS,
+        "pipeline": {stage.name: {"workers": stage.num_workers, "queue_size": stage.queue_size}
+                     for stage in caption_scheduler.stages},
+        "caption_queue_size": CAPTION_QUEUE_SIZE,
+        "batch_max_size": BATCH_MAX_SIZE,
+        "batch_max_wait_ms": BATCH_MAX_WAIT_MS,
+        "batch_max_visual_tokens": BATCH_MAX_VISUAL_TOKENS,
     }
 
 
+if SERVES_CAPTIONS:
+    app.include_router(caption_router)
+if SERVES_CHAT:
+    app.include_router(chat_router)
+
+
 # =============================================================================
 # MAIN
 # =============================================================================
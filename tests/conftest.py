@@ -0,0 +1,23 @@
+"""Test setup for server5.
+
+Run from the repository root with `python -m pytest tests`. The S3 tests
+need moto (`pip install "moto[server]"`) and are skipped without it.
+"""
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Keep caches and the webhook outbox out of the working tree; set before server5 is imported
+_state_dir = tempfile.mkdtemp(prefix="server5-tests-")
+for name, default in {
+    "CAPTION_CACHE_DIR": "caption_cache",
+    "TRANSCRIPT_CACHE_DIR": "transcript_cache",
+    "CHAT_SUMMARY_CACHE_DIR": "chat_summaries",
+    "WEBHOOK_OUTBOX_PATH": "webhook_outbox.db",
+}.items():
+    os.environ.setdefault(name, os.path.join(_state_dir, default))
+# Set even if empty, so load_dotenv cannot inject a real webhook URL from .env
+os.environ["RESPONSE_WEBHOOK_URL"] = ""
@@ -0,0 +1,64 @@
+"""Coalescing of identical in-flight chat calls in ChatResponseCache."""
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+import server5
+
+
+def cache():
+    return server5.ChatResponseCache(size=16, ttl=60, directory="")
+
+
+def counting_call(calls, result):
+    async def call():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        if isinstance(result, Exception):
+            raise result
+        return result
+    return call
+
+
+def test_identical_calls_share_one_reply():
+    calls = []
+
+    async def run():
+        chat_cache = cache()
+        return await asyncio.gather(*(chat_cache.get_or_call("k", counting_call(calls, "hi")) for _ in range(5)))
+
+    assert asyncio.run(run()) == [("hi", False)] + [("hi", True)] * 4
+    assert len(calls) == 1
+
+
+def test_waiters_get_the_leaders_error():
+    calls = []
+    error = HTTPException(status_code=500, detail="LLM API error: all providers failed")
+
+    async def run():
+        chat_cache = cache()
+        return await asyncio.gather(*(chat_cache.get_or_call("k", counting_call(calls, error)) for _ in range(5)),
+                                    return_exceptions=True)
+
+    assert all(result is error for result in asyncio.run(run()))
+    assert len(calls) == 1
+
+
+def test_one_waiter_takes_over_when_the_leader_goes_away():
+    calls = []
+
+    async def run():
+        chat_cache = cache()
+        leader = asyncio.create_task(chat_cache.get_or_call("k", counting_call(calls, "first")))
+        await asyncio.sleep(0.01)
+        waiters = [asyncio.create_task(chat_cache.get_or_call("k", counting_call(calls, "second")))
+                   for _ in range(4)]
+        await asyncio.sleep(0.01)
+        leader.cancel()  # e.g. its SSE client disconnected
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return await asyncio.gather(*waiters)
+
+    assert asyncio.run(run()) == [("second", False)] + [("second", True)] * 3
+    assert len(calls) == 2
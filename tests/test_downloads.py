@@ -0,0 +1,190 @@
+"""Ranged HTTP downloads and the s3:// presign path."""
+import asyncio
+import os
+
+import httpx
+import pytest
+
+import server5
+
+MB = server5.MB
+
+
+def mock_client(monkeypatch, handler):
+    """Route server5's shared HTTP client through an in-process handler."""
+    client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    monkeypatch.setattr(server5, "http_client", client)
+    return client
+
+
+def byte_range(request: httpx.Request) -> tuple[int, int]:
+    start, end = request.headers["range"].removeprefix("bytes=").split("-")
+    return int(start), int(end)
+
+
+def test_ranged_download_reassembles_parts(monkeypatch, tmp_path):
+    monkeypatch.setattr(server5, "DOWNLOAD_PART_MB", 1)
+    body = os.urandom(3 * MB + 123)
+
+    def handler(request):
+        start, end = byte_range(request)
+        return httpx.Response(206, content=body[start:end + 1])
+
+    mock_client(monkeypatch, handler)
+    path = tmp_path / "out.bin"
+    parts = asyncio.run(server5.download_http_ranged("http://test/video", str(path), len(body)))
+    assert parts == 4
+    assert path.read_bytes() == body
+
+
+def test_ranged_download_rejects_short_read(monkeypatch, tmp_path):
+    monkeypatch.setattr(server5, "DOWNLOAD_PART_MB", 1)
+    size = 2 * MB
+
+    def handler(request):
+        start, end = byte_range(request)
+        return httpx.Response(206, content=b"x" * (end - start))  # one byte short
+
+    mock_client(monkeypatch, handler)
+    with pytest.raises(OSError, match="Short read"):
+        asyncio.run(server5.download_http_ranged("http://test/video", str(tmp_path / "out.bin"), size))
+
+
+def test_ranged_download_rejects_ignored_range(monkeypatch, tmp_path):
+    monkeypatch.setattr(server5, "DOWNLOAD_PART_MB", 1)
+    size = 2 * MB
+    mock_client(monkeypatch, lambda request: httpx.Response(200, content=b"x" * size))
+    with pytest.raises(OSError, match="not honoured"):
+        asyncio.run(server5.download_http_ranged("http://test/video", str(tmp_path / "out.bin"), size))
+
+
+def test_failed_part_cancels_others_before_closing_file(monkeypatch, tmp_path):
+    monkeypatch.setattr(server5, "DOWNLOAD_PART_MB", 1)
+    size = 4 * MB
+    cancelled = []
+    closed = set()
+    real_close, real_pwrite = os.close, os.pwrite
+
+    def close(fd):
+        closed.add(fd)
+        real_close(fd)
+
+    def pwrite(fd, data, offset):
+        assert fd not in closed, "part wrote after the file was closed"
+        return real_pwrite(fd, data, offset)
+
+    monkeypatch.setattr(os, "close", close)
+    monkeypatch.setattr(os, "pwrite", pwrite)
+
+    async def handler(request):
+        start, end = byte_range(request)
+        if start == 0:
+            return httpx.Response(500)
+        try:
+            await asyncio.sleep(30)
+        except asyncio.CancelledError:
+            cancelled.append(start)
+            raise
+        return httpx.Response(206, content=b"x" * (end - start + 1))
+
+    mock_client(monkeypatch, handler)
+    with pytest.raises(httpx.HTTPStatusError):
+        asyncio.run(asyncio.wait_for(
+            server5.download_http_ranged("http://test/video", str(tmp_path / "out.bin"), size), timeout=10))
+    assert sorted(cancelled) == [MB, 2 * MB, 3 * MB]
+
+
+def range_server(body, requests, honour_range=True):
+    def handler(request):
+        requests.append(request.headers.get("range"))
+        if not (honour_range and "range" in request.headers):
+            return httpx.Response(200, content=body)
+        start, _, end = request.headers["range"].removeprefix("bytes=").partition("-")
+        start, end = int(start), min(int(end or len(body) - 1), len(body) - 1)
+        return httpx.Response(206, content=body[start:end + 1],
+                              headers={"content-range": f"bytes {start}-{end}/{len(body)}"})
+    return handler
+
+
+@pytest.mark.parametrize("size_mb, parallel_min_mb, mode, ranges", [
+    (0.5, 16, "stream", ["bytes=0-1048575"]),
+    (2.5, 16, "stream", ["bytes=0-1048575", "bytes=1048576-"]),
+    (2.5, 2, "ranged", ["bytes=0-1048575", "bytes=1048576-2097151", "bytes=2097152-2621439"]),
+])
+def test_first_part_doubles_as_range_probe(monkeypatch, tmp_path, size_mb, parallel_min_mb, mode, ranges):
+    monkeypatch.setattr(server5, "DOWNLOAD_PART_MB", 1)
+    monkeypatch.setattr(server5, "DOWNLOAD_PARALLEL_MIN_MB", parallel_min_mb)
+    body, requests = os.urandom(int(size_mb * MB)), []
+    mock_client(monkeypatch, range_server(body, requests))
+    path = tmp_path / "out.bin"
+    result = asyncio.run(server5.download_http("http://test/video", str(path)))
+    assert result == (mode, len(ranges))
+    assert sorted(requests) == ranges
+    assert path.read_bytes() == body
+
+
+def test_server_ignoring_range_is_downloaded_in_one_request(monkeypatch, tmp_path):
+    monkeypatch.setattr(server5, "DOWNLOAD_PART_MB", 1)
+    monkeypatch.setattr(server5, "DOWNLOAD_PARALLEL_MIN_MB", 1)
+    body, requests = os.urandom(3 * MB), []
+    mock_client(monkeypatch, range_server(body, requests, honour_range=False))
+    path = tmp_path / "out.bin"
+    assert asyncio.run(server5.download_http("http://test/video", str(path))) == ("stream", 1)
+    assert len(requests) == 1
+    assert path.read_bytes() == body
+
+
+@pytest.fixture
+def s3_server(monkeypatch):
+    """A moto S3 server, with server5 pointed at it through S3_ENDPOINT_URL."""
+    moto_server = pytest.importorskip("moto.server")
+    server = moto_server.ThreadedMotoServer(ip_address="127.0.0.1", port=0)
+    server.start()
+    host, port = server.get_host_and_port()
+    monkeypatch.setattr(server5, "S3_ENDPOINT_URL", f"http://{host}:{port}")
+    monkeypatch.setattr(server5, "AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setattr(server5, "AWS_SECRET_ACCESS_KEY", "testing")
+    server5.get_s3_client.cache_clear()
+    monkeypatch.setattr(server5, "http_client", None)
+    try:
+        yield server5.get_s3_client()
+    finally:
+        server5.get_s3_client.cache_clear()
+        server.stop()
+
+
+@pytest.mark.parametrize("parallel_min_mb, mode", [(1, "s3-ranged"), (1024, "s3-stream")])
+def test_s3_download_through_presigned_url(s3_server, monkeypatch, tmp_path, parallel_min_mb, mode):
+    monkeypatch.setattr(server5, "DOWNLOAD_PART_MB", 1)
+    monkeypatch.setattr(server5, "DOWNLOAD_PARALLEL_MIN_MB", parallel_min_mb)
+    body = os.urandom(2 * MB + 7)
+    s3_server.create_bucket(Bucket="videos")
+    s3_server.put_object(Bucket="videos", Key="clips/a.mp4", Body=body)
+
+    async def run():
+        stats = {}
+        try:
+            await server5.download_file("s3://videos/clips/a.mp4", str(tmp_path / "a.mp4"), stats)
+            etag = await server5.get_s3_etag("s3://videos/clips/a.mp4")
+        finally:
+            await server5.http_client.aclose()
+        return stats, etag
+
+    stats, etag = asyncio.run(run())
+    assert (tmp_path / "a.mp4").read_bytes() == body
+    assert stats["download"]["mode"] == mode
+    assert etag
+
+
+def test_s3_download_of_missing_object_is_a_400(s3_server, tmp_path):
+    s3_server.create_bucket(Bucket="videos")
+
+    async def run():
+        try:
+            await server5.download_file("s3://videos/missing.mp4", str(tmp_path / "m.mp4"))
+        finally:
+            await server5.http_client.aclose()
+
+    with pytest.raises(server5.HTTPException) as error:
+        asyncio.run(run())
+    assert error.value.status_code == 400
@@ -0,0 +1,157 @@
+"""LLM provider failover, hedging and circuit breaking against a local stub server."""
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from fastapi import HTTPException
+
+import server5
+
+PROVIDERS = ("openai", "together", "openrouter")
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """OpenAI-style /chat/completions; the first path segment names the provider."""
+
+    def do_POST(self):
+        provider = self.path.split("/")[1]
+        self.rfile.read(int(self.headers.get("content-length", 0)))
+        self.server.calls.append(provider)
+        behaviour = self.server.behaviour.get(provider, {})
+        time.sleep(behaviour.get("delay", 0))
+        status = behaviour.get("status", 200)
+        if status == 200:
+            body = {"id": "stub", "object": "chat.completion", "created": 0, "model": "stub",
+                    "choices": [{"index": 0, "finish_reason": "stop",
+                                 "message": {"role": "assistant", "content": f"{provider} reply"}}]}
+        else:
+            body = {"error": {"message": f"{provider} returned {status}", "type": "stub"}}
+        data = json.dumps(body).encode()
+        try:
+            self.send_response(status)
+            self.send_header("content-type", "application/json")
+            self.send_header("content-length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        except OSError:
+            pass  # the client gave up on this call (a lost hedge)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stub(monkeypatch):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    server.daemon_threads = True
+    server.calls, server.behaviour = [], {}
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    for name in PROVIDERS:
+        config = server5.LLM_CONFIGS[name]
+        monkeypatch.setenv(config["api_key_env"], "test-key")
+        monkeypatch.setenv(config["base_url_env"], f"http://127.0.0.1:{server.server_port}/{name}/v1")
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def router(*names):
+    return server5.LLMRouter([server5.LLMClient(name) for name in names])
+
+
+def chat(llm) -> str:
+    return asyncio.run(llm.chat([{"role": "user", "content": "hi"}]))
+
+
+def test_default_pool_is_the_configured_provider(stub, monkeypatch):
+    monkeypatch.setattr(server5, "LLM_PROVIDERS", [])
+    monkeypatch.setattr(server5, "LLM_PROVIDER", "together")
+    monkeypatch.setattr(server5, "llm_client", None)
+    server5.init_llm_client()
+    assert [c.provider for c in server5.llm_client.clients] == ["together"]
+
+
+def test_unmeasured_providers_keep_configured_order(stub):
+    llm = router("together", "openai", "openrouter")
+    assert [c.provider for c in llm.ranked()] == ["together", "openai", "openrouter"]
+    assert chat(llm) == "together reply"
+
+
+def test_fails_over_to_next_provider(stub):
+    stub.behaviour["openai"] = {"status": 500}
+    llm = router("openai", "together")
+    assert chat(llm) == "together reply"
+    assert stub.calls == ["openai", "together"]  # no SDK retries against the failing provider
+    assert llm.stats["openai"].failures == 1
+    assert [c.provider for c in llm.ranked()] == ["together", "openai"]
+
+
+def test_all_providers_failing_raises(stub):
+    stub.behaviour.update(openai={"status": 503}, together={"status": 400})
+    with pytest.raises(HTTPException) as exc:
+        chat(router("openai", "together"))
+    assert exc.value.status_code == 500
+    assert "openai" in exc.value.detail and "together" in exc.value.detail
+
+
+def test_faster_provider_ranks_first(stub):
+    stub.behaviour["openai"] = {"delay": 0.2}
+    llm = router("openai", "together")
+    assert chat(llm) == "openai reply"
+    assert chat(llm) == "together reply"  # still unmeasured, so tried next
+    assert [c.provider for c in llm.ranked()] == ["together", "openai"]
+
+
+def test_breaker_opens_after_consecutive_overloads(stub, monkeypatch):
+    monkeypatch.setattr(server5, "LLM_BREAKER_FAILURES", 2)
+    stub.behaviour.update(openai={"status": 503}, together={"status": 400})
+    llm = router("openai", "together")
+    for _ in range(2):
+        with pytest.raises(HTTPException):
+            chat(llm)
+    stats = llm.stats["openai"]
+    assert not stats.available and stats.as_dict()["breaker_open"]
+    assert llm.stats["together"].available  # a 400 is the request's fault, not the provider's
+    assert [c.provider for c in llm.ranked()] == ["together", "openai"]
+
+
+def test_auth_error_opens_breaker_at_once(stub):
+    stub.behaviour["openai"] = {"status": 401}
+    llm = router("openai", "together")
+    assert chat(llm) == "together reply"
+    assert not llm.stats["openai"].available
+
+
+def test_breaker_closes_after_cooldown(stub, monkeypatch):
+    monkeypatch.setattr(server5, "LLM_BREAKER_FAILURES", 1)
+    monkeypatch.setattr(server5, "LLM_BREAKER_COOLDOWN", 0.2)
+    stub.behaviour["openai"] = {"status": 503}
+    llm = router("openai", "together")
+    assert chat(llm) == "together reply"
+    assert not llm.stats["openai"].available
+    time.sleep(0.3)
+    assert llm.stats["openai"].available
+
+
+def test_hedge_wins_when_first_provider_stalls(stub, monkeypatch):
+    monkeypatch.setattr(server5, "LLM_HEDGE", True)
+    monkeypatch.setattr(server5, "LLM_HEDGE_DEFAULT_MS", 100)
+    monkeypatch.setattr(server5, "LLM_HEDGE_MIN_MS", 50)
+    stub.behaviour["openai"] = {"delay": 2}
+    llm = router("openai", "together")
+    start = time.monotonic()
+    assert chat(llm) == "together reply"
+    assert time.monotonic() - start < 1.5
+    assert llm.hedges == 1 and llm.stats["together"].hedges_won == 1
+    assert stub.calls == ["openai", "together"]
+
+
+def test_no_hedge_when_first_provider_answers_in_time(stub, monkeypatch):
+    monkeypatch.setattr(server5, "LLM_HEDGE", True)
+    monkeypatch.setattr(server5, "LLM_HEDGE_DEFAULT_MS", 1000)
+    llm = router("openai", "together")
+    assert chat(llm) == "openai reply"
+    assert llm.hedges == 0 and stub.calls == ["openai"]
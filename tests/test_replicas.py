@@ -0,0 +1,145 @@
+"""Replica routing, failure cooldown and memory admission with stub CPU replicas."""
+import asyncio
+import threading
+from collections import Counter
+
+import pytest
+
+import server5
+
+
+class StubModel:
+    """Loader and generate_fn for fake CPU devices; generation blocks until released."""
+
+    def __init__(self, failing=()):
+        self.failing = set(failing)
+        self.gate = threading.Event()
+        self.batches = []
+
+    def load(self, device):
+        return {"device": device}, object()
+
+    def generate(self, model, processor, batch, stats):
+        assert self.gate.wait(5), "generation never released"
+        self.batches.append((model["device"], len(batch)))
+        if model["device"] in self.failing:
+            raise RuntimeError(f"{model['device']} broke")
+        return [model["device"]] * len(batch)
+
+
+@pytest.fixture
+def make_dispatcher(monkeypatch):
+    monkeypatch.setattr(server5, "MAX_TOKENS", 0)
+    monkeypatch.setattr(server5, "ADMISSION_OVERHEAD", 1.0)
+    dispatchers = []
+
+    def make(devices, stub, capacity=None):
+        dispatcher = server5.ReplicaDispatcher(devices, stub.load, stub.generate)
+        asyncio.run(dispatcher.load())
+        for replica in dispatcher.replicas:
+            replica.capacity, replica.kv_bytes_per_token = capacity, 1
+        dispatcher.start()
+        dispatchers.append(dispatcher)
+        return dispatcher
+
+    yield make
+    for dispatcher in dispatchers:
+        dispatcher.stop()
+
+
+def prepared(visual_tokens=1):
+    return server5.PreparedCaption("", None, None, {}, visual_tokens)
+
+
+def test_submit_before_load_fails():
+    dispatcher = server5.ReplicaDispatcher(["cpu:0"], StubModel().load, StubModel().generate)
+    with pytest.raises(RuntimeError, match="not loaded"):
+        dispatcher.submit(prepared())
+
+
+def test_jobs_go_to_least_loaded_replica(make_dispatcher):
+    stub = StubModel()
+    dispatcher = make_dispatcher(["cpu:0", "cpu:1", "cpu:2"], stub)
+    futures = [dispatcher.submit(prepared()) for _ in range(6)]
+    assert [r.in_flight for r in dispatcher.replicas] == [2, 2, 2]
+    stub.gate.set()
+    assert Counter(f.result(5) for f in futures) == {"cpu:0": 2, "cpu:1": 2, "cpu:2": 2}
+    assert [r.in_flight for r in dispatcher.replicas] == [0, 0, 0]
+    assert [r.completed for r in dispatcher.replicas] == [2, 2, 2]
+
+
+def test_failing_replica_cools_down(make_dispatcher, monkeypatch):
+    monkeypatch.setattr(server5, "REPLICA_MAX_FAILURES", 2)
+    stub = StubModel(failing={"cpu:0"})
+    stub.gate.set()
+    dispatcher = make_dispatcher(["cpu:0", "cpu:1"], stub)
+    for _ in range(2):  # both replicas idle, so the tie goes to cpu:0
+        with pytest.raises(RuntimeError, match="cpu:0 broke"):
+            dispatcher.submit(prepared()).result(5)
+    broken, good = dispatcher.replicas
+    assert not broken.healthy and broken.available
+    assert [dispatcher.submit(prepared()).result(5) for _ in range(3)] == ["cpu:1"] * 3
+    assert broken.failures == 2 and good.completed == 3
+
+
+def test_cooling_replica_still_used_when_no_other(make_dispatcher, monkeypatch):
+    monkeypatch.setattr(server5, "REPLICA_MAX_FAILURES", 1)
+    stub = StubModel(failing={"cpu:0"})
+    stub.gate.set()
+    dispatcher = make_dispatcher(["cpu:0"], stub)
+    with pytest.raises(RuntimeError):
+        dispatcher.submit(prepared()).result(5)
+    assert not dispatcher.replicas[0].healthy
+    stub.failing.clear()
+    assert dispatcher.submit(prepared()).result(5) == "cpu:0"
+
+
+def test_jobs_held_in_order_until_memory_frees(make_dispatcher):
+    stub = StubModel()
+    dispatcher = make_dispatcher(["cpu:0"], stub, capacity=100)
+    replica = dispatcher.replicas[0]
+    first = dispatcher.submit(prepared(60))
+    assert replica.reserved == 60 and dispatcher.metrics()["held"] == 0
+    second = dispatcher.submit(prepared(60))  # 120 > 100: held
+    third = dispatcher.submit(prepared(30))  # would fit, but waits behind the held job
+    assert dispatcher.metrics()["held"] == 2 and dispatcher.metrics()["held_total"] == 2
+    assert replica.reserved == 60 and replica.in_flight == 1
+    stub.gate.set()
+    assert [f.result(5) for f in (first, second, third)] == ["cpu:0"] * 3
+    assert dispatcher.metrics()["held"] == 0
+    assert replica.reserved == 0 and replica.in_flight == 0
+
+
+def test_idle_replica_admits_oversized_job(make_dispatcher):
+    stub = StubModel()
+    stub.gate.set()
+    dispatcher = make_dispatcher(["cpu:0"], stub, capacity=100)
+    replica = dispatcher.replicas[0]
+    assert replica.fits(replica.estimate(prepared(500)))
+    assert dispatcher.submit(prepared(500)).result(5) == "cpu:0"
+    assert dispatcher.metrics()["held_total"] == 0
+
+
+def test_admission_picks_replica_with_room(make_dispatcher):
+    stub = StubModel()
+    dispatcher = make_dispatcher(["cpu:0", "cpu:1"], stub, capacity=100)
+    dispatcher.replicas[0].capacity = 1000
+    futures = [dispatcher.submit(prepared(60)) for _ in range(4)]
+    # cpu:1 holds one 60-token job; the rest fit only on cpu:0
+    assert [r.in_flight for r in dispatcher.replicas] == [3, 1]
+    assert dispatcher.metrics()["held"] == 0
+    stub.gate.set()
+    assert Counter(f.result(5) for f in futures) == {"cpu:0": 3, "cpu:1": 1}
+
+
+def test_stop_fails_held_jobs(make_dispatcher):
+    stub = StubModel()
+    dispatcher = make_dispatcher(["cpu:0"], stub, capacity=100)
+    running = dispatcher.submit(prepared(80))
+    held = dispatcher.submit(prepared(80))
+    threading.Timer(0.1, stub.gate.set).start()  # stop() waits for the running batch
+    dispatcher.stop()
+    with pytest.raises(RuntimeError, match="stopped"):
+        held.result(5)
+    running.result(5)
+
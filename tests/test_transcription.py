@@ -0,0 +1,96 @@
+"""Chunked transcription through a stub Whisper backend, including partial failures."""
+import asyncio
+import os
+import shutil
+
+import pytest
+
+import server5
+
+
+class StubWhisper(server5.WhisperBackend):
+    """Answers each chunk with its own name; chunks listed in `failing` always raise."""
+    name = "stub"
+
+    def __init__(self, failing=()):
+        self.failing = set(failing)
+        self.calls = []
+
+    async def transcribe(self, file_name: str, data: bytes) -> dict:
+        self.calls.append(file_name)
+        if file_name in self.failing:
+            raise RuntimeError(f"{file_name} rejected")
+        return {"text": file_name, "segments": [{"start": 1.0, "end": 2.0, "text": f" {file_name} "}]}
+
+
+@pytest.fixture
+def track(monkeypatch, tmp_path):
+    """A 900-second track, three chunks at the default TRANSCRIBE_CHUNK_SECONDS, with ffmpeg replaced by file copies."""
+    monkeypatch.setattr(server5, "TRANSCRIBE_RETRIES", 0)
+
+    async def analyze(path):
+        return server5.AudioAnalysis(900.0, -10.0, [])
+
+    async def cut(args, timeout=server5.FFMPEG_TIMEOUT):
+        shutil.copy(args[args.index('-i') + 1], args[-1])
+        return True
+
+    monkeypatch.setattr(server5, "analyze_audio", analyze)
+    monkeypatch.setattr(server5, "run_ffmpeg_async", cut)
+    path = tmp_path / "track.mp3"
+    path.write_bytes(os.urandom(1024))  # unique content, so the transcript cache starts cold
+    return str(path)
+
+
+def use(monkeypatch, backend):
+    monkeypatch.setattr(server5, "whisper_backend", backend)
+    return backend
+
+
+def test_chunks_are_stitched_with_offsets_and_cached(monkeypatch, track):
+    backend = use(monkeypatch, StubWhisper())
+    stats = {}
+    transcript = asyncio.run(server5.transcribe_track(track, stats))
+    assert [seg["start"] for seg in transcript.segments] == [1.0, 301.0, 601.0]
+    assert transcript.text == "chunk_0000.mp3 chunk_0001.mp3 chunk_0002.mp3"
+    assert stats["transcription"]["chunks"] == 3 and stats["transcription"]["failed_chunks"] == 0
+
+    stats = {}
+    assert asyncio.run(server5.transcribe_track(track, stats)) == transcript
+    assert stats["transcription"]["cached"] and len(backend.calls) == 3
+
+
+def test_failed_chunk_gives_partial_uncached_transcript(monkeypatch, track):
+    backend = use(monkeypatch, StubWhisper(failing={"chunk_0001.mp3"}))
+    stats = {}
+    transcript = asyncio.run(server5.transcribe_track(track, stats))
+    assert [seg["start"] for seg in transcript.segments] == [1.0, 601.0]
+    assert stats["transcription"]["failed_chunks"] == 1
+
+    backend.failing.clear()  # not cached, so a retry fills the gap
+    stats = {}
+    transcript = asyncio.run(server5.transcribe_track(track, stats))
+    assert not stats["transcription"]["cached"] and len(transcript.segments) == 3
+
+
+def test_all_chunks_failing_gives_no_transcript(monkeypatch, track):
+    use(monkeypatch, StubWhisper(failing={f"chunk_000{i}.mp3" for i in range(3)}))
+    stats = {}
+    assert asyncio.run(server5.transcribe_audio(track, stats)) is None
+    assert stats["transcription"]["failed_chunks"] == 3
+
+
+@pytest.mark.parametrize("failing, incomplete", [((), False), ({"chunk_0002.mp3"}, True)])
+def test_stage_transcribe_flags_incomplete_transcripts(monkeypatch, track, failing, incomplete):
+    use(monkeypatch, StubWhisper(failing=failing))
+    monkeypatch.setattr(server5, "USE_AUDIO_GUARDRAIL", True)
+
+    async def audio_for_video(*args):
+        return track
+
+    monkeypatch.setattr(server5, "get_audio_for_video", audio_for_video)
+    monkeypatch.setattr(server5, "build_caption_inputs", lambda decoded, prompt, transcript, extra: transcript)
+    job = server5.CaptionJob(job_id="j", video_url="http://test/video", video_path=track)
+    asyncio.run(server5.stage_transcribe(job))
+    assert job.transcript_incomplete is incomplete
+    assert job.prepared == job.transcript and "chunk_0000.mp3" in job.transcript
@@ -0,0 +1,31 @@
+"""Retention of undeliverable payloads in the webhook outbox."""
+import time
+
+import server5
+
+DAY = 24 * 3600
+
+
+def outbox_with_rows(tmp_path):
+    outbox = server5.WebhookOutbox(path=str(tmp_path / "outbox.db"))
+    db = outbox._connect()
+    now = time.time()
+    for status, age in [("dead", 30 * DAY), ("dead", DAY), ("pending", 30 * DAY)]:
+        row_id = outbox.enqueue({"status": status}, "http://test/webhook")
+        db.execute("UPDATE outbox SET status = ?, created_at = ? WHERE id = ?", (status, now - age, row_id))
+    return outbox
+
+
+def test_prune_deletes_only_old_dead_rows(tmp_path, monkeypatch):
+    monkeypatch.setattr(server5, "WEBHOOK_DEAD_RETENTION_HOURS", 7 * 24)
+    outbox = outbox_with_rows(tmp_path)
+    assert outbox._prune() == 1
+    assert outbox.stats()["dead"] == 1 and outbox.stats()["pending"] == 1
+    assert outbox.pruned == 1
+
+
+def test_zero_retention_keeps_dead_rows(tmp_path, monkeypatch):
+    monkeypatch.setattr(server5, "WEBHOOK_DEAD_RETENTION_HOURS", 0)
+    outbox = outbox_with_rows(tmp_path)
+    assert outbox._prune() == 0
+    assert outbox.stats()["dead"] == 2